@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+benchmark.py
+Нагрузочный прогон filter_diasoft_acc_by_LE.py на синтетических файлах
+(generate_large_files.py). Каждый случай (режим x движок x поиск LE x размер)
+выполняется в отдельном процессе, чтобы пиковая память (peak RSS) не
+смешивалась между случаями. Результат — JSON со скоростью (строк/с), временем
+по этапам (и по этапам внутри write_filtered_rows из его метрик) и peak RSS; при --baseline результат сравнивается с сохранённым
+ранее JSON, при --max-regression падение скорости больше порога даёт код 1.
+
+Режимы:
+  file — прямой вызов write_filtered_rows; этапы: filter (фильтрация и запись
+         out/), save_skipped, save_errors и справочный read (чистое чтение файла
+         openpyxl read_only — нижняя граница, в общее время не входит);
+  main — полный прогон main() по папке in/ с одним файлом; этап total.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import platform
+import contextlib
+import multiprocessing
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+WORK_DIR = "bench_work"  # сгенерированные файлы и выходы прогонов
+RESULT_FILE = "bench_result.json"
+REFERENCE_STAGES = ("import", "read")  # справочные этапы, не входящие в общее время
+
+
+def peak_rss_mb():
+    """
+    Пиковый RSS текущего процесса в МБ (None, если платформа не даёт его узнать).
+    """
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return round(psutil.Process().memory_info().peak_wset / 1024 / 1024, 1)
+        except (ImportError, AttributeError):
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт КБ, macOS — байты
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(peak / divisor, 1)
+
+
+def generate_input(work_dir: str, gen_args: list) -> tuple:
+    """
+    Генерирует входной файл и LE-список (или берёт уже сгенерированные с теми же параметрами).
+    Возвращает (путь к xlsx, путь к LE-списку).
+    """
+    import generate_large_files
+
+    key = hashlib.sha256(" ".join(gen_args).encode("utf-8")).hexdigest()[:12]
+    data_dir = os.path.join(work_dir, f"data_{key}")
+    xlsx_path = os.path.join(data_dir, "bench_001.xlsx")
+    le_path = os.path.join(data_dir, "LE.txt")
+    if not (os.path.exists(xlsx_path) and os.path.exists(le_path)):
+        os.makedirs(data_dir, exist_ok=True)
+        generate_large_files.main(gen_args + ["--out-dir", data_dir, "--le-file", le_path, "--files", "1"])
+    return xlsx_path, le_path
+
+
+def run_case(case: dict, queue):
+    """
+    Выполняется в отдельном процессе: прогоняет один случай и кладёт результат в queue.
+    """
+    sys.path.insert(0, SCRIPT_DIR)
+    os.makedirs(case["case_dir"], exist_ok=True)
+    os.chdir(case["case_dir"])
+    stages = {}
+    filter_stages = {}  # этапы внутри write_filtered_rows (метрики основного скрипта)
+    # Консольный вывод скрипта (rich, logging) в замеры не попадает
+    with open(os.devnull, "w", encoding="utf-8") as devnull, \
+            contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        started = time.perf_counter()
+        import filter_diasoft_acc_by_LE as flt
+        stages["import"] = time.perf_counter() - started
+
+        if case["mode"] == "main":
+            os.makedirs("in", exist_ok=True)
+            shutil.copy(case["xlsx_path"], os.path.join("in", os.path.basename(case["xlsx_path"])))
+            shutil.copy(case["le_path"], flt.LE_FILE)
+            started = time.perf_counter()
+            flt.main(["--engine", case["engine"], "--matcher", case["matcher"], "--workers", "1"])
+            stages["total"] = time.perf_counter() - started
+            with open(os.path.join(flt.OUT_DIR, flt.METRICS_FILE), encoding="utf-8") as f:
+                for metrics in json.load(f)["files"].values():
+                    for stage, entry in metrics.items():
+                        filter_stages[stage] = filter_stages.get(stage, 0.0) + entry["seconds"]
+        else:
+            from openpyxl import load_workbook, Workbook
+
+            # 1) Чистое чтение — нижняя граница стоимости разбора файла
+            started = time.perf_counter()
+            wb = load_workbook(case["xlsx_path"], read_only=True)
+            for _ in wb.worksheets[0].iter_rows(values_only=True):
+                pass
+            wb.close()
+            stages["read"] = time.perf_counter() - started
+
+            # 2) Фильтрация
+            os.makedirs(flt.OUT_DIR, exist_ok=True)
+            le_set = flt.load_le_set(case["le_path"])
+            skipped_wb = Workbook(write_only=True)
+            errors_ws = flt.ErrorsSheet()
+            metrics = {}
+            started = time.perf_counter()
+            options = flt.FilterOptions(engine=case["engine"], matcher=case["matcher"])
+            counts = flt.write_filtered_rows(case["xlsx_path"], le_set, skipped_wb, errors_ws, options,
+                                             metrics=metrics)
+            stages["filter"] = time.perf_counter() - started
+            filter_stages = {stage: entry["seconds"] for stage, entry in metrics.items()}
+
+            # 3) Сохранение skipped и errors
+            started = time.perf_counter()
+            if skipped_wb.sheetnames:
+                skipped_wb.save(flt.SKIPPED_FILE)
+            stages["save_skipped"] = time.perf_counter() - started
+            started = time.perf_counter()
+            errors_ws.save(flt.ERRORS_FILE)
+            stages["save_errors"] = time.perf_counter() - started
+            case["counts"] = dict(zip(("filtered", "skipped", "errors"), counts))
+
+    queue.put({"stages": stages, "filter_stages": filter_stages, "counts": case.get("counts"),
+               "peak_rss_mb": peak_rss_mb()})
+
+
+def measure(case: dict) -> dict:
+    """
+    Запускает случай в свежем процессе (spawn) и собирает его метрики.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_case, args=(case, queue))
+    process.start()
+    try:
+        result = queue.get()
+    finally:
+        process.join()
+    if process.exitcode:
+        raise RuntimeError(f"Случай {case['name']} завершился с кодом {process.exitcode}")
+
+    measured = [v for k, v in result["stages"].items() if k not in REFERENCE_STAGES]
+    wall = sum(measured)
+    return {
+        "name": case["name"],
+        "mode": case["mode"],
+        "engine": case["engine"],
+        "matcher": case["matcher"],
+        "rows": case["rows"],
+        "wall_s": round(wall, 3),
+        "rows_per_s": round(case["rows"] / wall, 1) if wall else None,
+        "stages": {k: round(v, 3) for k, v in result["stages"].items()},
+        "filter_stages": {k: round(v, 3) for k, v in result["filter_stages"].items()},
+        "counts": result["counts"],
+        "peak_rss_mb": result["peak_rss_mb"],
+    }
+
+
+def compare_with_baseline(results: list, baseline: dict) -> list:
+    """
+    Сравнивает случаи с одноимёнными случаями baseline.
+    Возвращает строки [случай, строк/с было, стало, изменение %, RSS было, стало].
+    """
+    base_cases = {case["name"]: case for case in baseline.get("cases", [])}
+    rows = []
+    for case in results:
+        base = base_cases.get(case["name"])
+        if base is None or not base.get("rows_per_s") or not case.get("rows_per_s"):
+            continue
+        change = (case["rows_per_s"] / base["rows_per_s"] - 1) * 100
+        rows.append([case["name"], base["rows_per_s"], case["rows_per_s"], round(change, 1),
+                     base.get("peak_rss_mb"), case.get("peak_rss_mb")])
+    return rows
+
+
+def print_table(headers: list, rows: list):
+    widths = [max(len(str(v)) for v in column) for column in zip(headers, *rows)]
+    print("  ".join(str(h).ljust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(str(v).ljust(w) for v, w in zip(row, widths)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон фильтрации по LE.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000], help="размеры файлов (строк)")
+    parser.add_argument("--cols", type=int, default=20)
+    parser.add_argument("--styles", type=int, default=8)
+    parser.add_argument("--match-ratio", type=float, default=0.1)
+    parser.add_argument("--bad-amount-ratio", type=float, default=0.01)
+    parser.add_argument("--mode", nargs="+", choices=["file", "main"], default=["file"])
+    parser.add_argument("--engine", nargs="+", choices=["stream", "template", "zip"], default=["stream"])
+    parser.add_argument("--matcher", nargs="+", choices=["compiled", "vector", "loop"], default=["compiled"])
+    parser.add_argument("--work-dir", default=WORK_DIR, help=f"рабочая папка (по умолчанию {WORK_DIR}/)")
+    parser.add_argument("--output", default=RESULT_FILE, help=f"куда записать JSON (по умолчанию {RESULT_FILE})")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--max-regression", type=float, metavar="PCT",
+                        help="код выхода 1, если скорость упала больше чем на PCT %% относительно baseline")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sys.path.insert(0, SCRIPT_DIR)
+    work_dir = os.path.abspath(args.work_dir)
+
+    results = []
+    for rows in args.rows:
+        gen_args = ["--rows", str(rows), "--cols", str(args.cols), "--styles", str(args.styles),
+                    "--match-ratio", str(args.match_ratio), "--bad-amount-ratio", str(args.bad_amount_ratio)]
+        xlsx_path, le_path = generate_input(work_dir, gen_args)
+        for mode in args.mode:
+            for engine in args.engine:
+                for matcher in args.matcher:
+                    name = f"{mode}-{engine}-{matcher}-r{rows}"
+                    case_dir = os.path.join(work_dir, "runs", name)
+                    shutil.rmtree(case_dir, ignore_errors=True)
+                    case = {"name": name, "mode": mode, "engine": engine, "matcher": matcher, "rows": rows,
+                            "xlsx_path": xlsx_path, "le_path": le_path, "case_dir": case_dir}
+                    print(f"Прогон {name}...", flush=True)
+                    results.append(measure(case))
+
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "generator": {"cols": args.cols, "styles": args.styles, "match_ratio": args.match_ratio,
+                      "bad_amount_ratio": args.bad_amount_ratio},
+        "cases": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print_table(["Случай", "Строк/с", "Время, с", "Peak RSS, МБ", "Этапы"],
+                [[c["name"], c["rows_per_s"], c["wall_s"], c["peak_rss_mb"],
+                  ", ".join(f"{k}={v}" for k, v in c["stages"].items())] for c in results])
+    print(f"Результат записан в {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows = compare_with_baseline(results, baseline)
+        print()
+        print_table(["Случай", "Строк/с (baseline)", "Строк/с", "Изменение, %", "RSS (baseline)", "RSS"], rows)
+        if args.max_regression is not None and any(row[3] < -args.max_regression for row in rows):
+            print(f"Скорость упала больше чем на {args.max_regression}% — см. таблицу выше.")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,71 +8,312 @@ filter_diasoft_acc_by_LE.py
 а пропущенные строки собирает в skipped.xlsx. Ошибки логируются в errors.xlsx.
 Сохраняет стили ячеек (шрифт, границы, фон, выравнивание и т.д.) и заголовки.
 Также удаляет пустые строки в конце выходного листа.
+
+Каждый входной файл разбирается один раз. По умолчанию используется потоковый
+движок (ENGINE = "stream"): потоковый разбор XML листа (iterparse, запасной
+путь — openpyxl read_only) на чтение и write_only-книга на запись, решение
+по LE принимается по мере чтения строк.
+Движок "template" загружает исходную книгу целиком и использует её как шаблон
+(сохраняются ширины колонок, объединения ячеек и прочие листы книги).
+Движок "zip" читает как stream, а выходной файл собирает копированием
+архива исходной книги, заново генерируя только XML листа.
 """
 
 import os
+import sys
+import time
 import glob
 import re
+import csv
+import argparse
+import tempfile
+import hashlib
+import json
+import shutil
+import pickle
+import importlib.util
+import itertools
 import datetime
 import logging
-import pandas as pd
+import queue
+import threading
+import atexit
+import cProfile
+import signal
+import posixpath
+import zipfile
+from bisect import bisect_left, bisect_right
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape as xml_escape
+from logging.handlers import QueueHandler, QueueListener
 from openpyxl import load_workbook, Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import column_index_from_string, get_column_letter
 from pathlib import Path
 from copy import copy
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 try:
-    from rich.console import Console
-    from rich.text import Text
-    RICH_AVAILABLE = True
-except ImportError:
-    RICH_AVAILABLE = False
+    import resource
+except ImportError:  # Windows: пиковая память в метриках не указывается
+    resource = None
 
 # ========== Настройки файлов и директорий ==========
 LE_FILE = "LE.txt"
+IN_PATTERN = "in/*.xlsx"  # входные файлы
 OUT_DIR = "out"
 SKIPPED_FILE = "skipped.xlsx"
 ERRORS_FILE = "errors.xlsx"
+ERRORS_HEADER = ["Файл", "Строка", "Описание ошибки"]
+SKIPPED_DIR = "skipped"  # пропущенные строки по файлам для форматов csv/parquet/jsonl (в OUT_DIR)
 LOG_FILE = "log.md"  # также используем logging модуль для файла .md
+MANIFEST_FILE = "manifest.json"  # манифест входных файлов для --incremental (в OUT_DIR)
+MANIFEST_VERSION = 2
+CACHE_DIR = ".cache"  # кэш skipped-частей для --incremental (в OUT_DIR)
+PARSE_CACHE_DIR = ".parse_cache"  # кэш разобранных входных файлов для --parse-cache
+PARSE_CACHE_MAX_MB = 2048  # предельный размер кэша разбора
+PARSE_CACHE_VERSION = 2
+METRICS_FILE = "metrics.json"  # метрики этапов последнего запуска (в OUT_DIR)
+PROFILE_DIR = "profiles"  # дампы cProfile по файлам для --profile
+WATCH_INTERVAL = 2.0  # секунд между опросами in/ в режиме --watch
+WATCH_SETTLE_SECONDS = 1.0  # файл считается дописанным, если столько секунд не менялся
 
-# ========== Настройки красивого вывода ==========
-if RICH_AVAILABLE:
-    console = Console()
-else:
-    console = None
+# ========== Настройки обработки ==========
+ENGINE = "stream"  # "stream" — потоковое чтение/запись, "template" — исходный файл как шаблон,
+                   # "zip" — чтение как у stream, выход — копия архива с новым XML листа
+MATCHER = "compiled"  # "compiled" — все маркеры LE строки по индексу LE.txt; "vector", "loop" — только первый маркер
+READER = "lean"  # "lean" — чтение XML листа напрямую (iterparse), "openpyxl" — через openpyxl read_only
+LE_IN_TEXT = False  # искать коды LE и в тексте ячеек (назначение платежа и т.п.), только для "compiled"
+LE_NORMALIZE_CACHE_SIZE = 100000  # нормализованных значений ячеек в кэше сопоставителя
+WRITE_SKIPPED = True  # False — пропущенные строки только считаются: skipped.xlsx и out/skipped/ не пишутся
+SHEETS = None  # листы для обработки: None — все рабочие листы книги, иначе кортеж имён
+MATCH_BATCH_ROWS = 5000  # размер окна строк (сопоставление, преобразование, запись) по умолчанию
+MIN_CHUNK_ROWS = 100  # окно не меньше этого при --max-memory
+PIPELINE_DEPTH = 2  # окон в очередях между потоками чтения, отбора и записи; 0 — без конвейера
+INPUT_PREFETCH_CHUNK = 1024 * 1024  # байт за одно чтение при упреждающем чтении входных файлов
+STAGE_POLL_SECONDS = 0.1  # период проверки остановки потоком этапа, ждущим место в очереди
+MEMORY_BASELINE_MB = 150  # память процесса без данных: интерпретатор, pandas, openpyxl
+CELL_BYTES_ESTIMATE = 400  # память на ячейку окна: ячейка openpyxl, значение, фрейм сопоставления
+AMOUNT_COL_IDX = 7  # 8-я колонка — сумма (если колонка не узнана по заголовку)
+DATE_COL_IDX = 3  # 4-я колонка — дата (если колонка не узнана по заголовку)
+AMOUNT_NUMBER_FORMAT = "#,##0.00"  # формат колонки суммы в выходном xlsx
+DATE_NUMBER_FORMAT = "dd.mm.yyyy"  # формат колонки даты в выходном xlsx
+LAYOUT_SNIFF_ROWS = 20  # первых строк листа, среди которых ищется заголовок
+# Имена колонок ролей (по приоритету, сравнение без регистра); переопределяются --layout
+COLUMN_ROLE_NAMES = {
+    "amount": ("сумма", "сумма проводки", "сумма в валюте", "сумма в рублях", "amount"),
+    "date": ("дата", "дата проводки", "дата операции", "дата документа", "date"),
+    # в выгрузке Диасофт маркер "LE" бывает в любой колонке — ищем во всей строке;
+    # поэтому без le_marker в --layout чтения в две фазы нет (см. write_filtered_rows)
+    "le_marker": (),
+}
+OUTPUT_FORMAT = "xlsx"  # "xlsx" — со стилями; "csv", "parquet", "jsonl" — только данные, без стилей
+OUTPUT_FORMATS = ("xlsx", "csv", "parquet", "jsonl")
+TABLE_FLUSH_ROWS = 10000  # строк в пачке записи csv/jsonl
+CONSOLIDATE = None  # None — выход по каждому файлу; "all" — все отобранные строки в одну книгу, "le" — книга на код LE
+CONSOLIDATED_FILE = "filtered.xlsx"  # сводная книга режима "all" (в OUT_DIR)
+CONSOLIDATED_LE_DIR = "by_le"  # книги по кодам LE режима "le" (в OUT_DIR)
+CONSOLIDATED_SHEET = "Отфильтровано"  # имя листа сводной книги ("le" — код LE)
+CONSOLIDATED_SOURCE_HEADER = "Исходный файл"  # последняя колонка сводного выхода: файл (и лист) строки
+CONSOLIDATED_MAX_OPEN = 64  # открытых книг режима "le"; строки остальных кодов откладываются во временные файлы
+EXCEL_MAX_ROWS = 1048576  # строк на листе Excel вместе с заголовком; дальше сводный выход — в следующий файл
+CSV_DELIMITER = ";"
+DATE_FORMATS = ("%d.%m.%Y", "%d.%m.%y", "%d.%m.%Y %H:%M:%S", "%Y-%m-%d", "%Y-%m-%d %H:%M:%S")
 
-# Создаём папку out если нет
-os.makedirs(OUT_DIR, exist_ok=True)
+# ========== Настройки красивого вывода ==========
+RICH_AVAILABLE = importlib.util.find_spec("rich") is not None
+_console = None
 
-# Очищаем папку out (удаляем файлы внутри)
-for f in os.listdir(OUT_DIR):
-    try:
-        os.remove(os.path.join(OUT_DIR, f))
-    except Exception:
-        pass
+def get_console():
+    """
+    Консоль rich (создаётся при первом выводе, rich импортируется только тогда)
+    или None, если rich не установлен.
+    """
+    global _console
+    if _console is None and RICH_AVAILABLE:
+        from rich.console import Console
+        _console = Console()
+    return _console
 
 # ========== Настройка логирования ==========
+# Все записи (markdown-сообщения log_md/log_header и обычные logger.*) идут через
+# очередь: основной поток только кладёт запись в queue, а фоновый поток
+# QueueListener пишет их в LOG_FILE через один открытый файл пачками по
+# LOG_FLUSH_LINES строк и выводит в консоль согласно CONSOLE_MODE.
+# При импорте модуля (использование как библиотеки) ничего не настраивается:
+# обработчики подключает setup_logging() из main() и в рабочих процессах пула.
+LOG_FLUSH_LINES = 200  # строк в пачке записи в LOG_FILE (ошибки сбрасываются сразу)
+CONSOLE_MODE = "full"  # "full" — панель на сообщение, "progress" — строка на файл, "quiet" — только итоги
+LOG_LEVELS = {"INFO": logging.INFO, "WARNING": logging.WARNING, "ERROR": logging.ERROR}
+
 logger = logging.getLogger("filter_le")
 logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.NullHandler())
+
+class BufferedMarkdownHandler(logging.Handler):
+    """
+    Пишет записи в файл (append) чистым MD без префиксов: один открытый файл,
+    запись пачками по flush_lines строк; записи уровня ERROR сбрасываются сразу.
+    """
+
+    def __init__(self, path: str, flush_lines: int = LOG_FLUSH_LINES):
+        super().__init__(logging.DEBUG)
+        self.path = path
+        self.flush_lines = flush_lines
+        self.buffer = []
+        self.stream = None
+        self.setFormatter(logging.Formatter("%(message)s"))  # Только сообщение, без времени и уровня
+
+    def emit(self, record):
+        try:
+            self.buffer.append(self.format(record))
+            if len(self.buffer) >= self.flush_lines or record.levelno >= logging.ERROR:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        if self.stream is None:
+            self.stream = open(self.path, "a", encoding="utf-8")
+        self.stream.write("\n".join(self.buffer) + "\n")
+        self.stream.flush()
+        self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        super().close()
+
+class ConsoleHandler(logging.Handler):
+    """
+    Консольный вывод. В режиме "full" markdown-сообщения выводятся панелью rich
+    (или строкой без rich), остальные записи — "LEVEL: сообщение" от INFO и выше.
+    В режимах "progress" и "quiet" выводятся только ошибки.
+    """
+
+    def emit(self, record):
+        try:
+            if CONSOLE_MODE != "full" and record.levelno < logging.ERROR:
+                return
+            if not hasattr(record, "console_text"):
+                if record.levelno >= logging.INFO:
+                    sys.stderr.write(f"{record.levelname}: {record.getMessage()}\n")
+                return
+            message = record.console_text
+            if message is None:  # заголовки MD пишутся только в файл
+                return
+            console = get_console()
+            if console:
+                from rich.panel import Panel
+
+                color_map = {"INFO": "green", "WARNING": "yellow", "ERROR": "red"}
+                color = color_map.get(record.levelname, "white")
+                if message.strip():  # Только если сообщение не пустое
+                    console.print(Panel(f"[{color}]{message}[/]", title=record.levelname, expand=False))
+                else:
+                    console.print()  # Просто пустая строка
+            else:
+                print(f"{record.timestamp} {record.levelname}: {message}")
+        except Exception:
+            self.handleError(record)
+
+file_handler = None
+console_handler = None
+log_queue = None
+log_listener = None
+
+def start_logging():
+    """
+    Запускает фоновый поток логирования с новой очередью.
+    """
+    global log_queue, log_listener
+    log_queue = queue.Queue()
+    log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    for handler in [h for h in logger.handlers if isinstance(h, QueueHandler)]:
+        logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(log_queue))
+    log_listener.start()
+
+def restart_logging_after_fork():
+    """
+    Поток-слушатель в дочерний процесс (fork) не переходит: запускаем свой.
+    Несброшенный буфер принадлежит родителю и в дочернем процессе не пишется.
+    """
+    if log_listener is None:
+        return
+    file_handler.buffer = []
+    file_handler.stream = None
+    start_logging()
+
+def setup_logging(console_mode: str = None, log_file: str = None):
+    """
+    Подключает запись в log_file (по умолчанию LOG_FILE) и вывод в консоль
+    в режиме console_mode (см. CONSOLE_MODE). Повторный вызов только меняет
+    режим консоли.
+    """
+    global file_handler, console_handler
+    set_console_mode(console_mode or CONSOLE_MODE)
+    if log_listener is not None:
+        return
+    file_handler = BufferedMarkdownHandler(log_file or LOG_FILE)
+    console_handler = ConsoleHandler()
+    logger.propagate = False
+    start_logging()
+    atexit.register(stop_logging)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=restart_logging_after_fork)
 
-# File handler - пишет в LOG_FILE (append) чистый MD без префиксов
-fh = logging.FileHandler(LOG_FILE, encoding="utf-8")
-fh.setLevel(logging.DEBUG)
-fh_formatter = logging.Formatter("%(message)s")  # Только сообщение, без времени и уровня
-fh.setFormatter(fh_formatter)
+def flush_logging():
+    """
+    Дожидается, пока фоновый поток обработает все записи очереди, и сбрасывает
+    буфер в LOG_FILE (конец файла в рабочем процессе, конец запуска).
+    """
+    if log_listener is None:
+        return
+    log_queue.join()
+    file_handler.flush()
+
+def stop_logging():
+    """
+    Останавливает фоновый поток логирования и закрывает LOG_FILE.
+    """
+    global log_listener
+    if log_listener is None:
+        return
+    log_listener.stop()
+    log_listener = None
+    file_handler.close()
+    for handler in [h for h in logger.handlers if isinstance(h, QueueHandler)]:
+        logger.removeHandler(handler)
+    logger.propagate = True
 
-# Console handler - INFO и выше в консоль с цветами если rich доступен
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-ch_formatter = logging.Formatter("%(levelname)s: %(message)s")
-ch.setFormatter(ch_formatter)
+def set_console_mode(mode: str):
+    """
+    Задаёт режим консоли: "full", "progress" или "quiet" (см. CONSOLE_MODE).
+    """
+    global CONSOLE_MODE
+    CONSOLE_MODE = mode
 
-logger.addHandler(fh)
-logger.addHandler(ch)
+def init_worker(console_mode: str = None):
+    """
+    initializer рабочих процессов пула: логирование подключается, только если
+    оно настроено в родительском процессе (console_mode не None). Обработчик
+    SIGTERM режима --watch (см. stop_on_sigterm), унаследованный при fork,
+    сбрасывается: рабочий процесс завершается молча, а не с KeyboardInterrupt.
+    """
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if console_mode is not None:
+        setup_logging(console_mode)
 
 # ========== Вспомогательные функции для красивого вывода ==========
 
-from rich.table import Table
-from rich.panel import Panel
-from rich.markdown import Markdown
 from datetime import datetime
 
 def log_md(message: str, level: str = "INFO"):
@@ -83,19 +324,9 @@ def log_md(message: str, level: str = "INFO"):
         "ERROR": "❌",
     }.get(level, "ℹ️")
     md_message = f"> **[{timestamp}] {prefix} {message}**"
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(f"{md_message}\n")
-
-    # Красивый вывод в консоль
-    if console:
-        color_map = {"INFO": "green", "WARNING": "yellow", "ERROR": "red"}
-        color = color_map.get(level, "white")
-        if message.strip():  # Только если сообщение не пустое
-            console.print(Panel(f"[{color}]{message}[/]", title=level, expand=False))
-        else:
-            console.print()  # Просто пустая строка
-    else:
-        print(f"{timestamp} {level}: {message}")
+    # В файл пишется md_message, в консоль (фоновым потоком) — message
+    logger.log(LOG_LEVELS.get(level, logging.INFO), md_message,
+               extra={"console_text": message, "timestamp": timestamp})
 
 def log_header(text: str, level: int = 1):
     """
@@ -103,8 +334,17 @@ def log_header(text: str, level: int = 1):
     """
     hashes = "#" * level
     msg = f"{hashes} {text}"
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(f"{msg}\n")
+    logger.info(msg, extra={"console_text": None})
+
+def log_progress(index: int, total: int, file_name: str, counts: tuple):
+    """
+    Строка прогресса на файл для режима консоли "progress".
+    """
+    if CONSOLE_MODE != "progress":
+        return
+    filtered, skipped, errors = counts
+    print(f"[{index}/{total}] {file_name}: отфильтровано {filtered}, пропущено {skipped}, ошибок {errors}",
+          flush=True)
 
 def log_list_item(text: str):
     """
@@ -131,8 +371,13 @@ def log_table(headers: list, rows: list):
 
 def log_file_separator():
     """
-    Добавляет визуальный разделитель между обработкой файлов в консоли.
+    Добавляет визуальный разделитель между обработкой файлов в консоли
+    (только в режиме "full"; перед ним выводятся все сообщения из очереди).
     """
+    if CONSOLE_MODE != "full" or log_listener is None:
+        return
+    flush_logging()
+    console = get_console()
     if console:
         console.print("\n" + "=" * 60 + "\n", style="blue")
     else:
@@ -142,6 +387,8 @@ def log_total_stats(filtered: int, skipped: int, errors: int):
     """
     Логирует итоговую статистику в красивом формате.
     """
+    flush_logging()
+    console = get_console()
     if console:
         try:
             console.print("\n[bold cyan]ИТОГОВАЯ СТАТИСТИКА:[/bold cyan]")
@@ -161,18 +408,53 @@ def log_total_stats(filtered: int, skipped: int, errors: int):
         print(f"Пропущено: {skipped} строк")
         print(f"Ошибок: {errors} строк")
 
-# Логируем старт скрипта
-log_header("Запуск скрипта filter_diasoft_acc_by_LE.py")
-log_header("Настройки", 2)
-log_header(f"LE файл: {LE_FILE}", 3)
-log_header(f"Выходная папка: {OUT_DIR}", 3)
-log_header(f"Файл пропущенных: {SKIPPED_FILE}", 3)
-log_header(f"Файл ошибок: {ERRORS_FILE}", 3)
-log_header(f"Лог файл: {LOG_FILE}", 3)
-log_md("", "INFO")  # Пустая строка для разделения абзацев
+def prepare_out_dir(out_dir: str = OUT_DIR):
+    """
+    Создаёт папку out_dir (по умолчанию OUT_DIR), если её нет, и очищает её
+    (удаляет файлы внутри). Вызывается из main(), а не при импорте: рабочие
+    процессы пула импортируют модуль заново и не должны трогать out/.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for f in os.listdir(out_dir):
+        path = os.path.join(out_dir, f)
+        try:
+            if os.path.isdir(path):
+                # Папки групп и кэш инкрементального режима
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except Exception:
+            pass
+
+def log_run_settings(workers: int, engine: str, output_format: str = OUTPUT_FORMAT):
+    """
+    Логирует старт скрипта и его настройки.
+    """
+    log_header("Запуск скрипта filter_diasoft_acc_by_LE.py")
+    log_header("Настройки", 2)
+    log_header(f"LE файл: {LE_FILE}", 3)
+    log_header(f"Выходная папка: {OUT_DIR}", 3)
+    log_header(f"Файл пропущенных: {SKIPPED_FILE}", 3)
+    log_header(f"Файл ошибок: {ERRORS_FILE}", 3)
+    log_header(f"Лог файл: {LOG_FILE}", 3)
+    log_header(f"Движок: {engine}", 3)
+    log_header(f"Процессов: {workers}", 3)
+    log_header(f"Формат вывода: {output_format}", 3)
+    log_md("", "INFO")  # Пустая строка для разделения абзацев
 
 # ========== Вспомогательные функции ==========
 
+# Коды LE сравниваются без пробелов (в т.ч. неразрывных) и тире, в верхнем регистре
+LE_NORMALIZE_TABLE = str.maketrans("", "", " -\t\r\n\x0b\x0c\u00a0\u202f")
+# Текст ячейки при поиске кода внутри него: без тире (LE-001 -> LE001), пробелы — границы слов
+LE_TEXT_TABLE = str.maketrans("", "", "-")
+
+def normalize_le(value: str) -> str:
+    """
+    Нормализует код LE: убирает пробелы и тире, переводит в верхний регистр.
+    """
+    return value.translate(LE_NORMALIZE_TABLE).upper()
+
 def load_le_set(le_file: str) -> set:
     """
     Загружает LE из текстового файла.
@@ -183,7 +465,7 @@ def load_le_set(le_file: str) -> set:
     try:
         with open(le_file, "r", encoding="utf-8") as fh:
             for line in fh:
-                cleaned = line.strip().replace("-", "").replace(" ", "").upper()
+                cleaned = normalize_le(line)
                 if cleaned:
                     le_set.add(cleaned)
         log_header("Загруженные LE", 2)
@@ -197,34 +479,126 @@ def load_le_set(le_file: str) -> set:
         logger.exception("Ошибка при чтении %s: %s", le_file, e)
     return le_set
 
+def load_le_groups(le_files: list = None, le_map: str = None) -> dict:
+    """
+    Загружает несколько списков LE для режима групп.
+    le_files: файлы LE, группа — имя файла без расширения (LE_holding.txt -> LE_holding);
+    le_map: файл соответствия "LE;группа" (разделитель ; , или табуляция), одна пара на строку.
+    Один LE может входить в несколько групп. Возвращает {группа: set LE}.
+    """
+    le_groups = {}
+    for le_file in le_files or []:
+        le_groups[Path(le_file).stem] = load_le_set(le_file)
+    if le_map:
+        try:
+            with open(le_map, "r", encoding="utf-8") as fh:
+                for line_no, line in enumerate(fh, start=1):
+                    if not line.strip():
+                        continue
+                    parts = re.split(r"[;,\t]", line, maxsplit=1)
+                    le = normalize_le(parts[0])
+                    group = parts[1].strip() if len(parts) > 1 else ""
+                    if not le or not group:
+                        logger.warning("Строка %s файла %s пропущена: ожидается 'LE;группа'", line_no, le_map)
+                        continue
+                    le_groups.setdefault(group, set()).add(le)
+        except FileNotFoundError:
+            logger.error("Файл %s не найден.", le_map)
+        except Exception as e:
+            logger.exception("Ошибка при чтении %s: %s", le_map, e)
+        log_header("Загруженные группы LE", 2)
+        log_list_item(f"Загружено **{len(le_groups)}** групп из `{le_map}`")
+        if le_groups:
+            log_table(["Группа", "LE"], [[g, ", ".join(sorted(les))] for g, les in sorted(le_groups.items())])
+            log_md("", "INFO")  # Пустая строка для разделения абзацев
+    # Пустые группы не участвуют в отборе
+    return {group: les for group, les in le_groups.items() if les}
+
+def group_dir_name(group: str) -> str:
+    """
+    Имя папки группы внутри OUT_DIR (без недопустимых в путях символов).
+    """
+    return re.sub(r'[\\/:*?"<>|]', "_", group).strip() or "_"
+
+def convert_amounts(raw_values: list) -> tuple[list, list]:
+    """
+    Пакетно преобразует значения колонки суммы в float.
+    Числа берутся как есть; строки очищаются одним проходом по столбцу:
+    пробелы (в т.ч. неразрывные) — разделители разрядов; запятая — десятичный
+    разделитель ("1 234 567,89", "1234,5", "1.234,5", в том числе "1,234"),
+    а разделителем разрядов считается только при точке в дробной части
+    ("1,234,567.89").
+    Возвращает (суммы, ошибки): для каждого значения float и "" при успехе
+    или None и описание ошибки.
+    """
+    import pandas as pd
+
+    n = len(raw_values)
+    amounts = [None] * n
+    errors = [""] * n
+    if not n:
+        return amounts, errors
+    raw = pd.Series(raw_values, dtype=object)
+    is_number = raw.map(lambda v: isinstance(v, (int, float)) and not isinstance(v, bool)).to_numpy(dtype=bool)
+    text = raw.map(lambda v: "" if v is None else str(v)).str.strip()
+    compact = text.str.replace(r"[\s\u00a0\u202f]", "", regex=True)
+
+    cleaned = compact.copy()
+    grouped = compact.str.fullmatch(r"\d{1,3}(,\d{3})+\.\d+")
+    cleaned[grouped] = compact[grouped].str.replace(",", "", regex=False)
+    comma_decimal = compact.str.fullmatch(r"\d+(\.\d{3})*,\d+") & ~grouped
+    cleaned[comma_decimal] = (compact[comma_decimal].str.replace(".", "", regex=False)
+                              .str.replace(",", ".", regex=False))
+    # Допускаем точку как разделитель дробной части (427680000.00)
+    valid = cleaned.str.fullmatch(r"\d+(\.\d+)?").to_numpy(dtype=bool)
+    parsed = pd.to_numeric(cleaned.where(valid), errors="coerce").to_numpy()
+
+    for i in range(n):
+        if is_number[i] and raw_values[i] >= 0:
+            amounts[i] = float(raw_values[i])
+        elif valid[i]:
+            amounts[i] = float(parsed[i])
+        elif not is_number[i] and text.iat[i] == "":
+            errors[i] = "Пустое значение суммы"
+        else:
+            errors[i] = f"Некорректный формат суммы: '{raw_values[i]}' -> cleaned '{cleaned.iat[i]}'"
+    return amounts, errors
+
 def parse_and_convert_amount(amount_str: str) -> tuple[float | None, str]:
     """
-    Преобразует строку суммы в float.
-    Очищает разделители разрядов (заменяет запятые) и проверяет формат.
+    Преобразует одно значение суммы в float (см. convert_amounts).
     Возвращает (float, "") при успехе или (None, описание_ошибки).
     """
-    if amount_str is None or (isinstance(amount_str, str) and amount_str.strip() == ""):
-        return None, "Пустое значение суммы"
-    s = str(amount_str).strip()
-    # Убираем тысячи-разделители запятой и пробелы
-    cleaned = re.sub(r'[,\s]', '', s)
-    # Допускаем точку как разделитель дробной части (427680000.00)
-    if not re.match(r'^\d+(\.\d+)?$', cleaned):
-        return None, f"Некорректный формат суммы: '{amount_str}' -> cleaned '{cleaned}'"
-    try:
-        val = float(cleaned)
-        return val, ""
-    except Exception as e:
-        return None, f"Ошибка преобразования в число: {e}"
+    amounts, errors = convert_amounts([amount_str])
+    return amounts[0], errors[0]
+
+def style_key(cell):
+    """
+    Ключ стиля исходной ячейки в пределах её книги: индекс стиля у ReadOnlyCell,
+    кортеж индексов StyleArray у обычной ячейки.
+    """
+    style_id = getattr(cell, "_style_id", None)
+    if style_id is not None:
+        return style_id
+    return tuple(cell._style)
 
-def copy_cell_style(src_cell, dest_cell):
+def copy_cell_style(src_cell, dest_cell, style_cache: dict = None):
     """
     Копирует визуальные атрибуты ячейки из src_cell в dest_cell.
     Копируются: font, border, fill, number_format, protection, alignment.
-    Обёртка через copy() чтобы избежать общих ссылок на объекты стилей.
+    Если передан style_cache, каждое сочетание стилей (ключ — стиль исходной
+    ячейки и книга назначения) разбирается один раз, а дальше ячейке
+    назначается копия готового StyleArray (набор индексов стилей книги).
+    Кэш действителен только пока живы исходная книга и книга назначения.
     """
     if src_cell is None or not getattr(src_cell, "has_style", False):
         return
+    if style_cache is not None:
+        key = (style_key(src_cell), id(dest_cell.parent.parent))
+        cached = style_cache.get(key)
+        if cached is not None:
+            dest_cell._style = copy(cached)
+            return
     try:
         dest_cell.font = copy(src_cell.font)
         dest_cell.border = copy(src_cell.border)
@@ -234,328 +608,3613 @@ def copy_cell_style(src_cell, dest_cell):
         dest_cell.alignment = copy(src_cell.alignment)
     except Exception as e:
         logger.warning("Не удалось полностью скопировать стиль ячейки %s: %s", getattr(src_cell, "coordinate", "?"), e)
+        return
+    if style_cache is not None:
+        style_cache[key] = copy(dest_cell._style)
 
-def is_row_empty(ws, row_idx) -> bool:
+def truncate_rows(ws, last_row: int):
     """
-    Проверяет, пустая ли строка row_idx на листе ws.
-    Считается пустой, если все ячейки None или пустая строка после strip().
+    Отрезает все строки листа ws ниже last_row (значения и стили) одним
+    вызовом delete_rows на весь хвост, а не построчным удалением с
+    повторным просмотром каждой строки исходного листа. Ячейки оставляемых
+    строк не трогаются, в том числе правее колонок таблицы.
     """
-    for cell in ws[row_idx]:
-        if cell.value is not None and str(cell.value).strip() != "":
-            return False
-    return True
+    if ws.max_row > last_row:
+        ws.delete_rows(last_row + 1, ws.max_row - last_row)
 
-def remove_trailing_blank_rows(ws):
+def is_empty_value(value) -> bool:
     """
-    Удаляет пустые строк в конце листа ws.
-    Пока последняя строка полностью пустая — удаляет её.
-    Это предотвращает появление лишней пустой строки в конце выходного файла.
+    Пустое значение ячейки (как его понимает pandas.read_excel): None или "".
     """
-    try:
-        max_row = ws.max_row
-        # Пытаемся удалить до тех пор, пока последняя строка пустая и > 1 (не удаляем заголовок)
-        while max_row > 1:
-            # ws[max_row] возвращает кортеж ячеек в строке
-            if all((cell.value is None or str(cell.value).strip() == "") for cell in ws[max_row]):
-                ws.delete_rows(max_row, 1)
-                max_row -= 1
+    return value is None or value == ""
+
+def find_le_match(values: list, le_set: set, le_cols: tuple = None) -> tuple[str, str, str]:
+    """
+    Ищет в строке значение "LE" (регистр игнорируем) и проверяет следующую
+    колонку ("Аналитику") на совпадение с le_set. Учитывается только первый LE.
+    le_cols — колонки, в которых ищется маркер (None — все колонки).
+    Возвращает (статус, описание_ошибки, аналитика), где статус:
+      "match" — аналитика найдена в le_set (аналитика — кортеж совпавших
+                кодов LE, здесь из одного кода);
+      "skip"  — аналитика не совпала с LE.txt (нормальная причина пропуска);
+      "error" — LE не найден, аналитика пустая или отсутствует.
+    """
+    for col_idx, value in enumerate(values):
+        if le_cols is not None and col_idx not in le_cols:
+            continue
+        cell_value = str(value).strip().upper() if not is_empty_value(value) else ""
+        if cell_value == "LE":
+            # Берём следующую колонку как "Аналитику"
+            if col_idx + 1 < len(values):
+                analytics_raw = values[col_idx + 1]
+                analytics_value = normalize_le(str(analytics_raw)) if not is_empty_value(analytics_raw) else ""
+                if analytics_value and analytics_value in le_set:
+                    return "match", "", (analytics_value,)
+                if analytics_value:
+                    return "skip", "", analytics_value
+                return "error", f"Пустая аналитика после LE в колонке {col_idx}", ""
+            return "error", f"LE в колонке {col_idx}, но нет следующей колонки для аналитики", ""
+    return "error", "В строке не найден LE", ""
+
+def classify_rows_vectorized(rows_values: list, le_set: set, le_cols: tuple = None) -> list:
+    """
+    Векторный аналог find_le_match для блока строк.
+    Строковый фрейм (strip + upper) строится один раз на блок, первый маркер "LE"
+    в строке ищется через argmax, аналитика сверяется с le_set одним isin.
+    Возвращает список (статус, описание_ошибки, аналитика) в порядке строк —
+    так же, как построчный find_le_match.
+    """
+    import numpy as np
+    import pandas as pd
+
+    if not rows_values:
+        return []
+    df = pd.DataFrame(rows_values, dtype=object)
+    empty = (df.isna() | (df == "")).to_numpy()
+    text = df.astype(str)
+    upper = text.apply(lambda col: col.str.strip().str.upper()).to_numpy(dtype=object)
+    upper[empty] = ""
+    text = text.to_numpy(dtype=object)
+    text[empty] = ""
+
+    is_le = upper == "LE"
+    if le_cols is not None:
+        marker_cols = np.zeros(upper.shape[1], dtype=bool)
+        marker_cols[[c for c in le_cols if c < upper.shape[1]]] = True
+        is_le &= marker_cols
+    has_le = is_le.any(axis=1)
+    first_le = is_le.argmax(axis=1)
+    # Длина каждой строки: "следующая колонка" должна существовать в самой строке
+    lengths = np.fromiter((len(values) for values in rows_values), dtype=np.int64, count=len(rows_values))
+    next_idx = first_le + 1
+    has_next = has_le & (next_idx < lengths)
+
+    positions = np.arange(len(rows_values))
+    # Аналитика нормализуется той же таблицей, что и в normalize_le (построчный и компилированный поиск)
+    analytics = pd.Series(text[positions, np.minimum(next_idx, text.shape[1] - 1)], dtype=object)
+    analytics = analytics.str.translate(LE_NORMALIZE_TABLE).str.upper()
+    analytics_filled = (analytics != "").to_numpy() & has_next
+    in_set = analytics.isin(le_set).to_numpy() & analytics_filled
+
+    analytics = analytics.to_numpy()
+    result = []
+    for i in range(len(rows_values)):
+        if in_set[i]:
+            result.append(("match", "", (analytics[i],)))
+        elif analytics_filled[i]:
+            result.append(("skip", "", analytics[i]))
+        elif has_next[i]:
+            result.append(("error", f"Пустая аналитика после LE в колонке {first_le[i]}", ""))
+        elif has_le[i]:
+            result.append(("error", f"LE в колонке {first_le[i]}, но нет следующей колонки для аналитики", ""))
+        else:
+            result.append(("error", "В строке не найден LE", ""))
+    return result
+
+class LEAutomaton:
+    """
+    Автомат Ахо — Корасик по кодам LE: находит все коды внутри строки за один
+    проход по её символам, сколько бы кодов ни было в словаре.
+    """
+
+    def __init__(self, codes):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]  # код, оканчивающийся в узле
+        self.dict_link = [0]  # ближайший по fail-ссылкам узел с кодом (0 — нет)
+        for code in codes:
+            node = 0
+            for ch in code:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.dict_link.append(0)
+                node = nxt
+            self.output[node] = code
+        self.min_len = min((len(code) for code in codes), default=0)
+        # fail-ссылки — обходом в ширину
+        pending = list(self.goto[0].values())
+        for node in pending:
+            for ch, child in self.goto[node].items():
+                pending.append(child)
+                state = self.fail[node]
+                while state and ch not in self.goto[state]:
+                    state = self.fail[state]
+                target = self.goto[state].get(ch, 0)
+                self.fail[child] = target if target != child else 0
+                self.dict_link[child] = target if self.output[target] is not None else self.dict_link[target]
+
+    def find_all(self, text: str) -> list:
+        """
+        Коды, целиком стоящие в text отдельным словом (соседние символы —
+        не буквы и не цифры), в порядке их окончания в тексте.
+        """
+        codes = []
+        goto, fail, output, dict_link = self.goto, self.fail, self.output, self.dict_link
+        node = 0
+        last = len(text) - 1
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            hit = node if output[node] is not None else dict_link[node]
+            while hit:
+                code = output[hit]
+                start = i - len(code) + 1
+                if (start == 0 or not text[start - 1].isalnum()) and (i == last or not text[i + 1].isalnum()):
+                    codes.append(code)
+                hit = dict_link[hit]
+        return codes
+
+class LEMatcher:
+    """
+    Сопоставитель строк со списком LE, собираемый один раз на набор LE
+    (см. compile_le_matcher). Проверяются все маркеры "LE" строки, а не
+    только первый: строка совпала, если аналитика после любого маркера есть
+    в наборе, и решение содержит все такие коды. Нормализованные значения ячеек кэшируются (аналитика в
+    выгрузке повторяется). search_text=True — если по маркерам совпадения
+    нет, коды LE ищутся внутри текста всех ячеек (LEAutomaton).
+    """
+
+    def __init__(self, le_set: set, search_text: bool = False):
+        self.le_set = frozenset(le_set)
+        self.search_text = search_text
+        self.automaton = LEAutomaton(self.le_set) if search_text and self.le_set else None
+        self._normalized = {}
+
+    def normalize(self, value) -> str:
+        normalized = self._normalized.get(value)
+        if normalized is None:
+            normalized = normalize_le(str(value)) if not is_empty_value(value) else ""
+            if len(self._normalized) >= LE_NORMALIZE_CACHE_SIZE:
+                self._normalized.clear()
+            self._normalized[value] = normalized
+        return normalized
+
+    def find_in_text(self, values: list) -> list:
+        """
+        Коды LE, найденные внутри текстовых ячеек строки, по порядку ячеек.
+        """
+        codes = []
+        for value in values:
+            if isinstance(value, str) and len(value) >= self.automaton.min_len:
+                codes += self.automaton.find_all(value.translate(LE_TEXT_TABLE).upper())
+        return codes
+
+    def classify(self, values: list, le_cols: tuple = None) -> tuple[str, str, object]:
+        """
+        (статус, описание_ошибки, аналитика) строки, как у find_le_match. При
+        нескольких маркерах: совпадение — кортеж всех аналитик из набора по
+        порядку маркеров (без повторов); иначе пропуск, если хоть одна
+        аналитика заполнена; иначе ошибка первого маркера. Коды в тексте ячеек
+        ищутся, только если по маркерам совпадения нет.
+        """
+        codes = []
+        skip_value = ""
+        error = None
+        for col_idx, value in enumerate(values):
+            if le_cols is not None and col_idx not in le_cols:
+                continue
+            if not (isinstance(value, str) and value.strip().upper() == "LE"):
+                continue
+            if col_idx + 1 >= len(values):
+                error = error or f"LE в колонке {col_idx}, но нет следующей колонки для аналитики"
+                continue
+            analytics = self.normalize(values[col_idx + 1])
+            if analytics in self.le_set:
+                if analytics not in codes:
+                    codes.append(analytics)
+            elif analytics:
+                skip_value = skip_value or analytics
             else:
-                break
-    except Exception as e:
-        logger.exception("Ошибка при удалении пустых строк: %s", e)
+                error = error or f"Пустая аналитика после LE в колонке {col_idx}"
+        if not codes and self.automaton is not None:
+            codes = list(dict.fromkeys(self.find_in_text(values)))
+        if codes:
+            return "match", "", tuple(codes)
+        if skip_value:
+            return "skip", "", skip_value
+        return "error", error or "В строке не найден LE", ""
 
-# ========== Основная логика обработки одного файла ==========
-def write_filtered_rows(file_path: str, le_set: set, skipped_wb: Workbook, errors_ws):
+    def classify_rows(self, rows_values: list, le_cols: tuple = None) -> list:
+        classify = self.classify
+        return [classify(values, le_cols) for values in rows_values]
+
+LE_MATCHER_CACHE = {}  # (id набора LE, search_text) -> (набор LE, LEMatcher)
+
+def compile_le_matcher(le_set: set, search_text: bool = False) -> LEMatcher:
     """
-    Читает xlsx файл (через pandas для логики), создаёт/редактирует выходной xlsx
-    (используя openpyxl), записывает отфильтрованные строки с сохранением стилей.
-    Возвращает (filtered_count, skipped_count, error_count).
+    LEMatcher для набора le_set; собирается один раз на объект набора
+    (набор хранится в кэше, так что его id не переиспользуется).
     """
-    file_name = Path(file_path).name
-    log_md(f"Начинаю обработку файла: **{file_name}**", "INFO")
+    key = (id(le_set), search_text)
+    cached = LE_MATCHER_CACHE.get(key)
+    if cached is not None and cached[0] is le_set:
+        return cached[1]
+    if len(LE_MATCHER_CACHE) >= 8:
+        LE_MATCHER_CACHE.clear()
+    matcher = LEMatcher(le_set, search_text)
+    LE_MATCHER_CACHE[key] = (le_set, matcher)
+    return matcher
 
-    # 1) Читаем файл в pandas (header=None, чтобы найти реальную строку заголовка программно)
-    try:
-        df = pd.read_excel(file_path, header=None)
-    except Exception as e:
-        logger.exception("Ошибка при чтении %s в pandas: %s", file_name, e)
-        errors_ws.append([file_name, "", f"Ошибка чтения файла: {e}"])
-        return 0, 0, 1
+def classify_rows(rows_values: list, le_set: set, matcher: str, le_cols: tuple = None,
+                  search_text: bool = False) -> list:
+    """
+    Классифицирует блок строк выбранным способом: "compiled" (все маркеры
+    строки и, при search_text, коды в тексте ячеек — см. LEMatcher), "vector"
+    или "loop" (только первый маркер; оба дают одинаковый результат — их
+    можно сравнивать на реальных файлах).
+    """
+    if matcher == "loop":
+        return [find_le_match(values, le_set, le_cols) for values in rows_values]
+    if matcher == "vector":
+        return classify_rows_vectorized(rows_values, le_set, le_cols)
+    return compile_le_matcher(le_set, search_text).classify_rows(rows_values, le_cols)
 
-    if df.empty:
-        logger.warning("Файл %s пустой.", file_name)
-        errors_ws.append([file_name, "", "Файл пустой"])
-        return 0, 0, 1
+def iter_batches(items, size: int):
+    """
+    Разбивает итератор на списки длиной не более size.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def convert_dates(raw_values: list) -> list:
+    """
+    Пакетно преобразует строковые значения колонки даты в datetime.
+    Сначала пробуются явные форматы DATE_FORMATS (день впереди: dd.mm.yyyy),
+    затем разбор pandas с dayfirst=True. Нестроковые значения и
+    нераспознанные строки возвращаются как есть.
+    """
+    result = list(raw_values)
+    positions = [i for i, v in enumerate(raw_values) if isinstance(v, str) and v.strip()]
+    if not positions:
+        return result
+    import pandas as pd
 
-    # 2) Находим первую непустую строку — считаем её заголовком
-    header_row = None
-    for idx in df.index:
-        if df.loc[idx].notna().any():
-            header_row = idx
+    text = pd.Series([raw_values[i].strip() for i in positions], dtype=object)
+    parsed = pd.Series(pd.NaT, index=text.index, dtype="datetime64[ns]")
+    for fmt in DATE_FORMATS:
+        todo = parsed.isna()
+        if not todo.any():
             break
-    if header_row is None:
-        logger.error("Не удалось найти заголовок в %s", file_name)
-        errors_ws.append([file_name, "", "Не найден заголовок"])
-        return 0, 0, 1
+        parsed[todo] = pd.to_datetime(text[todo], format=fmt, errors="coerce")
+    todo = parsed.isna()
+    if todo.any():
+        parsed[todo] = pd.to_datetime(text[todo], format="mixed", dayfirst=True, errors="coerce")
+    for pos, i in enumerate(positions):
+        if pd.notna(parsed.iat[pos]):
+            result[i] = parsed.iat[pos].to_pydatetime()
+    return result
 
-    # Устанавливаем имена столбцов и отбрасываем строки выше заголовка
-    df.columns = df.loc[header_row]
-    df = df.loc[header_row + 1 :].reset_index(drop=True)
+def apply_column_formats(cell, col_idx: int, layout: "ColumnLayout" = None):
+    """
+    Явно назначает number_format для важных колонок (сумма и дата) раскладки
+    layout (None — AMOUNT_COL_IDX и DATE_COL_IDX).
+    """
+    layout = layout or ColumnLayout()
+    if col_idx == layout.amount_col:
+        cell.number_format = AMOUNT_NUMBER_FORMAT
+    if col_idx == layout.date_col:
+        cell.number_format = DATE_NUMBER_FORMAT
 
-    # 3) Загружаем workbook через openpyxl — используем файл как шаблон (стили остаются)
-    try:
-        wb_out = load_workbook(file_path)
-    except Exception as e:
-        logger.exception("Ошибка load_workbook для %s: %s", file_name, e)
-        errors_ws.append([file_name, "", f"Ошибка открытия файла: {e}"])
-        return 0, 0, 1
+class StreamSheetWriter:
+    """
+    Выходной лист в write_only-книге: строки пишутся потоком, в памяти не копятся.
+    wb — общая write_only-книга (например, skipped), в которой создаётся лист;
+    без неё у листа своя книга. apply_formats=False — строки данных пишутся
+    без форматов колонок суммы и даты (как на листах skipped); колонки
+    суммы и даты — по раскладке layout.
+    """
 
-    ws_out = wb_out.active
+    def __init__(self, title: str, style_cache: dict = None, wb: Workbook = None, apply_formats: bool = True,
+                 layout: "ColumnLayout" = None):
+        self.wb = wb if wb is not None else Workbook(write_only=True)
+        self.ws = self.wb.create_sheet(title=title)
+        self.style_cache = style_cache
+        self.apply_formats = apply_formats
+        self.layout = layout
+        self.rows_written = 0
 
-    # Сохраняем индекс исходной строки заголовка в листе для копирования стиля заголовка
-    src_header_row_index = header_row + 1  # потому что pandas 0-based, excel 1-based
+    def _styled_row(self, src_cells, values, apply_formats: bool):
+        row = []
+        for col_idx, value in enumerate(values):
+            cell = WriteOnlyCell(self.ws, value=value)
+            src_cell = src_cells[col_idx] if col_idx < len(src_cells) else None
+            copy_cell_style(src_cell, cell, self.style_cache)
+            if apply_formats:
+                apply_column_formats(cell, col_idx, self.layout)
+            row.append(cell)
+        return row
 
-    # 4) Очищаем значения на листе, оставляя стили и структуру (формат ячеек не удаляется)
-    for row in ws_out.iter_rows(min_row=2):
-        for cell in row:
-            cell.value = None
+    def write_header(self, src_cells, values):
+        self.ws.append(self._styled_row(src_cells, values, apply_formats=False))
 
-    # 5) Устанавливаем заголовки в первой строке листа и копируем стиль из исходного заголовка
-    for col_idx in range(len(df.columns)):
-        hdr_cell = ws_out.cell(row=1, column=col_idx + 1)
-        # Устанавливаем значение заголовка.
-        try:
-            hdr_cell.value = df.columns[col_idx]
-        except Exception:
-            # Защита от merged cells или нестандартных заголовков
-            hdr_cell.value = str(df.columns[col_idx])
-        # Копируем стиль заголовочной ячейки из исходной позиции
-        orig_hdr_cell = ws_out.cell(row=src_header_row_index, column=col_idx + 1)
-        copy_cell_style(orig_hdr_cell, hdr_cell)
-
-    # Счётчики
-    filtered_count = 0
-    skipped_count = 0
-    error_count = 0
-    skipped_rows_indexes = []
-
-    # Логируем начало построчной обработки
-    log_list_item(f"Начинаю построчную обработку данных для {file_name}")
-
-    # 6) Проходим строки pandas DataFrame и решаем, записывать ли их в выходной файл
-    for row_idx, row in df.iterrows():
-        # Пропускаем полностью пустые строки
-        if row.isna().all():
-            continue
+    def write_row(self, src_cells, values):
+        self.ws.append(self._styled_row(src_cells, values, apply_formats=self.apply_formats))
+        self.rows_written += 1
 
-        match_found = False
-        is_error = False
-
-        error_desc = "В строке не найден LE"
-        has_LE_colmn = False
-
-        # Ищем значение "LE" в строке (регистр игнорируем)
-        for col_idx, (col_name, value) in enumerate(row.items()):
-            cell_value = str(value).strip().upper() if pd.notna(value) else ""
-            if cell_value == "LE":
-                has_LE_colmn = True
-
-                # Берём следующую колонку как "Аналитику"
-                if col_idx + 1 < len(row):
-                    analytics_raw = row.iloc[col_idx + 1]
-                    analytics_value = (
-                        str(analytics_raw).strip().replace("-", "").replace(" ", "").upper()
-                        if pd.notna(analytics_raw)
-                        else ""
-                    )
-                    if analytics_value and analytics_value in le_set:
-                        match_found = True
-                        break
-                    elif analytics_value:
-                        # Не совпало с LE.txt — это нормальная причина пропуска
-                        is_error = False
-                    else:
-                        is_error = True
-                        error_desc = f"Пустая аналитика после LE в колонке {col_idx}"
-                else:
-                    is_error = True
-                    error_desc = f"LE в колонке {col_idx}, но нет следующей колонки для аналитики"
-                break
-
-        # Если найдено совпадение — записываем строку в выходной лист
-        if match_found:
-            # Обрабатываем сумму: колонка индекс 7 ожидается числом
-            amount_raw = row.iloc[7] if 7 < len(row) else None
-            parsed_amount, amt_err = parse_and_convert_amount(amount_raw)
-            if amt_err:
-                # Записываем в errors_ws и помечаем как ошибка
-                row_number = row_idx + src_header_row_index + 1  # для лога: реальный номер в исходном файле
-                errors_ws.append([file_name, str(row_number), amt_err])
-                logger.warning("Ошибка суммы в %s строка %s: %s", file_name, row_number, amt_err)
-                is_error = True
-                error_count += 1
-                skipped_rows_indexes.append(row_idx)
-                skipped_count += 1
-                continue
+    def save(self, path: str):
+        self.wb.save(path)
+
+def output_file_name(file_name: str, fmt: str) -> str:
+    """
+    Имя выходного файла в формате fmt: для xlsx — исходное, иначе с расширением формата.
+    """
+    if fmt == "xlsx":
+        return file_name
+    return f"{Path(file_name).stem}.{fmt}"
+
+def sheet_output_name(file_name: str, sheet: str, fmt: str) -> str:
+    """
+    Имя выходного файла листа: для книги с одним листом (sheet None) — как
+    у файла (см. output_file_name), иначе <имя>_<лист>.<расширение>.
+    """
+    name = output_file_name(file_name, fmt)
+    if sheet is None:
+        return name
+    return f"{Path(name).stem}_{group_dir_name(sheet)}{Path(name).suffix}"
+
+def sheet_label(file_name: str, sheet: str) -> str:
+    """
+    Имя файла для логов, errors и итогов; у листа многолистовой книги — с именем листа.
+    """
+    return file_name if sheet is None else f"{file_name} [{sheet}]"
+
+def skipped_sheet_title(file_name: str, sheet: str) -> str:
+    """
+    Имя листа skipped.xlsx (Excel допускает не больше 31 символа).
+    """
+    if sheet is None:
+        return file_name[:25]
+    return f"{Path(file_name).stem[:15]}_{sheet}"[:31]
+
+def text_value(value):
+    """
+    Значение для текстовых форматов: дата без времени — YYYY-MM-DD,
+    дата со временем — ISO с пробелом, прочее без изменений.
+    """
+    if isinstance(value, datetime):
+        if (value.hour, value.minute, value.second, value.microsecond) == (0, 0, 0, 0):
+            return value.date().isoformat()
+        return value.isoformat(sep=" ")
+    return value
+
+class TableWriter:
+    """
+    Выход без стилей: csv, parquet или jsonl. Стили исходных ячеек не копируются,
+    значения пишутся пачками по flush_rows (TABLE_FLUSH_ROWS) строк во временный
+    файл в tmp_dir (по умолчанию OUT_DIR): csv и jsonl — сразу в своём формате,
+    parquet — pickle-блоками, которые при save() переписываются группами строк
+    parquet (типы колонок известны только после всех строк). save() переносит
+    результат в целевой путь. typed=True — строки данных с преобразованными
+    суммой и датой (колонки раскладки layout): в parquet эти колонки получают
+    типы float64 и timestamp, остальные колонки пишутся строками.
+    """
+
+    def __init__(self, fmt: str, typed: bool = True, tmp_dir: str = None, layout: "ColumnLayout" = None,
+                 flush_rows: int = None):
+        self.fmt = fmt
+        self.typed = typed
+        self.layout = layout or ColumnLayout()
+        self.tmp_dir = tmp_dir or OUT_DIR
+        self.flush_rows = flush_rows or TABLE_FLUSH_ROWS
+        self.columns = []
+        self.buffer = []
+        self.rows_written = 0
+        self.tmp_path = None
+        self.stream = None
+        self.csv_writer = None
+        # parquet: ширина и типизируемость колонок суммы и даты по всем записанным блокам
+        self.width = 0
+        self.amount_numeric = True
+        self.date_timestamp = True
+
+    def write_header(self, src_cells, values):
+        # Имена колонок: пустые — colN, повторяющиеся — с суффиксом _2, _3...
+        seen = {}
+        for col_idx, value in enumerate(values):
+            name = f"col{col_idx + 1}" if is_empty_value(value) else str(value).strip()
+            seen[name] = seen.get(name, 0) + 1
+            self.columns.append(name if seen[name] == 1 else f"{name}_{seen[name]}")
+        self.width = len(self.columns)
+        if self.fmt == "csv":
+            self._open()
+            self.csv_writer.writerow(self.columns)
+
+    def write_row(self, src_cells, values):
+        self.buffer.append(values)
+        self.rows_written += 1
+        if len(self.buffer) >= self.flush_rows:
+            self._flush()
+
+    def _open(self):
+        if self.stream is None:
+            os.makedirs(self.tmp_dir, exist_ok=True)
+            fd, self.tmp_path = tempfile.mkstemp(prefix=".part_", suffix=f".{self.fmt}", dir=self.tmp_dir)
+            if self.fmt == "parquet":
+                self.stream = open(fd, "wb")
             else:
-                # Заменяем значение в pandas-строке на float для корректной записи
-                row.iloc[7] = parsed_amount
-
-            # Записываем значения и копируем стили по одной ячейке
-            for col_idx in range(len(row)):
-                out_cell = ws_out.cell(row=filtered_count + 2, column=col_idx + 1)  # +2: 1 заголовок
-                out_cell.value = row.iloc[col_idx]
-
-                # Берём "оригинальную" ячейку из исходного листа (до очистки значений
-                # стили всё ещё там). Индекс в исходном листе = header_row + 2 + row_idx
-                orig_row_number = src_header_row_index + 1 + row_idx
-                orig_cell = ws_out.cell(row=orig_row_number, column=col_idx + 1)
-                copy_cell_style(orig_cell, out_cell)
-
-                # Явно назначаем number_format для важных колонок
-                if col_idx == 7:
-                    out_cell.number_format = "#,##0.00"
-                if col_idx == 3:
-                    out_cell.number_format = "dd.mm.yyyy"
-                    # Попытка преобразовать строку в datetime, если исход был строкой
-                    if isinstance(row.iloc[col_idx], str):
-                        try:
-                            out_cell.value = pd.to_datetime(row.iloc[col_idx])
-                        except Exception:
-                            # Оставляем как есть и логируем предупреждение
-                            logger.debug("Не удалось преобразовать дату '%s' в datetime (файл %s, строка %s)",
-                                         row.iloc[col_idx], file_name, filtered_count + src_header_row_index + 1)
-
-            filtered_count += 1
+                self.stream = open(fd, "w", encoding="utf-8", newline="")
+            if self.fmt == "csv":
+                self.csv_writer = csv.writer(self.stream, delimiter=CSV_DELIMITER)
+
+    def _column_name(self, col_idx: int) -> str:
+        return self.columns[col_idx] if col_idx < len(self.columns) else f"col{col_idx + 1}"
 
+    def _flush(self):
+        if not self.buffer:
+            return
+        self._open()
+        if self.fmt == "parquet":
+            amount_col, date_col = self.layout.amount_col, self.layout.date_col
+            for row in self.buffer:
+                self.width = max(self.width, len(row))
+                if self.typed and amount_col < len(row) and not (row[amount_col] is None or isinstance(row[amount_col], (int, float))):
+                    self.amount_numeric = False
+                # Непреобразованная дата (текст) оставляет колонку строковой, как ячейку в xlsx
+                if self.typed and date_col < len(row) and not (row[date_col] is None or isinstance(row[date_col], datetime)):
+                    self.date_timestamp = False
+            pickle.dump(self.buffer, self.stream, protocol=pickle.HIGHEST_PROTOCOL)
+        elif self.fmt == "csv":
+            self.csv_writer.writerows([[text_value(v) for v in row] for row in self.buffer])
         else:
-            # Пропускаем строку — добавляем в skipped список
-            skipped_rows_indexes.append(row_idx)
-            skipped_count += 1
-            if is_error or has_LE_colmn == False:
-                # Если это была ошибка, записываем её
-                row_number = row_idx + src_header_row_index + 1
-                errors_ws.append([file_name, str(row_number), error_desc])
-                error_count += 1
-                logger.warning("Строка %s пропущена с ошибкой: %s", row_idx + src_header_row_index + 1, error_desc)
-
-    # 7) Записываем skipped лист если есть пропущенные строки
-    if skipped_rows_indexes:
-        log_list_item(f"Создаю лист skipped для {file_name}, строк: {len(skipped_rows_indexes)}")
-        # Создаём отдельный лист
-        skipped_ws = skipped_wb.create_sheet(title=file_name[:25])
-        # Копируем заголовок и его стиль из выходного листа (который содержит стиль заголовка)
-        for col in range(len(df.columns)):
-            cell = skipped_ws.cell(row=1, column=col + 1)
-            cell.value = df.columns[col]
-            # Копируем стиль из ws_out.header (ячейка 1, col+1)
-            copy_cell_style(ws_out.cell(row=1, column=col + 1), cell)
-
-        # Заполняем пропущенные строки значениями и копируем стили из исходного листа
-        for i, src_row_idx in enumerate(skipped_rows_indexes):
-            row_values = df.iloc[src_row_idx]
-            for col_idx in range(len(row_values)):
-                val = row_values.iloc[col_idx]
-                dest_cell = skipped_ws.cell(row=i + 2, column=col_idx + 1, value=val)
-                orig_row_number = src_header_row_index + 1 + src_row_idx
-                copy_cell_style(ws_out.cell(row=orig_row_number, column=col_idx + 1), dest_cell)
-
-    # 8) Удаляем пустые строки в конце выходного листа перед сохранением
-    remove_trailing_blank_rows(ws_out)
-
-    # 9) Сохраняем выходной файл (только если есть отфильтрованные строки)
-    if filtered_count > 0:
-        out_file_path = os.path.join(OUT_DIR, file_name)
-        try:
-            wb_out.save(out_file_path)
-            log_list_item(f"Файл сохранён: {out_file_path} (строк: {filtered_count})")
-        except Exception as e:
-            logger.exception("Ошибка при сохранении %s: %s", out_file_path, e)
-            errors_ws.append([file_name, "", f"Ошибка сохранения: {e}"])
-            return filtered_count, skipped_count, error_count + 1
-    else:
-        log_list_item(f"В файле {file_name} нет строк для записи. Выходной файл не создан.")
+            self.stream.write("".join(
+                json.dumps({self._column_name(i): text_value(v) for i, v in enumerate(row)},
+                           ensure_ascii=False, default=str) + "\n"
+                for row in self.buffer))
+        self.buffer = []
 
-    # 10) Итоги для файла
-    log_md(f"Итог **{file_name}** — Отфильтровано: **{filtered_count}**, Пропущено: **{skipped_count}**, Ошибок: **{error_count}**", "INFO")
-    log_md("", "INFO")  # Пустая строка для разделения абзацев
+    def _parquet_table(self, rows: list):
+        import pyarrow as pa
 
-    return filtered_count, skipped_count, error_count
+        arrays = []
+        for col_idx in range(self.width):
+            column = [row[col_idx] if col_idx < len(row) else None for row in rows]
+            if self.typed and col_idx == self.layout.amount_col and self.amount_numeric:
+                array = pa.array(column, type=pa.float64())
+            elif self.typed and col_idx == self.layout.date_col and self.date_timestamp:
+                array = pa.array(column, type=pa.timestamp("us"))
+            else:
+                array = pa.array([None if v is None else str(text_value(v)) for v in column], type=pa.string())
+            arrays.append(array)
+        return pa.table(arrays, names=[self._column_name(i) for i in range(self.width)])
 
-# ========== Точка входа ==========
-def main():
-    # Логирование старта
-    log_header("Старт обработки в папке in/", 2)
-    le_set = load_le_set(LE_FILE)
-    if not le_set:
-        log_md("**Ошибка:** LE список пуст — завершаю.", "ERROR")
-        return
+    def _save_parquet(self, path: str):
+        import pyarrow.parquet as pq
 
-    in_files = glob.glob("in/*.xlsx")
-    if not in_files:
-        log_md("**Ошибка:** Нет файлов в папке `in/`. Завершаю.", "ERROR")
-        return
+        # Блоки читаются по одному: в памяти не больше flush_rows строк
+        empty = self._parquet_table([])
+        with pq.ParquetWriter(path, empty.schema) as writer:
+            if self.stream is None:
+                writer.write_table(empty)
+                return
+            self.stream.close()
+            with open(self.tmp_path, "rb") as fh:
+                while True:
+                    try:
+                        rows = pickle.load(fh)
+                    except EOFError:
+                        break
+                    writer.write_table(self._parquet_table(rows))
+        os.remove(self.tmp_path)
 
-    log_header("Найденные файлы для обработки", 2)
-    log_list_item(f"Найдено **{len(in_files)}** файлов в папке `in/`")
-    if in_files:
-        log_table(["Файл"], [[Path(fp).name] for fp in in_files])
-        log_md("", "INFO")  # Пустая строка для разделения абзацев
+    def save(self, path: str):
+        self._flush()
+        if self.fmt == "parquet":
+            self._save_parquet(path)
+            return
+        self._open()  # выход без строк данных тоже даёт файл (с заголовком)
+        self.stream.close()
+        os.replace(self.tmp_path, path)
+
+class ErrorsSheet:
+    """
+    Лист errors.xlsx в write_only-книге: строки ошибок пишутся на диск по мере
+    поступления (книга создаётся при первой ошибке). Как и список строк
+    ошибок в рабочих процессах, поддерживает append().
+    fmt — формат вывода; для csv/parquet/jsonl строки пишет TableWriter
+    (временный файл — в tmp_dir, по умолчанию OUT_DIR).
+    """
 
-    # Подготовка skipped.xlsx и errors.xlsx
-    skipped_wb = Workbook()
-    # удалим стандартный лист (в openpyxl он создаётся по умолчанию)
-    if skipped_wb.active:
-        skipped_wb.remove(skipped_wb.active)
+    def __init__(self, fmt: str = "xlsx", tmp_dir: str = None):
+        self.fmt = fmt
+        self.tmp_dir = tmp_dir
+        self.wb = None
+        self.ws = None
+        self.table = None
+        self.rows_written = 0
 
-    errors_wb = Workbook()
-    errors_ws = errors_wb.active
-    errors_ws.append(["Файл", "Строка", "Описание ошибки"])
+    def append(self, row):
+        if self.fmt != "xlsx":
+            if self.table is None:
+                self.table = TableWriter(self.fmt, typed=False, tmp_dir=self.tmp_dir)
+                self.table.write_header(None, ERRORS_HEADER)
+            self.table.write_row(None, row)
+        else:
+            if self.ws is None:
+                self.wb = Workbook(write_only=True)
+                self.ws = self.wb.create_sheet(title="Sheet")
+                self.ws.append(ERRORS_HEADER)
+            self.ws.append(row)
+        self.rows_written += 1
 
-    total_filtered = 0
-    total_skipped = 0
-    total_errors = 0
+    def save(self, path: str):
+        if self.table is not None:
+            self.table.save(path)
+        elif self.wb is not None:
+            self.wb.save(path)
 
-    # Обработка каждого файла
-    for fp in in_files:
-        log_header(f"Обработка файла: {Path(fp).name}", 2)
-        f, s, e = write_filtered_rows(fp, le_set, skipped_wb, errors_ws)
-        total_filtered += f
-        total_skipped += s
-        total_errors += e
-        log_file_separator()  # Добавляем разделитель между файлами
-
-    # Сохраняем skipped.xlsx если есть листы
-    if skipped_wb.sheetnames:
-        try:
-            skipped_out_path = os.path.join(OUT_DIR, SKIPPED_FILE)
-            skipped_wb.save(skipped_out_path)
-            logger.info("Сохранён файл с пропущенными строками: %s", skipped_out_path)
-        except Exception as e:
-            logger.exception("Ошибка при сохранении skipped.xlsx: %s", e)
+class TemplateSheetWriter:
+    """
+    Пишет отфильтрованные строки прямо в исходный лист (книга загружена целиком
+    и служит шаблоном). Строка с номером N пишется в строку <= N, поэтому
+    исходные значения и стили строки читаются до того, как она будет перезаписана.
+    """
+
+    def __init__(self, wb, ws, style_cache: dict = None, layout: "ColumnLayout" = None):
+        self.wb = wb
+        self.ws = ws
+        self.style_cache = style_cache
+        self.layout = layout
+        self.rows_written = 0
+
+    def _write(self, out_row: int, src_cells, values, apply_formats: bool):
+        for col_idx, value in enumerate(values):
+            src_cell = src_cells[col_idx] if col_idx < len(src_cells) else None
+            out_cell = self.ws.cell(row=out_row, column=col_idx + 1)
+            if src_cell is not out_cell:
+                copy_cell_style(src_cell, out_cell, self.style_cache)
+            out_cell.value = value
+            if apply_formats:
+                apply_column_formats(out_cell, col_idx, self.layout)
+
+    def write_header(self, src_cells, values):
+        self._write(1, src_cells, values, apply_formats=False)
+
+    def write_row(self, src_cells, values):
+        self._write(self.rows_written + 2, src_cells, values, apply_formats=True)  # +2: 1 заголовок
+        self.rows_written += 1
 
-    # Сохраняем errors.xlsx если были ошибки
-    if total_errors > 0:
+    def save(self, path: str):
+        # Последняя строка известна (заголовок + rows_written): хвост исходного листа отрезаем целиком
+        truncate_rows(self.ws, self.rows_written + 1)
+        self.wb.save(path)
+
+class ConsolidatedOutput:
+    """
+    Сводный выход (--consolidate): отобранные строки всех входных файлов
+    пишутся потоком в write_only-книги по мере обработки, а не в выход по
+    каждому файлу. mode "all" — одна книга <out_dir>/CONSOLIDATED_FILE, "le"
+    — книга на код LE (аналитика, найденная при сопоставлении) в
+    <out_dir>/CONSOLIDATED_LE_DIR/<код>.xlsx; строка с несколькими
+    совпавшими кодами пишется в книгу каждого из них. Строки файлов с
+    одинаковым заголовком идут на один лист книги (шарда), с другим — на
+    отдельный лист; последняя колонка (CONSOLIDATED_SOURCE_HEADER) — файл
+    (и лист), из которого взята строка. Когда на листе набирается max_rows
+    строк вместе с заголовком (предел Excel), книга сохраняется, и шард
+    продолжается в следующем файле: <имя>_2.xlsx и т.д. Перед строками
+    каждого файла вызывается begin_source.
+    Открытыми держится не больше max_open шардов: строки остальных кодов
+    копятся во временных файлах (значения и индексы стилей, как в кэше
+    разбора) и пишутся в книги по одной при save().
+    """
+
+    def __init__(self, mode: str, out_dir: str, max_rows: int = EXCEL_MAX_ROWS,
+                 max_open: int = CONSOLIDATED_MAX_OPEN):
+        self.mode = mode
+        self.out_dir = out_dir
+        self.max_rows = max_rows
+        self.max_open = max_open
+        self.shards = {}  # None (режим "all") или код LE -> {"part", "wb", "sheets": {заголовок: лист}, "rows"}
+        self.saved = []  # (путь, строк данных) сохранённых файлов, по порядку сохранения
+        self.rows_written = 0
+        self.header_cells = None
+        self.header_key = None
+        self.layout = None
+        self.style_cache = None
+        self.label = None
+        # Отложенные строки кодов без открытого шарда
+        self.spill_dir = None
+        self.spill_files = {}  # код LE -> файл с pickle-пачками [(номер источника, значения, индексы стилей)]
+        self.spill_batches = {}  # код LE -> ещё не сброшенная пачка
+        self.spill_rows = 0
+        self.spill_sources = []  # (заголовок, индексы стилей заголовка, раскладка, имя файла) по номеру источника
+        self.spill_source = None  # номер текущего источника в spill_sources (None — его строки не откладывались)
+        self.spill_styles = {}  # индекс стиля отложенных строк -> (font, border, fill, number_format, ...)
+        self.spill_style_ids = {}  # (номер источника, ключ стиля ячейки) -> индекс стиля отложенных строк
+
+    def begin_source(self, header_cells, header_values, layout: "ColumnLayout", style_cache: dict, label: str):
+        """
+        Источник следующих строк: заголовок, раскладка колонок, кэш стилей и имя файла (с листом).
+        """
+        self.header_cells = header_cells
+        self.header_key = tuple(header_values)
+        self.layout = layout
+        self.style_cache = style_cache
+        self.label = label
+        self.spill_source = None
+
+    def _path(self, key: str, part: int) -> str:
+        if key is None:
+            folder, stem = self.out_dir, Path(CONSOLIDATED_FILE).stem
+        else:
+            folder, stem = os.path.join(self.out_dir, CONSOLIDATED_LE_DIR), group_dir_name(key)
+        return os.path.join(folder, f"{stem}.xlsx" if part == 1 else f"{stem}_{part}.xlsx")
+
+    def _open_sheet(self, shard: dict, key: str) -> StreamSheetWriter:
+        title = CONSOLIDATED_SHEET if key is None else re.sub(r"[\\/:*?\[\]]", "_", key)[:25]
+        if shard["sheets"]:
+            title = f"{title} ({len(shard['sheets']) + 1})"
+        sheet = StreamSheetWriter(title, self.style_cache, shard["wb"], layout=self.layout)
+        cells = list(self.header_cells)[:len(self.header_key)]
+        cells.append(cells[-1] if cells else None)  # заголовок колонки источника — в стиле соседнего
+        sheet.write_header(cells, list(self.header_key) + [CONSOLIDATED_SOURCE_HEADER])
+        shard["sheets"][self.header_key] = sheet
+        return sheet
+
+    def _save(self, key: str, shard: dict):
+        path = self._path(key, shard["part"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shard["wb"].save(path)
+        self.saved.append((path, shard["rows"]))
+
+    def write_row(self, codes: tuple, src_cells, values):
+        """
+        Пишет строку с совпавшими кодами LE codes (см. LEMatcher.classify).
+        """
+        for key in (codes if self.mode == "le" else (None,)):
+            if key in self.shards or len(self.shards) < self.max_open:
+                self._write_row(key, src_cells, values)
+            else:
+                self._spill_row(key, src_cells, values)
+
+    def _write_row(self, key: str, src_cells, values):
+        shard = self.shards.get(key)
+        if shard is None:
+            shard = self.shards[key] = {"part": 1, "wb": Workbook(write_only=True), "sheets": {}, "rows": 0}
+        sheet = shard["sheets"].get(self.header_key)
+        if sheet is not None and sheet.rows_written + 1 >= self.max_rows:
+            # Лист дошёл до предела Excel — шард продолжается в следующем файле
+            self._save(key, shard)
+            # Ключ кэша стилей — id книги назначения: id сохранённой книги может достаться новой
+            self.style_cache.clear()
+            shard = self.shards[key] = {"part": shard["part"] + 1, "wb": Workbook(write_only=True), "sheets": {},
+                                        "rows": 0}
+            sheet = None
+        if sheet is None:
+            sheet = self._open_sheet(shard, key)
+        sheet.style_cache = self.style_cache
+        sheet.layout = self.layout
+        sheet.write_row(src_cells, list(values) + [self.label])
+        shard["rows"] += 1
+        self.rows_written += 1
+
+    def _spill_style_ids(self, cells) -> tuple:
+        ids = []
+        for cell in cells:
+            style_id = 0
+            if cell is not None and getattr(cell, "has_style", False):
+                key = (self.spill_source, style_key(cell))
+                style_id = self.spill_style_ids.get(key)
+                if style_id is None:
+                    style_id = self.spill_style_ids[key] = len(self.spill_styles) + 1
+                    self.spill_styles[style_id] = (cell.font, cell.border, cell.fill, cell.number_format,
+                                                   cell.protection, cell.alignment)
+            ids.append(style_id)
+        return tuple(ids)
+
+    def _spill_row(self, key: str, src_cells, values):
+        if self.spill_source is None:
+            # Первая отложенная строка источника: запоминаем его заголовок и раскладку
+            self.spill_source = len(self.spill_sources)
+            self.spill_sources.append((self.header_key, self._spill_style_ids(self.header_cells), self.layout,
+                                       self.label))
+        self.spill_batches.setdefault(key, []).append(
+            (self.spill_source, tuple(values), self._spill_style_ids(src_cells[:len(values)])))
+        self.spill_rows += 1
+        if self.spill_rows >= MATCH_BATCH_ROWS:
+            self._flush_spill()
+
+    def _flush_spill(self):
+        if self.spill_dir is None:
+            os.makedirs(self.out_dir, exist_ok=True)
+            self.spill_dir = tempfile.mkdtemp(prefix=".consolidated-", dir=self.out_dir)
+        for key, batch in self.spill_batches.items():
+            path = self.spill_files.get(key)
+            if path is None:
+                path = self.spill_files[key] = os.path.join(self.spill_dir, f"{len(self.spill_files)}.pkl")
+            # Файл открывается на время записи пачки — число открытых файлов не растёт с числом кодов
+            with open(path, "ab") as fh:
+                pickle.dump(batch, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        self.spill_batches = {}
+        self.spill_rows = 0
+
+    def _write_spilled(self, key: str):
+        """
+        Пишет отложенные строки кода key в его книги (открыта одна книга за раз).
+        """
+        styles = self.spill_styles
+        self.style_cache = {}
+        current = None
+        with open(self.spill_files[key], "rb") as fh:
+            while True:
+                try:
+                    batch = pickle.load(fh)
+                except EOFError:
+                    break
+                for source, values, style_ids in batch:
+                    if source != current:
+                        current = source
+                        self.header_key, header_styles, self.layout, self.label = self.spill_sources[source]
+                        self.header_cells = tuple(CachedCell(v, sid, styles)
+                                                  for v, sid in zip(self.header_key, header_styles))
+                    cells = tuple(CachedCell(v, sid, styles) for v, sid in zip(values, style_ids))
+                    self._write_row(key, cells, list(values))
+        self._save(key, self.shards.pop(key))
+
+    def save(self) -> list:
+        """
+        Сохраняет открытые книги шардов и пишет отложенные строки; возвращает
+        [(путь, строк данных)] всех файлов сводного выхода.
+        """
+        for key in sorted(self.shards, key=lambda key: key or ""):
+            self._save(key, self.shards[key])
+        self.shards = {}
+        if self.spill_batches:
+            self._flush_spill()
         try:
-            errors_out_path = os.path.join(OUT_DIR, ERRORS_FILE)
-            errors_wb.save(errors_out_path)
-            logger.info("Сохранён файл ошибок: %s", errors_out_path)
-        except Exception as e:
-            logger.exception("Ошибка при сохранении errors.xlsx: %s", e)
-    else:
-        logger.info("Ошибок не обнаружено. Файл %s не создан.", ERRORS_FILE)
+            for key in sorted(self.spill_files):
+                self._write_spilled(key)
+        finally:
+            if self.spill_dir is not None:
+                shutil.rmtree(self.spill_dir, ignore_errors=True)
+        return self.saved
 
-    # Финальный лог и вывод в консоль статистики
-    log_header("Обработка завершена", 2)
-    log_table(["Показатель", "Количество"],
-                [["Отфильтровано", total_filtered],
-                 ["Пропущено", total_skipped],
-                 ["Ошибок", total_errors]])
-    log_md("", "INFO")  # Пустая строка для разделения абзацев
-    log_md("---", "INFO")  # Разделитель
+# ========== Раскладка колонок ==========
+@dataclass(frozen=True)
+class ColumnLayout:
+    """
+    Колонки ролей листа (индексы с 0): сумма, дата и колонки маркера "LE"
+    (None — маркер ищется во всей строке, аналитика — в следующей колонке).
+    """
+    amount_col: int = AMOUNT_COL_IDX
+    date_col: int = DATE_COL_IDX
+    le_cols: tuple = None
 
-    # Итоговая статистика в консоли
-    log_total_stats(total_filtered, total_skipped, total_errors)
+    def decision_cols(self, search_text: bool = False) -> frozenset | None:
+        """
+        Колонки, по которым решается судьба строки: маркеры LE, аналитика за
+        ними, сумма и дата. None — нужны все колонки (маркер ищется во всей
+        строке или коды LE — в тексте ячеек).
+        """
+        if self.le_cols is None or search_text:
+            return None
+        return frozenset(self.le_cols) | {c + 1 for c in self.le_cols} | {self.amount_col, self.date_col}
+
+    def describe(self) -> str:
+        le = ", ".join(get_column_letter(c + 1) for c in self.le_cols) if self.le_cols else "любая колонка"
+        return (f"дата — {get_column_letter(self.date_col + 1)}, сумма — {get_column_letter(self.amount_col + 1)}, "
+                f"маркер LE — {le}")
+
+LAYOUT_CACHE = {}  # (ключ настроек, сигнатура заголовка) -> ColumnLayout
+
+def normalize_header(value) -> str:
+    """
+    Имя колонки для сравнения: нижний регистр, "ё" как "е", пробелы схлопнуты.
+    """
+    if is_empty_value(value):
+        return ""
+    return " ".join(str(value).lower().replace("ё", "е").split())
+
+def load_layout_config(path: str = None) -> dict:
+    """
+    Настройки поиска заголовка и колонок ролей: COLUMN_ROLE_NAMES и
+    LAYOUT_SNIFF_ROWS, переопределённые JSON-файлом path (если задан), например
+    {"header_rows": 30, "amount": ["Сумма в руб."], "date": 3, "le_marker": ["Тип"]}.
+    Роль задаётся списком имён колонок (по приоритету) или индексом колонки (с 0).
+    Возвращает {"header_rows", "roles": {роль: кортеж имён или индекс}, "key"};
+    key — короткий хэш настроек (для кэшей и манифеста). При ошибке в файле — ValueError.
+    """
+    roles = dict(COLUMN_ROLE_NAMES)
+    header_rows = LAYOUT_SNIFF_ROWS
+    if path:
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                overrides = json.load(fh)
+        except (OSError, json.JSONDecodeError) as e:
+            raise ValueError(f"не удалось прочитать {path}: {e}")
+        if not isinstance(overrides, dict):
+            raise ValueError(f"{path}: ожидается JSON-объект")
+        for role, value in overrides.items():
+            if role == "header_rows":
+                if not isinstance(value, int) or value < 1:
+                    raise ValueError(f"{path}: header_rows должно быть целым числом больше 0")
+                header_rows = value
+            elif role not in roles:
+                raise ValueError(f"{path}: неизвестная роль '{role}' (ожидаются {', '.join(roles)}, header_rows)")
+            elif isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+                roles[role] = value
+            elif isinstance(value, list) and all(isinstance(name, str) for name in value):
+                roles[role] = tuple(normalize_header(name) for name in value)
+            else:
+                raise ValueError(f"{path}: роль '{role}' — список имён колонок или индекс колонки")
+    config = {"header_rows": header_rows, "roles": roles}
+    config["key"] = hashlib.sha256(json.dumps(config, ensure_ascii=False, sort_keys=True)
+                                   .encode("utf-8")).hexdigest()[:12]
+    return config
+
+def header_score(values: list, config: dict) -> int:
+    """
+    Число ролей, имена которых встречаются среди значений строки.
+    """
+    names = {normalize_header(v) for v in values}
+    return sum(1 for role_names in config["roles"].values()
+               if isinstance(role_names, tuple) and names.intersection(role_names))
+
+def find_header_index(rows_values: list, config: dict) -> int | None:
+    """
+    Индекс строки заголовка среди первых строк листа: непустая строка,
+    в которой узнаётся больше всего ролей по именам колонок (при равенстве —
+    верхняя); если ни одна роль не узнана — первая непустая строка.
+    None — все строки пустые.
+    """
+    best, best_score = None, 0
+    for index, values in enumerate(rows_values):
+        if all(is_empty_value(v) for v in values):
+            continue
+        if best is None:
+            best = index
+        score = header_score(values, config)
+        if score > best_score:
+            best, best_score = index, score
+    return best
+
+def detect_layout(header_values: list, config: dict) -> tuple:
+    """
+    Раскладка колонок по заголовку: роль, заданная индексом, берётся как есть,
+    заданная именами — первая колонка с первым найденным именем; не найденные
+    сумма и дата — AMOUNT_COL_IDX и DATE_COL_IDX, маркер LE — любая колонка.
+    Раскладка кэшируется по сигнатуре заголовка, так что файлы с тем же
+    заголовком имена не разбирают. Возвращает (ColumnLayout, взята_из_кэша).
+    """
+    signature = (config["key"], tuple(normalize_header(v) for v in header_values))
+    layout = LAYOUT_CACHE.get(signature)
+    if layout is not None:
+        return layout, True
+
+    names = list(signature[1])
+    found = {}
+    for role, role_names in config["roles"].items():
+        if isinstance(role_names, int):
+            found[role] = [role_names]
+        else:
+            found[role] = next(([i for i, name in enumerate(names) if name == role_name]
+                                for role_name in role_names if role_name in names), [])
+    layout = ColumnLayout(
+        amount_col=found["amount"][0] if found["amount"] else AMOUNT_COL_IDX,
+        date_col=found["date"][0] if found["date"] else DATE_COL_IDX,
+        le_cols=tuple(found["le_marker"]) or None,
+    )
+    LAYOUT_CACHE[signature] = layout
+    return layout, False
+
+# ========== Источники строк: книга xlsx или кэш разбора ==========
+class SheetRowSource:
+    """
+    Общая часть источников строк листа xlsx: заголовок находится при открытии
+    по первым строкам листа (см. find_header_index и layout_config); непустые
+    строки над ним (шапка отчёта) пропускаются, их число — в preamble_rows.
+    Если передан recorder (ParsedSheetRecorder), прочитанные строки
+    одновременно сохраняются в кэш разбора. Подкласс задаёт title и ncols
+    (ширина по <dimension> листа) и вызывает _find_header с итератором
+    (номер_строки_excel, ячейки), где пропущенные в XML строки — пустые кортежи.
+    """
+
+    recorder = None
+
+    def _find_header(self, rows, layout_config: dict):
+        # Заголовок ищем среди первых строк листа; прочитанные строки под ним
+        # вернутся в data_rows. Если они все пустые — первая непустая строка ниже
+        prefix = list(itertools.islice(rows, layout_config["header_rows"]))
+        header_index = find_header_index(
+            [[cell.value if cell is not None else None for cell in cells] for _, cells in prefix], layout_config)
+        if header_index is None:
+            prefix = []
+            for row_number, cells in rows:
+                if any(cell is not None and not is_empty_value(cell.value) for cell in cells):
+                    prefix, header_index = [(row_number, cells)], 0
+                    break
+        self.header_row = None
+        self.header_cells = None
+        self.preamble_rows = 0
+        if header_index is not None:
+            self.header_row, self.header_cells = prefix[header_index]
+            self.preamble_rows = sum(
+                1 for _, cells in prefix[:header_index]
+                if any(cell is not None and not is_empty_value(cell.value) for cell in cells))
+        self._rows = itertools.chain(prefix[header_index + 1:] if header_index is not None else [], rows)
+        if self.header_cells is not None:
+            self.ncols = max(self.ncols, len(self.header_cells))
+            self.header_values = [cell.value if cell is not None else None for cell in self.header_cells]
+
+    def data_rows(self):
+        """
+        Отдаёт непустые строки ниже заголовка как (номер_строки_excel, ячейки, значения);
+        строки дополняются до ncols колонок.
+        """
+        for row_number, cells in self._rows:
+            if len(cells) < self.ncols:
+                cells = tuple(cells) + (None,) * (self.ncols - len(cells))
+            values = [cell.value if cell is not None else None for cell in cells]
+            # Пропускаем полностью пустые строки
+            if all(is_empty_value(v) for v in values):
+                continue
+            if self.recorder is not None:
+                self.recorder.add(row_number, cells, values)
+            yield row_number, cells, values
+        if self.recorder is not None:
+            self.recorder.commit(self)
+            self.recorder = None
+
+    def project(self, columns) -> bool:
+        """
+        Двухфазное чтение (см. XmlRowSource.project); по умолчанию не поддерживается.
+        """
+        return False
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.abort()
+            self.recorder = None
+
+class WorkbookRowSource(SheetRowSource):
+    """
+    Строки листа sheet книги xlsx (None — активного листа) через openpyxl.
+    Движок stream читает книгу в режиме read_only (данные, без формул),
+    template — загружает книгу целиком, она же служит шаблоном выходного
+    файла (при заданном sheet остальные листы из шаблона убираются).
+    Для stream это запасной путь, когда файл не читает XmlRowSource.
+    """
+
+    def __init__(self, file_path: str, template: bool = False, recorder=None, layout_config: dict = None,
+                 sheet: str = None):
+        self.template = template
+        self.recorder = recorder
+        layout_config = layout_config or load_layout_config()
+        if template:
+            self.wb = load_workbook(file_path)
+        else:
+            self.wb = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            self.ws = self.wb.active if sheet is None else self.wb[sheet]
+            if template and sheet is not None:
+                # В выход листа многолистовой книги не попадают неотфильтрованные соседние листы
+                for other in [ws for ws in self.wb.worksheets if ws is not self.ws]:
+                    self.wb.remove(other)
+            self.title = self.ws.title
+            self.ncols = self.ws.max_column or 0
+            if not template:
+                # Размеры в <dimension> у выгрузок бывают неверными — читаем все строки
+                self.ws.reset_dimensions()
+            # Номер строки Excel: пропуски строк в XML read_only отдаёт пустыми кортежами
+            self._find_header(enumerate(self.ws.iter_rows(), start=1), layout_config)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        super().close()
+        if not self.template:
+            self.wb.close()
+
+# Пространства имён частей xlsx (Transitional OOXML; Strict читает openpyxl)
+XLSX_MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+XLSX_REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+XLSX_PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+def read_workbook_index(zf: zipfile.ZipFile) -> dict:
+    """
+    Оглавление книги из xl/workbook.xml и его связей: {"sheets": [(имя, путь
+    части листа в архиве или None для не рабочих листов)], "active": индекс
+    активного листа, "date1904": система дат 1904}.
+    """
+    workbook = ElementTree.fromstring(zf.read("xl/workbook.xml"))
+    rels = ElementTree.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+    targets = {}
+    for rel in rels.iter(f"{XLSX_PKG_REL_NS}Relationship"):
+        if rel.get("Type", "").endswith("/worksheet"):
+            target = rel.get("Target", "")
+            targets[rel.get("Id")] = (target.lstrip("/") if target.startswith("/")
+                                      else posixpath.normpath(posixpath.join("xl", target)))
+    sheets = [(sheet.get("name"), targets.get(sheet.get(f"{XLSX_REL_NS}id")))
+              for sheet in workbook.iter(f"{XLSX_MAIN_NS}sheet")]
+    view = workbook.find(f"{XLSX_MAIN_NS}bookViews/{XLSX_MAIN_NS}workbookView")
+    properties = workbook.find(f"{XLSX_MAIN_NS}workbookPr")
+    return {
+        "sheets": sheets,
+        "active": int(view.get("activeTab", 0)) if view is not None else 0,
+        "date1904": properties is not None and properties.get("date1904") in ("1", "true"),
+    }
+
+def xlsx_text(node) -> str:
+    """
+    Текст строки из <si> или <is>: <t> и текст фрагментов <r> (без фонетики <rPh>), как у openpyxl.
+    """
+    parts = []
+    plain = node.find(f"{XLSX_MAIN_NS}t")
+    if plain is not None:
+        parts.append(plain.text or "")
+    for run in node.iter(f"{XLSX_MAIN_NS}r"):
+        text = run.find(f"{XLSX_MAIN_NS}t")
+        if text is not None:
+            parts.append(text.text or "")
+    return "".join(parts)
+
+def read_shared_strings(zf: zipfile.ZipFile) -> list:
+    """
+    Таблица общих строк книги (список по индексу); читается потоком, разобранные <si> отпускаются.
+    """
+    if "xl/sharedStrings.xml" not in zf.namelist():
+        return []
+    strings = []
+    si_tag = f"{XLSX_MAIN_NS}si"
+    with zf.open("xl/sharedStrings.xml") as fh:
+        root = None
+        for event, node in ElementTree.iterparse(fh, events=("start", "end")):
+            if root is None:
+                root = node
+            elif event == "end" and node.tag == si_tag:
+                strings.append(xlsx_text(node).replace("x005F_", ""))
+                root.clear()
+    return strings
+
+class XlsxStyleTable(dict):
+    """
+    Стили ячеек книги по индексу (атрибут s ячейки): кортеж (font, border,
+    fill, number_format, protection, alignment), как у записи кэша разбора;
+    разбирается при первом обращении к индексу. date_formats и
+    timedelta_formats — индексы стилей с форматом даты и длительности.
+    """
+
+    def __init__(self, zf: zipfile.ZipFile):
+        from openpyxl.styles.stylesheet import Stylesheet
+
+        super().__init__()
+        self.stylesheet = Stylesheet.from_tree(ElementTree.fromstring(zf.read("xl/styles.xml")))
+        self.date_formats = self.stylesheet.date_formats
+        self.timedelta_formats = self.stylesheet.timedelta_formats
+
+    def __missing__(self, style_id: int):
+        from openpyxl.styles.numbers import BUILTIN_FORMATS, BUILTIN_FORMATS_MAX_SIZE
+
+        sheet = self.stylesheet
+        style = sheet.cell_styles[style_id]
+        if style.numFmtId < BUILTIN_FORMATS_MAX_SIZE:
+            number_format = BUILTIN_FORMATS.get(style.numFmtId, "General")
+        else:
+            number_format = sheet.number_formats[style.numFmtId - BUILTIN_FORMATS_MAX_SIZE]
+        entry = (sheet.fonts[style.fontId], sheet.borders[style.borderId], sheet.fills[style.fillId],
+                 number_format, sheet.protections[style.protectionId], sheet.alignments[style.alignmentId])
+        self[style_id] = entry
+        return entry
+
+class XmlRowSource(SheetRowSource):
+    """
+    Лёгкое чтение листа sheet книги xlsx (None — активного) без объектной
+    модели openpyxl: общие строки один раз загружаются в список, XML листа
+    разбирается потоком (iterparse), строка за строкой — разобранные строки
+    сразу отпускаются. Ячейки — CachedCell (значение и индекс стиля;
+    стиль разбирается при первом обращении, см. XlsxStyleTable). Значения —
+    как у openpyxl read_only с data_only: числа, даты по формату ячейки,
+    общие и встроенные строки, логические, кэшированные результаты формул.
+    Файлы, которые так прочитать нельзя, open_row_source читает через
+    WorkbookRowSource.
+    """
+
+    def __init__(self, file_path: str, recorder=None, layout_config: dict = None, sheet: str = None):
+        from openpyxl.utils.datetime import CALENDAR_MAC_1904, WINDOWS_EPOCH
+
+        self.recorder = recorder
+        layout_config = layout_config or load_layout_config()
+        self.zf = zipfile.ZipFile(file_path)
+        self.stream = None
+        try:
+            index = read_workbook_index(self.zf)
+            names = [name for name, _ in index["sheets"]]
+            position = index["active"] if sheet is None else names.index(sheet)
+            self.title, part = index["sheets"][position]
+            if part is None:
+                raise ValueError(f"лист {self.title} не является рабочим листом")
+            self.epoch = CALENDAR_MAC_1904 if index["date1904"] else WINDOWS_EPOCH
+            self.strings = read_shared_strings(self.zf)
+            self.styles = XlsxStyleTable(self.zf)
+            self.ncols = 0
+            self.projected = False
+            self.columns = frozenset()
+            self._columns = {}  # буквы колонки -> номер
+            self._cell_tag = f"{XLSX_MAIN_NS}c"
+            self.stream = self.zf.open(part)
+            self._find_header(self._iter_rows(), layout_config)
+        except Exception:
+            self.close()
+            raise
+
+    def _cell_value(self, cell, style_id: int):
+        from openpyxl.utils.datetime import from_excel, from_ISO8601
+
+        data_type = cell.get("t", "n")
+        if data_type == "inlineStr":
+            inline = cell.find(f"{XLSX_MAIN_NS}is")
+            return xlsx_text(inline) if inline is not None else None
+        value = cell.findtext(f"{XLSX_MAIN_NS}v") or None
+        if value is None:
+            return None
+        if data_type == "n":
+            value = float(value) if "." in value or "E" in value or "e" in value else int(value)
+            if style_id in self.styles.date_formats:
+                try:
+                    return from_excel(value, self.epoch, timedelta=style_id in self.styles.timedelta_formats)
+                except (OverflowError, ValueError):
+                    return "#VALUE!"
+            return value
+        if data_type == "s":
+            return self.strings[int(value)]
+        if data_type == "b":
+            return bool(int(value))
+        if data_type == "d":
+            return from_ISO8601(value)
+        return value  # "str" (результат формулы) и "e" (ошибка) — текстом
+
+    def _column(self, cell, previous: int) -> int:
+        """
+        Номер колонки ячейки (с 1) по её адресу; без адреса — следующая за previous.
+        """
+        ref = cell.get("r")
+        if not ref:
+            return previous + 1
+        letters = ref.rstrip("0123456789")
+        column = self._columns.get(letters)
+        if column is None:
+            column = self._columns[letters] = column_index_from_string(letters)
+        return column
+
+    def _row_cells(self, node, values: list = None) -> tuple:
+        """
+        Ячейки строки <row>. values — значения первой фазы (см. project):
+        колонки self.columns берутся оттуда, а не разбираются заново.
+        """
+        columns = self.columns if values is not None else ()
+        styles = self.styles
+        cells = []
+        for cell in node.iter(self._cell_tag):
+            column = self._column(cell, len(cells))
+            if column > len(cells) + 1:
+                cells.extend([None] * (column - len(cells) - 1))
+            style_id = int(cell.get("s", 0))
+            value = values[column - 1] if column - 1 in columns else self._cell_value(cell, style_id)
+            cells.append(CachedCell(value, style_id, styles))
+        return tuple(cells)
+
+    def _has_value(self, cell) -> bool:
+        # Непустая ли ячейка — без разбора числа и даты (как is_empty_value(_cell_value(...)))
+        data_type = cell.get("t", "n")
+        if data_type == "inlineStr":
+            inline = cell.find(f"{XLSX_MAIN_NS}is")
+            return inline is not None and xlsx_text(inline) != ""
+        value = cell.findtext(f"{XLSX_MAIN_NS}v")
+        if not value:
+            return False
+        return data_type != "s" or self.strings[int(value)] != ""
+
+    def _decision_values(self, node) -> list | None:
+        """
+        Значения строки <row> для первой фазы: колонки self.columns, остальные
+        — None (их ячейки только проверяются на пустоту); None вместо списка — строка пустая.
+        """
+        columns = self.columns
+        values = []
+        has_value = False
+        for cell in node.iter(self._cell_tag):
+            column = self._column(cell, len(values))
+            if column > len(values) + 1:
+                values.extend([None] * (column - len(values) - 1))
+            if column - 1 in columns:
+                value = self._cell_value(cell, int(cell.get("s", 0)))
+                has_value = has_value or not is_empty_value(value)
+            else:
+                value = None
+                has_value = has_value or self._has_value(cell)
+            values.append(value)
+        return values if has_value else None
+
+    def _iter_rows(self):
+        """
+        (номер_строки_excel, ячейки) по порядку; пропущенные в XML строки — пустые
+        кортежи. После project вместо ячеек отдаётся сам элемент <row>.
+        """
+        from openpyxl.utils.cell import range_boundaries
+
+        row_tag = f"{XLSX_MAIN_NS}row"
+        dimension_tag, sheet_data_tag = f"{XLSX_MAIN_NS}dimension", f"{XLSX_MAIN_NS}sheetData"
+        sheet_data = None
+        row_number = 0
+        for event, node in ElementTree.iterparse(self.stream, events=("start", "end")):
+            if event == "start":
+                if node.tag == sheet_data_tag:
+                    sheet_data = node
+                continue
+            if node.tag == dimension_tag:
+                # Ширина листа по <dimension> — как max_column у openpyxl
+                ref = node.get("ref")
+                if ref:
+                    self.ncols = range_boundaries(ref if ":" in ref else f"{ref}:{ref}")[2] or 0
+            elif node.tag == row_tag:
+                r = node.get("r")
+                number = int(float(r)) if r else row_number + 1
+                for missing in range(row_number + 1, number):
+                    yield missing, ()
+                row_number = number
+                # После project отдаётся сам <row>: sheet_data.clear() лишь отцепляет его, ячейки остаются
+                yield row_number, (node if self.projected else self._row_cells(node))
+                if sheet_data is not None:
+                    sheet_data.clear()
+
+    def project(self, columns) -> bool:
+        """
+        Двухфазное чтение: дальше data_rows отдаёт вместо ячеек элемент <row>,
+        а в значениях — только колонки columns (индексы с 0), остальные — None.
+        Всю строку для записи разбирает materialize, так что строки, которые
+        никуда не пишутся, целиком не разбираются. Не включается без columns
+        (решению нужна вся строка) и с записью в кэш разбора (recorder) —
+        записи нужны все ячейки. Возвращает, включено ли.
+        """
+        if not columns or self.recorder is not None:
+            return False
+        self.projected = True
+        self.columns = frozenset(columns)
+        return True
+
+    def data_rows(self):
+        if not self.projected:
+            yield from super().data_rows()
+            return
+        for row_number, cells in self._rows:
+            if isinstance(cells, tuple):
+                # Строки, прочитанные при поиске заголовка, уже разобраны
+                values = [cell.value if cell is not None else None for cell in cells]
+                if all(is_empty_value(v) for v in values):
+                    continue
+                if len(cells) < self.ncols:
+                    cells = tuple(cells) + (None,) * (self.ncols - len(cells))
+                    values.extend([None] * (self.ncols - len(values)))
+                yield row_number, cells, values
+                continue
+            values = self._decision_values(cells)
+            if values is None:
+                continue
+            if len(values) < self.ncols:
+                values.extend([None] * (self.ncols - len(values)))
+            yield row_number, cells, values
+
+    def materialize(self, cells, values: list) -> tuple:
+        """
+        Вторая фаза для строки из data_rows после project: (ячейки, значения)
+        всей строки, как без project. values дополняются на месте.
+        """
+        if isinstance(cells, tuple):
+            return cells, values
+        cells = self._row_cells(cells, values)
+        if len(cells) < self.ncols:
+            cells += (None,) * (self.ncols - len(cells))
+        values[:len(cells)] = [cell.value if cell is not None else None for cell in cells]
+        return cells, values
+
+    def close(self):
+        super().close()
+        if self.stream is not None:
+            self.stream.close()
+        self.zf.close()
+
+class CachedCell:
+    """
+    Ячейка из кэша разбора или XmlRowSource: значение и индекс стиля в таблице
+    стилей (записи кэша или книги). Даёт copy_cell_style те же атрибуты, что
+    и ячейка openpyxl.
+    """
+
+    __slots__ = ("value", "_style_id", "_styles")
+
+    def __init__(self, value, style_id: int, styles: dict):
+        self.value = value
+        self._style_id = style_id
+        self._styles = styles
+
+    @property
+    def has_style(self):
+        return self._style_id != 0
+
+    font = property(lambda self: self._styles[self._style_id][0])
+    border = property(lambda self: self._styles[self._style_id][1])
+    fill = property(lambda self: self._styles[self._style_id][2])
+    number_format = property(lambda self: self._styles[self._style_id][3])
+    protection = property(lambda self: self._styles[self._style_id][4])
+    alignment = property(lambda self: self._styles[self._style_id][5])
+
+class ParsedSheetRecorder:
+    """
+    Пишет запись кэша разбора по мере чтения строк: rows.pkl — последовательность
+    pickle-блоков (номера строк, значения, индексы стилей), meta.pkl — лист,
+    заголовок и таблица используемых стилей. Запись собирается во временной
+    папке и появляется под своим ключом только после полного прочтения листа.
+    """
+
+    def __init__(self, entry_dir: str):
+        self.entry_dir = entry_dir
+        cache_dir = os.path.dirname(entry_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=cache_dir)
+        self.rows_fh = open(os.path.join(self.tmp_dir, "rows.pkl"), "wb")
+        self.styles = {}
+        self._batch = ([], [], [])
+
+    def _style_ids(self, cells) -> tuple:
+        ids = []
+        for cell in cells:
+            style_id = getattr(cell, "_style_id", 0) if cell is not None else 0
+            if style_id and style_id not in self.styles:
+                self.styles[style_id] = (cell.font, cell.border, cell.fill, cell.number_format,
+                                         cell.protection, cell.alignment)
+            ids.append(style_id)
+        return tuple(ids)
+
+    def add(self, row_number: int, cells, values):
+        row_numbers, rows_values, rows_styles = self._batch
+        row_numbers.append(row_number)
+        rows_values.append(tuple(values))  # копия: values дальше меняются (сумма, дата)
+        rows_styles.append(self._style_ids(cells))
+        if len(row_numbers) >= MATCH_BATCH_ROWS:
+            self._flush()
+
+    def _flush(self):
+        if self._batch[0]:
+            pickle.dump(self._batch, self.rows_fh, protocol=pickle.HIGHEST_PROTOCOL)
+            self._batch = ([], [], [])
+
+    def commit(self, source: "WorkbookRowSource"):
+        self._flush()
+        self.rows_fh.close()
+        meta = {
+            "title": source.title,
+            "ncols": source.ncols,
+            "header_row": source.header_row,
+            "header_values": source.header_values,
+            "preamble_rows": source.preamble_rows,
+            "header_styles": self._style_ids(source.header_cells),
+            "styles": self.styles,
+        }
+        with open(os.path.join(self.tmp_dir, "meta.pkl"), "wb") as fh:
+            pickle.dump(meta, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            os.replace(self.tmp_dir, self.entry_dir)
+        except OSError:
+            # Запись с тем же ключом уже создана другим процессом
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def abort(self):
+        self.rows_fh.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+class CachedRowSource:
+    """
+    Строки листа из записи кэша разбора; интерфейс как у WorkbookRowSource.
+    Блоки rows.pkl читаются лениво, по одному.
+    """
+
+    def __init__(self, entry_dir: str):
+        self.entry_dir = entry_dir
+        with open(os.path.join(entry_dir, "meta.pkl"), "rb") as fh:
+            meta = pickle.load(fh)
+        self.title = meta["title"]
+        self.ncols = meta["ncols"]
+        self.styles = meta["styles"]
+        self.header_row = meta["header_row"]
+        self.header_values = meta["header_values"]
+        self.preamble_rows = meta["preamble_rows"]
+        self.header_cells = tuple(CachedCell(v, sid, self.styles)
+                                  for v, sid in zip(self.header_values, meta["header_styles"]))
+        # Отмечаем использование записи (вытеснение — по давности использования)
+        os.utime(entry_dir)
+
+    def data_rows(self):
+        styles = self.styles
+        with open(os.path.join(self.entry_dir, "rows.pkl"), "rb") as fh:
+            while True:
+                try:
+                    row_numbers, rows_values, rows_styles = pickle.load(fh)
+                except EOFError:
+                    break
+                for row_number, values, style_ids in zip(row_numbers, rows_values, rows_styles):
+                    cells = tuple(CachedCell(v, sid, styles) for v, sid in zip(values, style_ids))
+                    yield row_number, cells, list(values)
+
+    def project(self, columns) -> bool:
+        return False
+
+    def close(self):
+        pass
+
+def open_sheet_reader(file_path: str, reader: str, recorder=None, layout_config: dict = None, sheet: str = None):
+    """
+    Источник строк листа для движка stream: XmlRowSource (reader "lean"),
+    а если файл так не читается (не тот формат частей, повреждённый архив и
+    т.п.) или задан reader "openpyxl" — WorkbookRowSource.
+    """
+    if reader == "lean":
+        try:
+            return XmlRowSource(file_path, recorder=recorder, layout_config=layout_config, sheet=sheet)
+        except Exception as e:
+            log_list_item(f"Файл {Path(file_path).name} читается через openpyxl: {e}")
+    return WorkbookRowSource(file_path, recorder=recorder, layout_config=layout_config, sheet=sheet)
+
+def open_row_source(file_path: str, engine: str, parse_cache_dir: str = None, layout_config: dict = None,
+                    sheet: str = None, reader: str = None):
+    """
+    Открывает источник строк листа sheet файла (None — активного листа). С кэшем
+    разбора (parse_cache_dir) движок stream берёт строки из записи кэша по хэшу
+    содержимого файла (и настроек поиска заголовка), а при промахе читает книгу
+    (см. open_sheet_reader, reader — READER) и заодно создаёт запись.
+    Движку template кэш не подходит: ему нужна сама книга как шаблон.
+    """
+    layout_config = layout_config or load_layout_config()
+    reader = reader or READER
+    if engine == "template":
+        return WorkbookRowSource(file_path, template=True, layout_config=layout_config, sheet=sheet)
+    if not parse_cache_dir:
+        return open_sheet_reader(file_path, reader, layout_config=layout_config, sheet=sheet)
+    entry_name = f"{file_sha256(file_path)}-v{PARSE_CACHE_VERSION}-{layout_config['key']}"
+    if sheet is not None:
+        entry_name += "-" + hashlib.sha256(sheet.encode("utf-8")).hexdigest()[:12]
+    entry_dir = os.path.join(parse_cache_dir, entry_name)
+    if os.path.exists(os.path.join(entry_dir, "meta.pkl")):
+        try:
+            source = CachedRowSource(entry_dir)
+            log_list_item(f"Разбор {Path(file_path).name} взят из кэша")
+            return source
+        except Exception as e:
+            logger.warning("Повреждённая запись кэша %s: %s", entry_dir, e)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+    return open_sheet_reader(file_path, reader, ParsedSheetRecorder(entry_dir), layout_config, sheet)
+
+def list_worksheets(file_path: str) -> list | None:
+    """
+    Имена рабочих листов книги по порядку — из оглавления книги (см.
+    read_workbook_index), без разбора листов и общих строк (диаграммы-листы
+    не входят). None — книгу так прочитать не удалось; тогда файл
+    обрабатывается как однолистовой и ошибка чтения попадает в errors как обычно.
+    """
+    try:
+        with zipfile.ZipFile(file_path) as zf:
+            index = read_workbook_index(zf)
+    except Exception:
+        return None
+    return [name for name, part in index["sheets"] if part is not None] or None
+
+def plan_sheet_jobs(in_files: list, sheets: tuple = None) -> list:
+    """
+    Задания обработки: (файл, лист) для каждого рабочего листа каждого файла,
+    в порядке файлов и листов. Лист книги с одним рабочим листом — None
+    (имена выходов как у файла). sheets — имена листов для обработки
+    (None — все); остальные листы пропускаются с записью в лог.
+    """
+    jobs = []
+    for fp in in_files:
+        names = list_worksheets(fp)
+        if names is None:
+            jobs.append((fp, None))
+            continue
+        selected = [name for name in names if sheets is None or name in sheets]
+        for name in names:
+            if name not in selected:
+                log_list_item(f"Лист «{name}» файла {Path(fp).name} пропущен: не входит в выбранные листы")
+        if len(names) == 1:
+            jobs.extend((fp, None) for _ in selected)
+        else:
+            jobs.extend((fp, name) for name in selected)
+    return jobs
+
+def evict_parse_cache(parse_cache_dir: str, max_bytes: int):
+    """
+    Ограничивает размер кэша разбора: удаляет записи, которые дольше всего
+    не использовались, пока общий размер больше max_bytes.
+    """
+    if not os.path.isdir(parse_cache_dir):
+        return
+    entries = []
+    total = 0
+    for name in os.listdir(parse_cache_dir):
+        path = os.path.join(parse_cache_dir, name)
+        if name.startswith(".tmp-") or not os.path.isdir(path):
+            continue
+        size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+        entries.append((os.path.getmtime(path), size, path))
+        total += size
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        logger.info("Кэш разбора: удалена запись %s", path)
+
+# ========== Запись xlsx копированием архива (движок zip) ==========
+ZIP_SHEET_DATA_RE = re.compile(rb"<((?:[\w.-]+:)?)sheetData\b[^>]*?(/?)>")
+ZIP_READ_CHUNK = 1024 * 1024  # байт XML листа за одно чтение при поиске границ <sheetData>
+# Элементы листа после <sheetData>, привязанные к исходным номерам строк: в выход не переносятся
+ZIP_DROPPED_SHEET_ELEMENTS = ("sortState", "rowBreaks")
+# Элементы с диапазонами ячеек (атрибут ref/sqref или вложенный <xm:sqref>): диапазоны переводятся
+# на номера строк выхода (см. remap_sqref), элементы без оставшихся строк убираются
+ZIP_REMAPPED_SHEET_ELEMENTS = ("mergeCell", "hyperlink", "dataValidation", "conditionalFormatting")
+# Контейнеры этих элементов: пустые убираются, у остальных пересчитывается count
+ZIP_REMAPPED_CONTAINERS = ("mergeCells", "hyperlinks", "dataValidations", "conditionalFormattings")
+ZIP_CELL_REF_RE = re.compile(r"(\$?[A-Z]{0,3})(\$?)(\d*)")
+# Конец открывающего тега: '>' вне значений атрибутов
+XML_START_TAG_RE = re.compile(rb"<(?:[^>\"']|\"[^\"]*\"|'[^']*')*>")
+
+def split_sheet_xml(stream) -> tuple:
+    """
+    Делит XML листа на части до и после <sheetData>: (начало, префикс
+    пространства имён тегов, конец). Строки листа читаются потоком по
+    ZIP_READ_CHUNK байт и отбрасываются — в памяти держатся только начало и конец.
+    Границы ищутся по тегу <sheetData>; что вокруг них целый XML, проверяет
+    разбор начала и конца (см. XmlPart).
+    """
+    buffer = b""
+    match = None
+    while match is None:
+        chunk = stream.read(ZIP_READ_CHUNK)
+        if not chunk:
+            raise ValueError("в XML листа нет <sheetData>")
+        buffer += chunk
+        match = ZIP_SHEET_DATA_RE.search(buffer)
+    head, ns, rest = buffer[:match.start()], match.group(1), buffer[match.end():]
+    if match.group(2):  # <sheetData/> — строк нет
+        return head, ns, rest + stream.read()
+    end_tag = b"</" + ns + b"sheetData>"
+    while True:
+        pos = rest.find(end_tag)
+        if pos >= 0:
+            return head, ns, rest[pos + len(end_tag):] + stream.read()
+        chunk = stream.read(ZIP_READ_CHUNK)
+        if not chunk:
+            raise ValueError("в XML листа нет </sheetData>")
+        rest = rest[-len(end_tag):] + chunk
+
+def xml_local_name(tag: str) -> str:
+    """
+    Имя элемента без пространства имён: "{uri}sheet" -> "sheet".
+    """
+    return tag.rpartition("}")[2]
+
+class XmlElement:
+    """
+    Элемент XmlPart: tag — "{uri}имя" (как в ElementTree), name — имя с
+    префиксом как в исходном XML, attrib — атрибуты по именам с префиксами,
+    qnames — {"{uri}имя" или "имя": имя атрибута с префиксом}, text — текст
+    элемента; start, start_end, inner_end, end — смещения в байтах: начало
+    и конец открывающего тега, начало закрывающего и конец элемента.
+    """
+    __slots__ = ("tag", "name", "attrib", "qnames", "parent", "children", "text",
+                 "start", "start_end", "inner_end", "end", "empty")
+
+    def get(self, key: str, default=None):
+        """
+        Значение атрибута по имени ("ref") или "{uri}имя" (r:id с любым префиксом).
+        """
+        name = self.qnames.get(key)
+        return self.attrib.get(name, default) if name is not None else default
+
+    @property
+    def local(self) -> str:
+        return xml_local_name(self.tag)
+
+    @property
+    def prefix(self) -> str:
+        """
+        Префикс имени элемента вместе с двоеточием ("x:") или "".
+        """
+        return self.name[:self.name.index(":") + 1] if ":" in self.name else ""
+
+class XmlPart:
+    """
+    XML части архива для правок на месте. Элементы находит парсер (expat,
+    на котором построен ElementTree), а правки (remove, set, insert,
+    set_text) заменяют только байты изменяемых элементов и открывающих
+    тегов. Остальной XML — префиксы, объявления пространств имён (в том
+    числе перечисленные в mc:Ignorable), запись и порядок атрибутов —
+    остаётся байт в байт исходным. Части не в UTF-8 отвергаются.
+    """
+
+    def __init__(self, data: bytes):
+        from xml.parsers import expat
+
+        if data.startswith((b"\xff\xfe", b"\xfe\xff")):
+            raise ValueError("XML части не в UTF-8")
+        self.data = data
+        self.elements = []
+        self.edits = []  # (начало, конец, новые байты; None — точка разреза, см. split)
+        self.changed = {}  # элемент -> исходные атрибуты до set/unset
+        parser = expat.ParserCreate()
+        parser.ordered_attributes = True
+        stack = []
+        namespaces = [{"xml": "http://www.w3.org/XML/1998/namespace"}]
+
+        def declaration(version, encoding, standalone):
+            if encoding is not None and encoding.lower().replace("-", "") != "utf8":
+                raise ValueError(f"XML части в кодировке {encoding}")
+
+        def resolve(name: str, ns: dict, default: bool) -> str:
+            prefix, _, local = name.rpartition(":")
+            uri = ns.get(prefix) if prefix else (ns.get("") if default else None)
+            if prefix and uri is None:
+                raise ValueError(f"не объявлен префикс {prefix}")
+            return f"{{{uri}}}{local}" if uri else local
+
+        def start(name, attrs):
+            attrib = dict(zip(attrs[::2], attrs[1::2]))
+            ns = namespaces[-1]
+            declared = {key[6:] if key.startswith("xmlns:") else "": value for key, value in attrib.items()
+                        if key == "xmlns" or key.startswith("xmlns:")}
+            if declared:
+                ns = {**ns, **declared}
+            namespaces.append(ns)
+            element = XmlElement()
+            element.tag = resolve(name, ns, default=True)
+            element.name = name
+            element.attrib = attrib
+            element.qnames = {resolve(key, ns, default=False): key for key in attrib
+                              if key != "xmlns" and not key.startswith("xmlns:")}
+            element.parent = stack[-1] if stack else None
+            element.children = []
+            element.text = ""
+            element.start = parser.CurrentByteIndex
+            element.start_end = XML_START_TAG_RE.match(data, element.start).end()
+            element.empty = data[element.start_end - 2:element.start_end] == b"/>"
+            if element.parent is not None:
+                element.parent.children.append(element)
+            stack.append(element)
+            self.elements.append(element)
+
+        def end(name):
+            element = stack.pop()
+            namespaces.pop()
+            if element.empty:
+                element.inner_end = element.end = element.start_end
+            else:
+                element.inner_end = parser.CurrentByteIndex
+                element.end = data.index(b">", element.inner_end) + 1
+
+        def text(value):
+            if stack:
+                stack[-1].text += value
+
+        parser.XmlDeclHandler = declaration
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = text
+        try:
+            parser.Parse(data, True)
+        except expat.ExpatError as e:
+            raise ValueError(f"некорректный XML: {e}") from e
+        if not self.elements:
+            raise ValueError("пустой XML")
+        self.root = self.elements[0]
+
+    def iter(self, local: str, parent: XmlElement = None) -> list:
+        """
+        Элементы с именем local (без пространства имён) по порядку документа;
+        parent — только его прямые потомки.
+        """
+        elements = self.elements if parent is None else parent.children
+        return [element for element in elements if element.local == local]
+
+    def find(self, local: str, parent: XmlElement = None) -> XmlElement | None:
+        found = self.iter(local, parent)
+        return found[0] if found else None
+
+    def remove(self, element: XmlElement):
+        self.edits.append((element.start, element.end, b""))
+
+    def insert(self, pos: int, data: bytes):
+        self.edits.append((pos, pos, data))
+
+    def set(self, element: XmlElement, name: str, value: str):
+        """
+        Задаёт атрибут name (имя с префиксом, как в исходном XML); открывающий тег пишется заново.
+        """
+        self.changed.setdefault(element, dict(element.attrib))
+        element.attrib[name] = value
+        element.qnames.setdefault(name, name)
+
+    def unset(self, element: XmlElement, name: str):
+        self.changed.setdefault(element, dict(element.attrib))
+        element.attrib.pop(name, None)
+
+    def set_text(self, element: XmlElement, value: str):
+        """
+        Заменяет текст элемента без вложенных элементов.
+        """
+        element.text = value
+        self.edits.append((element.start_end, element.inner_end, xml_escape(value).encode()))
+
+    def split(self, element: XmlElement):
+        """
+        Отмечает элемент как точку разреза: result_parts() отдаёт XML до и после него.
+        """
+        self.edits.append((element.start, element.end, None))
+
+    def start_tag(self, element: XmlElement, changes: dict = None, empty: bool = None) -> bytes:
+        """
+        Открывающий тег элемента с атрибутами attrib, обновлёнными changes.
+        """
+        attrib = {**element.attrib, **(changes or {})}
+        escapes = {'"': "&quot;", "\t": "&#9;", "\n": "&#10;", "\r": "&#13;"}
+        attrs = "".join(f' {name}="{xml_escape(value, escapes)}"' for name, value in attrib.items())
+        empty = element.empty if empty is None else empty
+        return f"<{element.name}{attrs}{'/>' if empty else '>'}".encode()
+
+    def copy(self, element: XmlElement, changes: dict) -> bytes:
+        """
+        Копия элемента (с исходным содержимым) с атрибутами, обновлёнными changes.
+        """
+        return self.start_tag(element, changes) + self.data[element.start_end:element.end]
+
+    def result_parts(self) -> list:
+        """
+        XML с правками, разрезанный в точках split (без точек — одна часть).
+        Правки внутри удалённых элементов пропускаются.
+        """
+        edits = self.edits + [(element.start, element.start_end, self.start_tag(element))
+                              for element in self.changed]
+        parts = []
+        out = []
+        pos = 0
+        # Вставки — раньше замен с той же позицией, из замен — сначала объемлющая
+        for start, end, data in sorted(edits, key=lambda edit: (edit[0], edit[0] != edit[1], -edit[1])):
+            if start < pos:
+                continue
+            out.append(self.data[pos:start])
+            if data is None:
+                parts.append(b"".join(out))
+                out = []
+            else:
+                out.append(data)
+            pos = end
+        out.append(self.data[pos:])
+        parts.append(b"".join(out))
+        return parts
+
+    def result(self) -> bytes:
+        return b"".join(self.result_parts())
+
+def remap_sqref(sqref: str, source_rows: list, merge: bool = False) -> str:
+    """
+    Переводит диапазоны sqref (через пробел: A1, A1:C5, 2:5, A:C) на номера
+    строк выхода; source_rows — исходные номера записанных строк по порядку
+    (возрастают). Диапазон сжимается до попавших в выход строк — как при
+    удалении остальных строк в Excel; диапазоны без таких строк убираются.
+    merge=True — убираются и диапазоны из одной ячейки (объединение).
+    """
+    result = []
+    for ref in sqref.split():
+        parts = [ZIP_CELL_REF_RE.fullmatch(part) for part in ref.split(":")]
+        if len(parts) > 2 or None in parts or not all(match.group(3) for match in parts):
+            result.append(ref)  # целые колонки и непонятные ссылки от строк не зависят
+            continue
+        first = bisect_left(source_rows, int(parts[0].group(3))) + 1
+        last = bisect_right(source_rows, int(parts[-1].group(3)))
+        if first > last:
+            continue
+        refs = [match.group(1) + match.group(2) + str(row)
+                for match, row in zip(parts, (first, last) if len(parts) == 2 else (first,))]
+        if merge and (len(refs) == 1 or refs[0] == refs[1]):
+            continue
+        result.append(":".join(refs))
+    return " ".join(result)
+
+def excel_number(value) -> str:
+    """
+    Число для <v> ячейки: целые значения (в том числе float) — без ".0",
+    прочие — в кратчайшей точной записи.
+    """
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+class ZipSheetWriter:
+    """
+    Выход движка zip: архив исходной книги копируется запись за записью, а
+    XML листа генерируется заново — начало листа (ширины колонок,
+    закрепление, формат строк) и конец (поля и параметры печати) берутся из
+    исходного XML, между ними — только записанные строки с перенумерованным
+    атрибутом r. Ячейки сохраняют исходный индекс стиля s (таблица стилей,
+    тема и шрифты не пересобираются); суммы и даты пишутся по своему типу
+    (число, дата — числом Excel), а их ячейкам (layout) добавляются в конец
+    cellXfs копии исходных стилей с форматами AMOUNT_NUMBER_FORMAT и
+    DATE_NUMBER_FORMAT — существующие индексы стилей не меняются.
+    Строковые значения из таблицы общих строк ссылаются на неё (strings —
+    готовая таблица XmlRowSource, иначе читается из архива), прочие пишутся
+    встроенными строками. Строки листа копятся во временном файле в tmp_dir
+    (по умолчанию OUT_DIR).
+    Объединения ячеек, гиперссылки, проверки данных и условное форматирование,
+    закрепление областей и выделение переводятся на новые номера строк по
+    исходным номерам записанных строк (header_row и source_row у write_row) —
+    как если бы остальные строки удалили в Excel; сортировка, разрывы страниц
+    и цепочка вычислений не переносятся; диапазон автофильтра (и его скрытое
+    имя) и <dimension> пересчитываются. У листа многолистовой книги (sheet)
+    остальные листы из книги убираются.
+    Кроме XML листа правятся (через XmlPart, только изменяемые элементы)
+    xl/styles.xml — если добавлены стили сумм и дат, xl/workbook.xml, его
+    связи и [Content_Types].xml — чтобы убрать цепочку вычислений и другие
+    листы; остальные части копируются байт в байт.
+    Книгу, которую так записать нельзя (нет частей по стандартным путям, XML
+    не разбирается, лист с таблицами Excel или примечаниями), конструктор
+    отвергает — см. open_zip_writer.
+    """
+
+    def __init__(self, file_path: str, sheet: str = None, layout: "ColumnLayout" = None, tmp_dir: str = None,
+                 strings: list = None, header_row: int = 1):
+        import datetime as dt
+        from openpyxl.cell.cell import ERROR_CODES
+        from openpyxl.utils.datetime import CALENDAR_MAC_1904, WINDOWS_EPOCH, to_excel
+
+        self.to_excel = to_excel
+        self.error_codes = ERROR_CODES
+        self.temporal_types = (dt.datetime, dt.date, dt.time, dt.timedelta)
+        self.layout = layout or ColumnLayout()
+        self.zf = zipfile.ZipFile(file_path)
+        self.spool = None
+        try:
+            index = read_workbook_index(self.zf)
+            names = [name for name, _ in index["sheets"]]
+            position = index["active"] if sheet is None else names.index(sheet)
+            self.part = index["sheets"][position][1]
+            if self.part is None:
+                raise ValueError("лист не является рабочим листом")
+            sheet_rels = posixpath.join(posixpath.dirname(self.part), "_rels",
+                                        posixpath.basename(self.part) + ".rels")
+            if sheet_rels in self.zf.namelist():
+                types = [rel.get("Type", "") for rel in ElementTree.fromstring(self.zf.read(sheet_rels))
+                         .iter(f"{XLSX_PKG_REL_NS}Relationship")]
+                if any(rel_type.endswith("/table") for rel_type in types):
+                    raise ValueError("на листе есть таблицы Excel")
+                if any(rel_type.endswith(("/comments", "/threadedComment")) for rel_type in types):
+                    # Примечания привязаны к ячейкам и в comments, и в разметке VML — их пишет openpyxl
+                    raise ValueError("на листе есть примечания")
+            # Начало и конец XML листа (без строк) разбираются сразу: лист, который не
+            # получится переписать, уходит в запасной движок до обработки строк
+            with self.zf.open(self.part) as fh:
+                head, ns, tail = split_sheet_xml(fh)
+            self.sheet_xml = XmlPart(head + b"<" + ns + b"sheetData/>" + tail)
+            self.sheet_data = self.sheet_xml.find("sheetData", self.sheet_xml.root)
+            if self.sheet_data is None:
+                raise ValueError("<sheetData> не на верхнем уровне листа")
+            # Префикс тегов листа (например, x:) — у сгенерированных строк тот же
+            self.ns = self.sheet_data.prefix
+            self.epoch = CALENDAR_MAC_1904 if index["date1904"] else WINDOWS_EPOCH
+            self.local_sheet_id = position if sheet is None else 0
+            self.replaced, self.dropped = self._package_edits(index, position if sheet is not None else None)
+            self._load_styles()
+            if strings is None:
+                strings = read_shared_strings(self.zf)
+            self.string_index = {}
+            for i, text in enumerate(strings):
+                self.string_index.setdefault(text, i)
+            fd, self.spool_path = tempfile.mkstemp(prefix="sheet_", suffix=".xml", dir=tmp_dir or OUT_DIR)
+            self.spool = os.fdopen(fd, "w", encoding="utf-8")
+        except Exception:
+            self.zf.close()
+            raise
+        self.columns = []
+        self.max_col = 0
+        self.rows_written = 0
+        self.header_row = header_row
+        self.source_rows = []  # исходные номера записанных строк (с заголовком) по порядку
+
+    def _package_edits(self, index: dict, keep: int = None) -> tuple:
+        """
+        Правки частей книги: ({имя части: XmlPart с правками}, {удаляемые части}).
+        Цепочка вычислений (calcChain) удаляется всегда; если задан keep —
+        из книги убираются все листы, кроме листа с этим номером.
+        """
+        rels_name = "xl/_rels/workbook.xml.rels"
+        workbook = XmlPart(self.zf.read("xl/workbook.xml"))
+        rels = XmlPart(self.zf.read(rels_name))
+        content_types = XmlPart(self.zf.read("[Content_Types].xml"))
+        dropped = {"xl/calcChain.xml"}
+        relationships = rels.iter("Relationship", rels.root)
+        for rel in relationships:
+            if rel.get("Type", "").endswith("/calcChain"):
+                rels.remove(rel)
+        if keep is not None:
+            sheets = [element for element in workbook.elements if element.tag == f"{XLSX_MAIN_NS}sheet"]
+            if len(sheets) != len(index["sheets"]):
+                raise ValueError("не удалось разобрать список листов xl/workbook.xml")
+            for position, element in enumerate(sheets):
+                if position == keep:
+                    continue
+                workbook.remove(element)
+                rel_id = element.get(f"{XLSX_REL_NS}id")
+                for rel in relationships:
+                    if rel_id is not None and rel.get("Id") == rel_id:
+                        rels.remove(rel)
+                part = index["sheets"][position][1]
+                if part is not None:
+                    dropped.add(part)
+                    dropped.add(posixpath.join(posixpath.dirname(part), "_rels", posixpath.basename(part) + ".rels"))
+            for name in workbook.iter("definedName"):
+                sheet_id = name.get("localSheetId")
+                if sheet_id is None:
+                    continue
+                if int(sheet_id) != keep:
+                    workbook.remove(name)
+                else:
+                    workbook.set(name, name.qnames["localSheetId"], "0")
+            for view in workbook.iter("workbookView"):
+                for attr in ("activeTab", "firstSheet"):
+                    if attr in view.qnames:
+                        workbook.unset(view, view.qnames[attr])
+        for override in content_types.iter("Override", content_types.root):
+            if override.get("PartName", "").lstrip("/") in dropped:
+                content_types.remove(override)
+        replaced = {"xl/workbook.xml": workbook, rels_name: rels, "[Content_Types].xml": content_types}
+        return replaced, dropped
+
+    def _load_styles(self):
+        from openpyxl.styles.numbers import BUILTIN_FORMATS_REVERSE
+
+        self.styles = XmlPart(self.zf.read("xl/styles.xml"))
+        self.cell_xfs = self.styles.find("cellXfs", self.styles.root)
+        if self.cell_xfs is None or not self.styles.iter("xf", self.cell_xfs):
+            raise ValueError("в xl/styles.xml нет cellXfs")
+        self.xfs = self.styles.iter("xf", self.cell_xfs)
+        self.new_xfs = []
+        self.new_num_fmts = []
+        self.formatted_styles = {}  # (индекс стиля, формат) -> индекс копии стиля с форматом
+        self.num_fmt_ids = dict(BUILTIN_FORMATS_REVERSE)
+        for num_fmt in self.styles.iter("numFmt"):
+            fmt_id, code = num_fmt.get("numFmtId"), num_fmt.get("formatCode")
+            if fmt_id is not None and code is not None:
+                self.num_fmt_ids.setdefault(code, int(fmt_id))
+
+    def _formatted_style(self, style_id: int, number_format: str) -> int:
+        key = (style_id, number_format)
+        if key not in self.formatted_styles:
+            fmt_id = self.num_fmt_ids.get(number_format)
+            prefix = self.cell_xfs.prefix
+            if fmt_id is None:
+                fmt_id = max([163, *self.num_fmt_ids.values()]) + 1  # свои форматы — с 164
+                self.num_fmt_ids[number_format] = fmt_id
+                code = xml_escape(number_format, {'"': "&quot;"})
+                self.new_num_fmts.append(f'<{prefix}numFmt numFmtId="{fmt_id}" formatCode="{code}"/>'.encode())
+            xf = self.xfs[style_id] if style_id < len(self.xfs) else self.xfs[0]
+            self.new_xfs.append(self.styles.copy(xf, {xf.qnames.get("numFmtId", "numFmtId"): str(fmt_id),
+                                                      xf.qnames.get("applyNumberFormat", "applyNumberFormat"): "1"}))
+            self.formatted_styles[key] = len(self.xfs) + len(self.new_xfs) - 1
+        return self.formatted_styles[key]
+
+    def _cell_xml(self, col_idx: int, row: int, value, style_id: int) -> str:
+        ns = self.ns
+        attrs = f'r="{self.columns[col_idx]}{row}"' + (f' s="{style_id}"' if style_id else "")
+        if value is None:
+            return f"<{ns}c {attrs}/>"
+        if isinstance(value, bool):
+            attrs, value = attrs + ' t="b"', int(value)
+        elif isinstance(value, (int, float)):
+            value = excel_number(value)
+        elif isinstance(value, self.temporal_types):
+            value = excel_number(self.to_excel(value, self.epoch))
+        else:
+            value = str(value)
+            if value in self.error_codes:
+                attrs += ' t="e"'
+            elif value in self.string_index:
+                attrs, value = attrs + ' t="s"', self.string_index[value]
+            else:
+                space = ' xml:space="preserve"' if value != value.strip() else ""
+                return f'<{ns}c {attrs} t="inlineStr"><{ns}is><{ns}t{space}>{xml_escape(value)}</{ns}t></{ns}is></{ns}c>'
+        return f"<{ns}c {attrs}><{ns}v>{value}</{ns}v></{ns}c>"
+
+    def _write(self, src_cells, values, apply_formats: bool):
+        row = self.rows_written + 1
+        while len(self.columns) < len(values):
+            self.columns.append(get_column_letter(len(self.columns) + 1))
+        cells = []
+        for col_idx, value in enumerate(values):
+            src_cell = src_cells[col_idx] if col_idx < len(src_cells) else None
+            style_id = getattr(src_cell, "_style_id", 0) if src_cell is not None else 0
+            if apply_formats and col_idx == self.layout.amount_col:
+                style_id = self._formatted_style(style_id, AMOUNT_NUMBER_FORMAT)
+            elif apply_formats and col_idx == self.layout.date_col:
+                style_id = self._formatted_style(style_id, DATE_NUMBER_FORMAT)
+            elif value is None and not style_id:
+                continue
+            cells.append(self._cell_xml(col_idx, row, value, style_id))
+            self.max_col = max(self.max_col, col_idx + 1)
+        self.spool.write(f'<{self.ns}row r="{row}">{"".join(cells)}</{self.ns}row>')
+
+    def write_header(self, src_cells, values):
+        self.source_rows.append(self.header_row)
+        self._write(src_cells, values, apply_formats=False)
+
+    def write_row(self, src_cells, values, source_row: int = None):
+        """
+        source_row — номер строки в исходном листе (None — следующая за предыдущей записанной).
+        """
+        self.rows_written += 1
+        self.source_rows.append(source_row if source_row is not None else self.source_rows[-1] + 1)
+        self._write(src_cells, values, apply_formats=True)
+
+    def _styles_xml(self) -> bytes:
+        styles = self.styles
+        if not self.new_xfs:
+            return styles.data
+        cell_xfs = self.cell_xfs
+        styles.insert(cell_xfs.inner_end, b"".join(self.new_xfs))
+        styles.set(cell_xfs, cell_xfs.qnames.get("count", "count"), str(len(self.xfs) + len(self.new_xfs)))
+        if self.new_num_fmts:
+            num_fmts = styles.find("numFmts", styles.root)
+            new = b"".join(self.new_num_fmts)
+            if num_fmts is None:
+                # <numFmts> — первый элемент styleSheet
+                prefix = cell_xfs.prefix
+                styles.insert(styles.root.start_end, f'<{prefix}numFmts count="{len(self.new_num_fmts)}">'.encode()
+                              + new + f"</{prefix}numFmts>".encode())
+            else:
+                count = str(len(styles.iter("numFmt", num_fmts)) + len(self.new_num_fmts))
+                changes = {num_fmts.qnames.get("count", "count"): count}
+                if num_fmts.empty:
+                    styles.remove(num_fmts)
+                    styles.insert(num_fmts.end, styles.start_tag(num_fmts, changes, empty=False) + new
+                                  + f"</{num_fmts.name}>".encode())
+                else:
+                    styles.insert(num_fmts.inner_end, new)
+                    styles.set(num_fmts, num_fmts.qnames.get("count", "count"), count)
+        return styles.result()
+
+    def _workbook_xml(self) -> bytes:
+        """
+        xl/workbook.xml с правками _package_edits; скрытое имя диапазона
+        автофильтра листа — по новым номерам строк, как <autoFilter>.
+        """
+        workbook = self.replaced["xl/workbook.xml"]
+        for name in workbook.iter("definedName"):
+            if name.get("name") == "_xlnm._FilterDatabase" and name.get("localSheetId") == str(self.local_sheet_id):
+                text = re.sub(r"(\$?[A-Z]{1,3}\$?)\d+(:\$?[A-Z]{1,3}\$?)\d+$",
+                              lambda m: f"{m.group(1)}1{m.group(2)}{self.rows_written + 1}", name.text)
+                if text != name.text:
+                    workbook.set_text(name, text)
+        return workbook.result()
+
+    def _nearest_row(self, row: int) -> int:
+        """
+        Строка выхода для исходной строки row: она сама или первая записанная ниже неё (иначе последняя).
+        """
+        return max(1, min(bisect_left(self.source_rows, row) + 1, len(self.source_rows)))
+
+    def _remap_cell(self, ref: str, min_row: int = 1) -> str:
+        match = ZIP_CELL_REF_RE.fullmatch(ref)
+        if match is None or not match.group(3):
+            return ref
+        row = max(self._nearest_row(int(match.group(3))), min_row)
+        return match.group(1) + match.group(2) + str(row)
+
+    def _remap_views(self, sheet: XmlPart):
+        """
+        Закрепление областей, выделение и позиция прокрутки листа — по номерам строк выхода.
+        """
+        for view in sheet.iter("sheetView"):
+            selections = sheet.iter("selection", view)
+            pane = sheet.find("pane", view)
+            if pane is not None and pane.get("state", "").startswith("frozen"):
+                y_split = pane.get("ySplit")
+                frozen = bisect_right(self.source_rows, int(float(y_split))) if y_split else 0
+                if y_split and frozen:
+                    sheet.set(pane, pane.qnames["ySplit"], str(frozen))
+                elif y_split:
+                    # Закреплены только строки, не попавшие в выход
+                    sheet.unset(pane, pane.qnames["ySplit"])
+                if "xSplit" in pane.qnames or (y_split and frozen):
+                    if "topLeftCell" in pane.qnames:
+                        sheet.set(pane, pane.qnames["topLeftCell"], self._remap_cell(pane.get("topLeftCell"),
+                                                                                     frozen + 1))
+                else:
+                    # Закрепления не осталось — выделения областей тоже убираются (Excel выделит A1)
+                    sheet.remove(pane)
+                    for selection in selections:
+                        sheet.remove(selection)
+                    selections = []
+            for element in [view, *selections]:
+                for attr in ("topLeftCell", "activeCell"):
+                    if attr in element.qnames:
+                        sheet.set(element, element.qnames[attr], self._remap_cell(element.get(attr)))
+                if "sqref" in element.qnames:
+                    ranges = remap_sqref(element.get("sqref"), self.source_rows) or element.get("activeCell", "A1")
+                    sheet.set(element, element.qnames["sqref"], ranges)
+
+    def _remap_ranges(self, sheet: XmlPart):
+        """
+        Диапазоны элементов ZIP_REMAPPED_SHEET_ELEMENTS (в том числе их версий
+        x14 в extLst) — по номерам строк выхода; элементы без оставшихся строк
+        и опустевшие контейнеры убираются.
+        """
+        removed = set()
+
+        def remove(element):
+            sheet.remove(element)
+            removed.add(element)
+
+        for element in sheet.elements:
+            if element.local not in ZIP_REMAPPED_SHEET_ELEMENTS:
+                continue
+            merge = element.local == "mergeCell"
+            attr = next((name for name in ("ref", "sqref") if name in element.qnames), None)
+            if attr is not None:
+                remapped = remap_sqref(element.get(attr), self.source_rows, merge)
+                if remapped:
+                    sheet.set(element, element.qnames[attr], remapped)
+                    continue
+            else:
+                sqref = sheet.find("sqref", element)
+                if sqref is None:
+                    continue
+                remapped = remap_sqref(sqref.text, self.source_rows, merge)
+                if remapped:
+                    sheet.set_text(sqref, remapped)
+                    continue
+            remove(element)
+        for name in ZIP_REMAPPED_CONTAINERS:
+            for container in sheet.iter(name):
+                count = len([child for child in sheet.iter(name[:-1], container) if child not in removed])
+                if not count:
+                    remove(container)
+                elif "count" in container.qnames:
+                    sheet.set(container, container.qnames["count"], str(count))
+        # Расширения x14, оставшиеся без содержимого
+        for name in ("ext", "extLst"):
+            for element in sheet.iter(name):
+                if element.children and all(child in removed for child in element.children):
+                    remove(element)
+
+    def _sheet_xml(self, out):
+        """
+        Пишет в поток out XML листа: исходные начало и конец вокруг записанных строк.
+        """
+        sheet = self.sheet_xml
+        root = sheet.root
+        last_ref = f"{get_column_letter(max(self.max_col, 1))}{self.rows_written + 1}"
+        for element in root.children:
+            if element.local in ZIP_DROPPED_SHEET_ELEMENTS:
+                sheet.remove(element)
+            elif element.local == "dimension" and "ref" in element.qnames:
+                sheet.set(element, element.qnames["ref"], f"A1:{last_ref}")
+            elif element.local == "autoFilter" and "ref" in element.qnames:
+                parts = [ZIP_CELL_REF_RE.fullmatch(part) for part in element.get("ref").split(":")]
+                if len(parts) == 2 and None not in parts and all(match.group(3) for match in parts):
+                    sheet.set(element, element.qnames["ref"],
+                              f"{parts[0].group(1)}1:{parts[1].group(1)}{self.rows_written + 1}")
+        self._remap_views(sheet)
+        self._remap_ranges(sheet)
+        sheet.split(self.sheet_data)
+        head, tail = sheet.result_parts()
+        out.write(head)
+        out.write(f"<{self.ns}sheetData>".encode())
+        with open(self.spool_path, "rb") as fh:
+            shutil.copyfileobj(fh, out)
+        out.write(f"</{self.ns}sheetData>".encode())
+        out.write(tail)
+
+    def save(self, path: str):
+        self.spool.close()
+        try:
+            with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as out:
+                for info in self.zf.infolist():
+                    if info.filename in self.dropped:
+                        continue
+                    target = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+                    target.compress_type = info.compress_type
+                    target.external_attr = info.external_attr
+                    if info.filename == self.part:
+                        large = os.path.getsize(self.spool_path) > 1 << 30
+                        with out.open(target, "w", force_zip64=large) as fh:
+                            self._sheet_xml(fh)
+                    elif info.filename == "xl/styles.xml":
+                        out.writestr(target, self._styles_xml())
+                    elif info.filename == "xl/workbook.xml":
+                        out.writestr(target, self._workbook_xml())
+                    elif info.filename in self.replaced:
+                        out.writestr(target, self.replaced[info.filename].result())
+                    else:
+                        with self.zf.open(info) as src, out.open(target, "w") as fh:
+                            shutil.copyfileobj(src, fh)
+        finally:
+            self.zf.close()
+            os.remove(self.spool_path)
+
+def open_zip_writer(file_path: str, sheet: str, source, style_cache: dict, layout: "ColumnLayout",
+                    tmp_dir: str = None):
+    """
+    Выходной лист движка zip: ZipSheetWriter, а если книгу так записать
+    нельзя — StreamSheetWriter (как у движка stream) с записью в лог.
+    """
+    try:
+        return ZipSheetWriter(file_path, sheet, layout, tmp_dir, getattr(source, "strings", None),
+                              source.header_row or 1)
+    except Exception as e:
+        log_list_item(f"Файл {Path(file_path).name} записывается через openpyxl: {e}")
+        return StreamSheetWriter(source.title, style_cache, layout=layout)
+
+# ========== Метрики этапов и профилирование ==========
+def peak_rss_mb() -> float | None:
+    """
+    Пиковый RSS текущего процесса в МБ (None, если платформа не даёт его узнать).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт КБ, macOS — байты
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def record_stage(metrics: dict, stage: str, started: float, rows: int = 0):
+    """
+    Добавляет к этапу stage время с момента started (time.perf_counter()) и rows строк.
+    Пиковая память этапа — peak RSS процесса на момент его окончания.
+    metrics=None — метрики не собираются.
+    """
+    if metrics is None:
+        return
+    entry = metrics.setdefault(stage, {"seconds": 0.0, "rows": 0, "peak_rss_mb": None})
+    entry["seconds"] += time.perf_counter() - started
+    entry["rows"] += rows
+    entry["peak_rss_mb"] = peak_rss_mb()
+
+def timed_batches(batches, metrics: dict, stage: str):
+    """
+    Отдаёт блоки из batches, засчитывая время получения каждого блока этапу stage.
+    """
+    batches = iter(batches)
+    while True:
+        started = time.perf_counter()
+        batch = next(batches, None)
+        if batch is None:
+            return
+        record_stage(metrics, stage, started, len(batch))
+        yield batch
+        batch = None  # окно отпускается до чтения следующего
+
+def metrics_table_rows(name: str, metrics: dict) -> list:
+    """
+    Строки для log_table: [имя, этап, время, строк, строк/с, peak RSS, очередь].
+    Очередь — средняя и наибольшая глубина для записей очередей (см. record_queue).
+    """
+    rows = []
+    for stage, entry in metrics.items():
+        seconds = entry["seconds"]
+        rate = round(entry["rows"] / seconds) if entry["rows"] and seconds else ""
+        peak = entry["peak_rss_mb"] if entry["peak_rss_mb"] is not None else ""
+        depth = f"{entry['mean_depth']:.1f} / {entry['max_depth']}" if "max_depth" in entry else ""
+        rows.append([name, stage, f"{seconds:.3f}", entry["rows"], rate, peak, depth])
+    return rows
+
+def save_metrics(run_metrics: dict, file_metrics: dict, settings: dict, out_dir: str = OUT_DIR):
+    """
+    Пишет метрики запуска и по файлам в <out_dir>/METRICS_FILE.
+    """
+    path = os.path.join(out_dir, METRICS_FILE)
+    data = {"created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "settings": settings,
+            "run": run_metrics, "files": file_metrics}
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+    except OSError as e:
+        logger.exception("Ошибка при сохранении %s: %s", path, e)
+
+def run_profiled(profile_dir: str, file_path: str, func, *args):
+    """
+    Выполняет func(*args). Если задан profile_dir — под cProfile, с дампом
+    в profile_dir/<имя файла>.prof (смотреть через python -m pstats);
+    у листа многолистовой книги file_path — метка с листом (см. sheet_label).
+    """
+    if not profile_dir:
+        return func(*args)
+    os.makedirs(profile_dir, exist_ok=True)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        profiler.dump_stats(os.path.join(profile_dir, Path(file_path).name + ".prof"))
+
+# ========== Конвейер этапов ==========
+def record_queue(metrics: dict, stage: str, depth: int):
+    """
+    Засчитывает очереди перед этапом stage (запись "queue_<stage>") один
+    элемент и её глубину depth в этот момент: items, max_depth, mean_depth.
+    Время записи очереди нулевое — ожидание входит во время самих этапов.
+    metrics=None — метрики не собираются.
+    """
+    if metrics is None:
+        return
+    entry = metrics.setdefault(f"queue_{stage}", {"seconds": 0.0, "rows": 0, "peak_rss_mb": None,
+                                                 "items": 0, "max_depth": 0, "mean_depth": 0.0})
+    entry["items"] += 1
+    entry["max_depth"] = max(entry["max_depth"], depth)
+    entry["mean_depth"] += (depth - entry["mean_depth"]) / entry["items"]
+
+def prefetch(items, depth: int, metrics: dict = None, stage: str = "read"):
+    """
+    Этап конвейера: элементы items вычисляются в отдельном потоке не больше
+    чем на depth вперёд (ограниченная очередь) и отдаются по порядку;
+    depth=0 — без потока. Ошибка потока пробрасывается при получении
+    следующего элемента. close() генератора останавливает поток и дожидается
+    его — до закрытия источника items. Глубина очереди перед каждым
+    получением — в metrics (см. record_queue).
+    """
+    if depth <= 0:
+        yield from items
+        return
+    pipe = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                pipe.put(item, timeout=STAGE_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except BaseException as e:
+            put((end, e))
+
+    thread = threading.Thread(target=produce, name=f"{stage}-stage", daemon=True)
+    thread.start()
+    try:
+        while True:
+            queued = pipe.qsize()
+            item, error = pipe.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            record_queue(metrics, stage, queued)
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+class StageWorker:
+    """
+    Этап конвейера в отдельном потоке: задания submit(func, *args) выполняются
+    по порядку из ограниченной очереди (depth); когда она заполнена, submit
+    ждёт. После ошибки задания остальные пропускаются, а ошибка пробрасывается
+    из следующего submit или join(). depth=0 — задания выполняются сразу
+    в вызывающем потоке. Глубина очереди при каждом submit — в metrics
+    (см. record_queue).
+    """
+
+    def __init__(self, depth: int, metrics: dict = None, stage: str = "write"):
+        self.metrics = metrics
+        self.stage = stage
+        self.error = None
+        self.raised = False
+        self.pipe = queue.Queue(maxsize=depth) if depth > 0 else None
+        self.thread = None
+        if self.pipe is not None:
+            self.thread = threading.Thread(target=self._run, name=f"{stage}-stage", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            task = self.pipe.get()
+            if task is None:
+                return
+            if self.error is None:
+                func, args = task
+                try:
+                    func(*args)
+                except BaseException as e:
+                    self.error = e
+
+    def _raise(self):
+        if self.error is not None and not self.raised:
+            self.raised = True
+            raise self.error
+
+    def submit(self, func, *args):
+        if self.pipe is None:
+            func(*args)
+            return
+        self._raise()
+        record_queue(self.metrics, self.stage, self.pipe.qsize())
+        self.pipe.put((func, args))
+
+    def join(self, raise_error: bool = True):
+        """
+        Дожидается выполнения всех заданий и останавливает поток. raise_error=False —
+        без проброса ошибки (при выходе по другой ошибке).
+        """
+        if self.thread is not None:
+            self.pipe.put(None)
+            self.thread.join()
+            self.thread = None
+        if raise_error:
+            self._raise()
+
+def read_ahead(jobs):
+    """
+    Задания (файл, лист) по порядку; файл каждого следующего задания перед
+    этим читается целиком (по INPUT_PREFETCH_CHUNK байт), чтобы к его
+    обработке он был в кэше ОС. Ошибки чтения пропускаются — их покажет обработка.
+    """
+    warmed = None
+    for fp, sheet in jobs:
+        if fp != warmed:
+            warmed = fp
+            try:
+                with open(fp, "rb") as fh:
+                    while fh.read(INPUT_PREFETCH_CHUNK):
+                        pass
+            except OSError:
+                pass
+        yield fp, sheet
+
+def pipeline_depth_for(options: "FilterOptions") -> int:
+    """
+    Глубина очередей конвейера внутри файла: options.pipeline_depth, но 0 для
+    движка template (запись идёт в тот же лист, который читается) и под
+    --profile (cProfile видит только основной поток).
+    """
+    if options.engine == "template" or options.profile_dir:
+        return 0
+    return options.pipeline_depth
+
+def write_window(ops: list, metrics: dict, rows: int):
+    """
+    Задание этапа записи: выполняет записи окна ops — (метод записи, ячейки, значения) по порядку.
+    """
+    started = time.perf_counter()
+    for write, cells, values in ops:
+        write(cells, values)
+    record_stage(metrics, "write", started, rows)
+
+# ========== Параметры и результаты обработки ==========
+@dataclass
+class FilterOptions:
+    """
+    Параметры обработки файлов. Незаданные поля берутся из констант модуля.
+    engine: "stream", "template" или "zip" (ENGINE); matcher: "compiled", "vector" или "loop" (MATCHER);
+    le_in_text: искать коды LE и внутри текста ячеек (LE_IN_TEXT; только matcher "compiled");
+    output_format: одно из OUTPUT_FORMATS (OUTPUT_FORMAT); out_dir: папка выходных
+    файлов (OUT_DIR); parse_cache_dir: папка кэша разбора (None — без кэша);
+    le_groups: {группа: set LE} — режим групп (le_set тогда не используется,
+    строка пишется в <out_dir>/<группа>/<файл> каждой группы, где есть её LE;
+    с движком template не работает — ValueError);
+    profile_dir: папка дампов cProfile (None — без профиля);
+    layout_config: поиск заголовка и колонок ролей (см. load_layout_config);
+    chunk_rows: строк в окне обработки (None — MATCH_BATCH_ROWS или по бюджету памяти);
+    max_memory_mb: бюджет памяти процесса на файл — окно подбирается по ширине
+    листа (см. chunk_rows_for); None — без бюджета;
+    sheets: имена листов для обработки (SHEETS; None — все рабочие листы);
+    reader: чтение xlsx движками stream и zip — "lean" или "openpyxl" (READER, см. open_sheet_reader);
+    pipeline_depth: окон в очередях между потоками чтения, отбора и записи
+    (PIPELINE_DEPTH; 0 — всё в одном потоке, см. pipeline_depth_for);
+    write_skipped: писать пропущенные строки (WRITE_SKIPPED; False — только
+    считать, тогда строки читаются в две фазы, см. write_filtered_rows);
+    consolidate: сводный выход вместо выхода по файлам — "all" или "le"
+    (CONSOLIDATE; см. ConsolidatedOutput и run_batch).
+    """
+    engine: str = None
+    matcher: str = None
+    output_format: str = None
+    out_dir: str = None
+    parse_cache_dir: str = None
+    le_groups: dict = None
+    profile_dir: str = None
+    layout_config: dict = None
+    chunk_rows: int = None
+    max_memory_mb: int = None
+    sheets: tuple = None
+    le_in_text: bool = None
+    reader: str = None
+    pipeline_depth: int = None
+    write_skipped: bool = None
+    consolidate: str = None
+
+    def __post_init__(self):
+        self.consolidate = self.consolidate or CONSOLIDATE
+        self.write_skipped = WRITE_SKIPPED if self.write_skipped is None else self.write_skipped
+        self.pipeline_depth = PIPELINE_DEPTH if self.pipeline_depth is None else max(0, self.pipeline_depth)
+        self.engine = self.engine or ENGINE
+        self.reader = self.reader or READER
+        self.le_in_text = LE_IN_TEXT if self.le_in_text is None else self.le_in_text
+        self.sheets = tuple(self.sheets) if self.sheets else SHEETS
+        self.matcher = self.matcher or MATCHER
+        self.output_format = self.output_format or OUTPUT_FORMAT
+        self.out_dir = self.out_dir or OUT_DIR
+        self.layout_config = self.layout_config or load_layout_config()
+        if self.le_groups and self.engine == "template":
+            # TemplateSheetWriter пишет прямо в исходный лист — выходы групп перезаписывали бы друг друга
+            raise ValueError("режим групп LE не работает с движком template")
+
+@dataclass
+class FileResult:
+    """
+    Итог обработки одного файла (листа многолистовой книги). sheet — лист
+    (None — единственный лист книги); error_rows — строки ошибок [файл, строка, описание],
+    ещё не перенесённые в общий errors; skipped_part — книга-часть с пропущенными
+    строками (xlsx), ещё не слитая в общий skipped; metrics — этапы (см. record_stage);
+    cached — результат взят из манифеста --incremental; failed — файл не обработан.
+    """
+    file_name: str
+    filtered: int = 0
+    skipped: int = 0
+    errors: int = 0
+    error_rows: list = field(default_factory=list)
+    skipped_part: str = None
+    group_counts: dict = field(default_factory=dict)
+    metrics: dict = field(default_factory=dict)
+    cached: bool = False
+    failed: bool = False
+    sheet: str = None
+
+    @property
+    def counts(self) -> tuple:
+        return self.filtered, self.skipped, self.errors
+
+    @property
+    def label(self) -> str:
+        return sheet_label(self.file_name, self.sheet)
+
+@dataclass
+class BatchResult:
+    """
+    Итог обработки набора файлов: результаты по файлам в порядке входа, общие
+    счётчики, отобранные строки по группам (режим групп) и метрики этапов запуска.
+    """
+    files: list = field(default_factory=list)
+    filtered: int = 0
+    skipped: int = 0
+    errors: int = 0
+    group_totals: dict = None
+    metrics: dict = field(default_factory=dict)
+
+    def add(self, result: FileResult):
+        self.files.append(result)
+        self.filtered += result.filtered
+        self.skipped += result.skipped
+        self.errors += result.errors
+        if self.group_totals is not None:
+            for group, count in result.group_counts.items():
+                self.group_totals[group] = self.group_totals.get(group, 0) + count
+
+def chunk_rows_for(options: FilterOptions, ncols: int) -> int:
+    """
+    Размер окна строк для листа шириной ncols. Без бюджета памяти — chunk_rows
+    или MATCH_BATCH_ROWS. С бюджетом — сколько строк помещается в
+    max_memory_mb за вычетом MEMORY_BASELINE_MB по оценке CELL_BYTES_ESTIMATE
+    байт на ячейку (но не больше chunk_rows, если он задан, и не меньше MIN_CHUNK_ROWS).
+    С конвейером бюджет делится на все окна в работе: по depth в двух очередях
+    и по одному у потоков чтения, отбора и записи (см. pipeline_depth_for).
+    """
+    if not options.max_memory_mb:
+        return options.chunk_rows or MATCH_BATCH_ROWS
+    depth = pipeline_depth_for(options)
+    windows = 2 * depth + 3 if depth else 1
+    budget = (options.max_memory_mb - MEMORY_BASELINE_MB) * 1024 * 1024
+    rows = budget // (max(ncols, 1) * CELL_BYTES_ESTIMATE * windows)
+    if options.chunk_rows:
+        rows = min(rows, options.chunk_rows)
+    return max(int(rows), MIN_CHUNK_ROWS)
+
+# ========== Основная логика обработки одного файла ==========
+def write_filtered_rows(file_path: str, le_set: set, skipped_wb: Workbook, errors_ws,
+                        options: FilterOptions = None, group_counts: dict = None, metrics: dict = None,
+                        sheet: str = None, consolidated: ConsolidatedOutput = None):
+    """
+    Читает лист sheet xlsx файла (None — активный лист) один раз и по мере
+    чтения строк решает, куда их записать: в выходной xlsx (options.out_dir,
+    имя — см. sheet_output_name), на лист skipped или в errors.
+    Стили ячеек сохраняются. options — см. FilterOptions (None — по умолчанию).
+    group_counts (если передан) накапливает число отобранных строк по группам.
+    metrics: {этап: {"seconds", "rows", "peak_rss_mb"}} — если передан,
+    накапливает время, строки и пиковую память по этапам (см. record_stage).
+    Строки читаются, сопоставляются, преобразуются и пишутся окнами по
+    chunk_rows_for(options, ширина листа) строк; окно отпускается до чтения
+    следующего, так что память зависит от размера окна, а не файла.
+    Чтение и запись окон идут конвейером (см. pipeline_depth_for): следующие
+    окна читаются в отдельном потоке, пока текущее сопоставляется, а
+    записи отобранных и пропущенных строк выполняет поток записи.
+    При формате, отличном от xlsx, выход пишется без стилей через TableWriter,
+    пропущенные строки — в <out_dir>/skipped/<файл>.<формат>, а skipped_wb
+    не используется. С consolidated (см. ConsolidatedOutput) отобранные
+    строки пишутся в сводный выход, а выходной файл листа не создаётся.
+    Возвращает (filtered_count, skipped_count, error_count).
+    """
+    options = options or FilterOptions()
+    engine = options.engine
+    matcher = options.matcher
+    output_format = options.output_format
+    out_dir = options.out_dir
+    le_groups = options.le_groups
+    groups_by_le = {}
+    if le_groups:
+        for group, group_le_set in le_groups.items():
+            for le in group_le_set:
+                groups_by_le.setdefault(le, []).append(group)
+        le_set = set(groups_by_le)
+    file_name = sheet_label(Path(file_path).name, sheet)  # в логах и errors — с листом
+    log_md(f"Начинаю обработку файла: **{file_name}**", "INFO")
+
+    # 1) Открываем источник строк (один разбор файла на всю обработку)
+    started = time.perf_counter()
+    try:
+        source = open_row_source(file_path, engine, options.parse_cache_dir, options.layout_config, sheet,
+                                 options.reader)
+        record_stage(metrics, "open", started)
+    except Exception as e:
+        logger.exception("Ошибка при чтении %s: %s", file_name, e)
+        errors_ws.append([file_name, "", f"Ошибка чтения файла: {e}"])
+        return 0, 0, 1
+
+    try:
+        # 2) Заголовок — первая непустая строка (находится при открытии источника)
+        if source.header_cells is None:
+            if sheet is not None:
+                # Пустой лист многолистовой книги (например, пустой «Лист2») — не ошибка
+                log_list_item(f"Лист {file_name} пустой — пропущен")
+                return 0, 0, 0
+            logger.warning("Файл %s пустой.", file_name)
+            errors_ws.append([file_name, "", "Файл пустой"])
+            return 0, 0, 1
+        header_cells = source.header_cells
+        header_values = source.header_values
+        if source.preamble_rows:
+            log_list_item(f"Заголовок в строке {source.header_row}, строк над ним пропущено: {source.preamble_rows}")
+
+        # Колонки суммы, даты и маркера LE — по именам в заголовке (раскладка кэшируется)
+        layout, _ = detect_layout(header_values, options.layout_config)
+        amount_col, date_col = layout.amount_col, layout.date_col
+        log_list_item(f"Колонки: {layout.describe()}")
+        chunk_rows = chunk_rows_for(options, source.ncols)
+        if options.chunk_rows or options.max_memory_mb:
+            log_list_item(f"Окно обработки: {chunk_rows} строк")
+
+        # Счётчики
+        filtered_count = 0
+        skipped_count = 0
+        error_count = 0
+        outs = {}  # группа (None без режима групп) -> выходной лист
+        skipped_out = None
+        style_cache = {}  # общий для выходного листа и skipped; живёт, пока открыт источник
+
+        # Логируем начало построчной обработки
+        log_list_item(f"Начинаю построчную обработку данных для {file_name}")
+
+        # Без записи пропущенных строк — две фазы: для решения разбираются только
+        # нужные ему колонки (см. ColumnLayout.decision_cols), строка целиком — лишь перед записью
+        write_skipped = options.write_skipped
+        two_phase = False
+        if not write_skipped:
+            decision_cols = layout.decision_cols(options.le_in_text)
+            two_phase = source.project(decision_cols)
+            if two_phase:
+                log_list_item("Чтение в две фазы: сначала колонки для отбора, строки целиком — только для записи")
+            elif options.le_in_text:
+                log_list_item("Чтение в две фазы не используется: коды LE ищутся в тексте всех ячеек (--le-in-text)")
+            elif decision_cols is None:
+                log_list_item("Чтение в две фазы не используется: колонки маркера LE не заданы или не найдены "
+                              "в заголовке (le_marker в --layout), маркер ищется во всей строке")
+            else:
+                log_list_item("Чтение в две фазы не используется: строки разбираются целиком "
+                              "(читатель openpyxl, чтение или запись кэша разбора)")
+
+        # 4) Проходим строки блоками по мере чтения и решаем, записывать ли их в выходной файл;
+        # окна читаются наперёд в потоке чтения, записи окна выполняет поток записи
+        depth = pipeline_depth_for(options)
+        batches = prefetch(iter_batches(source.data_rows(), chunk_rows), depth, metrics, "read")
+        writer = StageWorker(depth, metrics, "write")
+        try:
+            if consolidated is not None:
+                # Сводный выход общий для всех файлов: его записи идут в потоке записи, по порядку
+                writer.submit(consolidated.begin_source, header_cells, header_values, layout, style_cache, file_name)
+            for batch in timed_batches(batches, metrics, "read"):
+                started = time.perf_counter()
+                decisions = classify_rows([values for _, _, values in batch], le_set, matcher, layout.le_cols,
+                                          options.le_in_text)
+                record_stage(metrics, "match", started, len(batch))
+
+                # Суммы и даты совпавших строк преобразуются пакетно, одним проходом по колонке
+                started = time.perf_counter()
+                matched = [i for i, decision in enumerate(decisions) if decision[0] == "match"]
+                amounts, amount_errors = convert_amounts(
+                    [batch[i][2][amount_col] if amount_col < len(batch[i][2]) else None for i in matched])
+                dates = convert_dates(
+                    [batch[i][2][date_col] if date_col < len(batch[i][2]) else None for i in matched])
+                conversions = dict(zip(matched, zip(amounts, amount_errors, dates)))
+                record_stage(metrics, "convert", started, len(matched))
+
+                started = time.perf_counter()
+                ops = []  # записи окна по порядку: (метод записи, ячейки, значения) — их выполняет поток записи
+                for i, ((row_number, cells, values), (status, error_desc, le_value)) in enumerate(
+                        zip(batch, decisions)):
+                    if two_phase and status == "match":
+                        # Вторая фаза: строка пойдёт в запись — разбираем её целиком
+                        cells, values = source.materialize(cells, values)
+                    # Если найдено совпадение — записываем строку в выходной лист
+                    if status == "match":
+                        # Сумма: колонка суммы ожидается числом
+                        parsed_amount, amt_err, parsed_date = conversions[i]
+                        if not amt_err:
+                            values[amount_col] = parsed_amount
+                            if date_col < len(values):
+                                if isinstance(parsed_date, str):
+                                    logger.debug("Не удалось преобразовать дату '%s' в datetime (файл %s, строка %s)",
+                                                 parsed_date, file_name, row_number)
+                                values[date_col] = parsed_date
+                            if consolidated is not None:
+                                ops.append((partial(consolidated.write_row, le_value), cells, values))
+                                filtered_count += 1
+                                continue
+                            # le_value — все коды LE строки: она идёт в каждую группу любого из них
+                            for group in dict.fromkeys(group for code in le_value
+                                                       for group in groups_by_le.get(code, [None])):
+                                out = outs.get(group)
+                                if out is None:
+                                    # 3) Выходной лист создаётся при первом совпадении; заголовок со стилем исходного
+                                    if output_format != "xlsx":
+                                        out = TableWriter(output_format, tmp_dir=out_dir, layout=layout,
+                                                          flush_rows=min(TABLE_FLUSH_ROWS, chunk_rows))
+                                    elif engine == "template":
+                                        out = TemplateSheetWriter(source.wb, source.ws, style_cache, layout)
+                                    elif engine == "zip":
+                                        out = open_zip_writer(file_path, sheet, source, style_cache, layout, out_dir)
+                                    else:
+                                        out = StreamSheetWriter(source.title, style_cache, layout=layout)
+                                    ops.append((out.write_header, header_cells, header_values))
+                                    outs[group] = out
+                                write = out.write_row
+                                if isinstance(out, ZipSheetWriter):
+                                    # Движок zip переносит объединения, проверки и т.п. по исходному номеру строки
+                                    write = partial(out.write_row, source_row=row_number)
+                                ops.append((write, cells, values))
+                            filtered_count += 1
+                            continue
+                        # Ошибка суммы: записываем в errors_ws, строка уходит в skipped
+                        status, error_desc = "error", amt_err
+                        logger.warning("Ошибка суммы в %s строка %s: %s", file_name, row_number, amt_err)
+                    elif status == "error":
+                        logger.warning("Строка %s пропущена с ошибкой: %s", row_number, error_desc)
+
+                    if status == "error":
+                        errors_ws.append([file_name, str(row_number), error_desc])
+                        error_count += 1
+
+                    # 5) Пропускаем строку — пишем её на лист skipped (лист создаётся при первой такой строке)
+                    skipped_count += 1
+                    if not write_skipped:
+                        continue
+                    if skipped_out is None:
+                        if output_format != "xlsx":
+                            skipped_out = TableWriter(output_format, typed=False, tmp_dir=out_dir,
+                                                      flush_rows=min(TABLE_FLUSH_ROWS, chunk_rows))
+                        else:
+                            skipped_out = StreamSheetWriter(skipped_sheet_title(Path(file_path).name, sheet),
+                                                            style_cache, skipped_wb, apply_formats=False)
+                        ops.append((skipped_out.write_header, header_cells, header_values))
+                    ops.append((skipped_out.write_row, cells, values))
+                record_stage(metrics, "route", started, len(batch))
+                writer.submit(write_window, ops, metrics, len(batch))
+                del batch, decisions, matched, amounts, amount_errors, dates, conversions, ops
+            writer.join()
+        finally:
+            # Потоки этапов останавливаются до закрытия источника (finally ниже)
+            batches.close()
+            writer.join(raise_error=False)
+
+        if skipped_out is not None:
+            log_list_item(f"Создаю лист skipped для {file_name}, строк: {skipped_count}")
+            if output_format != "xlsx":
+                # Без общей книги skipped: пропущенные строки файла — отдельный файл в out/skipped/
+                skipped_path = os.path.join(out_dir, SKIPPED_DIR,
+                                            sheet_output_name(Path(file_path).name, sheet, output_format))
+                os.makedirs(os.path.dirname(skipped_path), exist_ok=True)
+                started = time.perf_counter()
+                try:
+                    skipped_out.save(skipped_path)
+                    record_stage(metrics, "save_skipped", started, skipped_count)
+                except Exception as e:
+                    logger.exception("Ошибка при сохранении %s: %s", skipped_path, e)
+                    errors_ws.append([file_name, "", f"Ошибка сохранения: {e}"])
+                    error_count += 1
+
+        # 6) Сохраняем выходные файлы (только если есть отфильтрованные строки)
+        out_name = sheet_output_name(Path(file_path).name, sheet, output_format)
+        for group, out in outs.items():
+            if group is None:
+                out_file_path = os.path.join(out_dir, out_name)
+            else:
+                out_file_path = os.path.join(out_dir, group_dir_name(group), out_name)
+                if group_counts is not None:
+                    group_counts[group] = group_counts.get(group, 0) + out.rows_written
+            os.makedirs(os.path.dirname(out_file_path), exist_ok=True)
+            started = time.perf_counter()
+            try:
+                out.save(out_file_path)
+                record_stage(metrics, "save", started, out.rows_written)
+                log_list_item(f"Файл сохранён: {out_file_path} (строк: {out.rows_written})")
+            except Exception as e:
+                logger.exception("Ошибка при сохранении %s: %s", out_file_path, e)
+                errors_ws.append([file_name, "", f"Ошибка сохранения: {e}"])
+                error_count += 1
+        if consolidated is not None:
+            log_list_item(f"Строк {file_name} в сводном выходе: {filtered_count}")
+        elif not outs:
+            log_list_item(f"В файле {file_name} нет строк для записи. Выходной файл не создан.")
+    finally:
+        source.close()
+    peak = peak_rss_mb()
+    if options.max_memory_mb and peak is not None and peak > options.max_memory_mb:
+        logger.warning("Пиковая память процесса %s МБ превысила --max-memory %s МБ (файл %s)",
+                       peak, options.max_memory_mb, file_name)
+
+    # 7) Итоги для файла
+    log_md(f"Итог **{file_name}** — Отфильтровано: **{filtered_count}**, Пропущено: **{skipped_count}**, Ошибок: **{error_count}**", "INFO")
+    log_md("", "INFO")  # Пустая строка для разделения абзацев
+
+    return filtered_count, skipped_count, error_count
+
+# ========== Обработка файла и набора файлов ==========
+def filter_file(file_path: str, le_set: set, options: FilterOptions = None, part_path: str = None,
+                sheet: str = None) -> FileResult:
+    """
+    Обрабатывает один файл или лист sheet многолистовой книги (в рабочем
+    процессе пула или в основном процессе).
+    Выходные файлы пишутся в options.out_dir. Пропущенные строки пишутся в
+    собственную книгу-часть, которая сохраняется в part_path (или во временный
+    xlsx) — см. FileResult.skipped_part; строки ошибок, счётчики и метрики
+    этапов возвращаются в FileResult. При формате, отличном от xlsx, части нет:
+    skipped файла пишется сразу в <out_dir>/skipped/.
+    """
+    options = options or FilterOptions()
+    result = FileResult(Path(file_path).name, sheet=sheet)
+    part_wb = Workbook(write_only=True)
+    try:
+        # errors_ws в write_filtered_rows нужен только append()
+        counts = run_profiled(options.profile_dir, result.label, write_filtered_rows, file_path, le_set, part_wb,
+                              result.error_rows, options, result.group_counts, result.metrics, sheet)
+        result.filtered, result.skipped, result.errors = counts
+        if part_wb.sheetnames:
+            if part_path is None:
+                fd, part_path = tempfile.mkstemp(prefix="skipped_part_", suffix=".xlsx")
+                os.close(fd)
+            started = time.perf_counter()
+            part_wb.save(part_path)
+            record_stage(result.metrics, "save_skipped_part", started, result.skipped)
+            result.skipped_part = part_path
+    finally:
+        # Рабочий процесс пула завершается без atexit: сбрасываем лог после каждого файла
+        flush_logging()
+    return result
+
+def merge_skipped_part(part_path: str, skipped_wb: Workbook, remove: bool = True):
+    """
+    Переносит листы из книги-части в общий skipped_wb (со стилями).
+    Часть читается потоком (read_only) и строка за строкой дописывается
+    в write_only-книгу, так что в памяти не держится ни часть, ни skipped_wb.
+    Временный файл части удаляется, если remove=True.
+    """
+    part_wb = None
+    try:
+        part_wb = load_workbook(part_path, read_only=True)
+        style_cache = {}
+        for src_ws in part_wb.worksheets:
+            dest = StreamSheetWriter(src_ws.title, style_cache, skipped_wb, apply_formats=False)
+            for cells in src_ws.iter_rows():
+                dest.write_row(cells, [cell.value for cell in cells])
+    finally:
+        if part_wb is not None:
+            part_wb.close()
+        if remove:
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+
+def warm_up():
+    """
+    Заранее импортирует тяжёлые модули обработки (pandas, numpy), чтобы первый
+    файл не платил за их загрузку. Выполняется в основном процессе и в рабочих.
+    """
+    import numpy  # noqa: F401
+    import pandas  # noqa: F401
+
+def start_pool(workers: int, warm: bool = False) -> ProcessPoolExecutor:
+    """
+    Пул процессов обработки. warm=True — рабочие процессы запускаются сразу
+    и импортируют тяжёлые модули (см. warm_up), не дожидаясь первого файла.
+    """
+    # Рабочие процессы ведут лог, только если он настроен здесь (main), а не при импорте
+    console_mode = CONSOLE_MODE if log_listener is not None else None
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(console_mode,))
+    if warm:
+        for future in [pool.submit(warm_up) for _ in range(workers)]:
+            future.result()
+    return pool
+
+def failed_file_result(file_path: str, sheet: str, e: Exception) -> FileResult:
+    """
+    Итог файла (листа), обработка которого прервалась исключением e: одна
+    строка ошибки в error_rows и failed=True. Пишет исключение в лог.
+    """
+    result = FileResult(Path(file_path).name, errors=1, failed=True, sheet=sheet)
+    logger.exception("Ошибка обработки %s: %s", result.label, e)
+    result.error_rows = [[result.label, "", f"Ошибка обработки файла: {e}"]]
+    return result
+
+def iter_file_results(jobs: list, le_set: set, options: FilterOptions, workers: int, part_paths: dict = None,
+                      pool: ProcessPoolExecutor = None):
+    """
+    Обрабатывает задания (файл, лист) — см. plan_sheet_jobs — через filter_file:
+    в пуле процессов, если workers > 1 или передан готовый pool (тогда листы
+    одной книги обрабатываются параллельно), — и отдаёт (file_path, FileResult)
+    строго в порядке jobs, поэтому skipped.xlsx, errors.xlsx и итоги
+    не зависят от того, какой лист обработался первым.
+    part_paths: {(file_path, лист): путь книги-части skipped} (иначе временные файлы).
+    """
+    part_paths = part_paths or {}
+
+    if pool is not None or (workers > 1 and len(jobs) > 1):
+        own_pool = pool is None
+        if own_pool:
+            pool = start_pool(workers)
+        try:
+            futures = [pool.submit(filter_file, fp, le_set, options, part_paths.get((fp, sheet)), sheet)
+                       for fp, sheet in jobs]
+            for (fp, sheet), future in zip(jobs, futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = failed_file_result(fp, sheet, e)
+                yield fp, result
+        finally:
+            if own_pool:
+                pool.shutdown()
+    else:
+        # Следующие входные файлы читаются наперёд в отдельном потоке (см. read_ahead)
+        inputs = prefetch(read_ahead(jobs), options.pipeline_depth)
+        try:
+            for fp, sheet in inputs:
+                log_header(f"Обработка файла: {sheet_label(Path(fp).name, sheet)}", 2)
+                try:
+                    result = filter_file(fp, le_set, options, part_paths.get((fp, sheet)), sheet)
+                except Exception as e:
+                    result = failed_file_result(fp, sheet, e)
+                yield fp, result
+        finally:
+            inputs.close()
+
+def merge_file_result(batch: BatchResult, result: FileResult, skipped_wb: Workbook, errors_ws,
+                      remove_part: bool = True):
+    """
+    Сливает результат одного файла в общие skipped_wb и errors_ws и добавляет
+    его в batch. Перенесённые строки ошибок в result не сохраняются.
+    """
+    for error_row in result.error_rows:
+        errors_ws.append(error_row)
+    result.error_rows = []
+    if result.skipped_part:
+        merge_skipped_part(result.skipped_part, skipped_wb, remove=remove_part)
+    batch.add(result)
+
+def new_batch(options: FilterOptions) -> BatchResult:
+    """
+    Пустой итог набора файлов (в режиме групп — с нулевыми счётчиками всех групп).
+    """
+    return BatchResult(group_totals={group: 0 for group in options.le_groups} if options.le_groups else None)
+
+def save_batch_outputs(batch: BatchResult, skipped_wb: Workbook, errors_ws, options: FilterOptions,
+                       consolidated: ConsolidatedOutput = None):
+    """
+    Сохраняет сводный выход (если задан), общие skipped (если есть листы) и
+    errors (если были ошибки) в options.out_dir; время сохранения — этапы
+    save_consolidated, save_skipped и save_errors batch.metrics.
+    """
+    os.makedirs(options.out_dir, exist_ok=True)
+    if consolidated is not None:
+        started = time.perf_counter()
+        try:
+            saved = consolidated.save()
+            record_stage(batch.metrics, "save_consolidated", started, consolidated.rows_written)
+            for path, rows in saved:
+                log_list_item(f"Файл сохранён: {path} (строк: {rows})")
+        except Exception as e:
+            logger.exception("Ошибка при сохранении сводного выхода: %s", e)
+
+    if skipped_wb.sheetnames:
+        started = time.perf_counter()
+        try:
+            skipped_out_path = os.path.join(options.out_dir, SKIPPED_FILE)
+            skipped_wb.save(skipped_out_path)
+            record_stage(batch.metrics, "save_skipped", started, batch.skipped)
+            logger.info("Сохранён файл с пропущенными строками: %s", skipped_out_path)
+        except Exception as e:
+            logger.exception("Ошибка при сохранении skipped.xlsx: %s", e)
+
+    if batch.errors > 0:
+        try:
+            errors_out_path = os.path.join(options.out_dir, output_file_name(ERRORS_FILE, options.output_format))
+            started = time.perf_counter()
+            errors_ws.save(errors_out_path)
+            record_stage(batch.metrics, "save_errors", started, batch.errors)
+            logger.info("Сохранён файл ошибок: %s", errors_out_path)
+        except Exception as e:
+            logger.exception("Ошибка при сохранении errors.xlsx: %s", e)
+    else:
+        logger.info("Ошибок не обнаружено. Файл %s не создан.", ERRORS_FILE)
+
+def run_batch(in_files: list, le_set: set, options: FilterOptions = None, workers: int = 1) -> BatchResult:
+    """
+    Обрабатывает рабочие листы файлов (options.sheets) по порядку (в пуле
+    процессов при workers > 1) и сохраняет общие skipped и errors
+    в options.out_dir. Со сводным выходом (options.consolidate) файлы
+    обрабатываются в основном процессе: строки пишутся в общие книги
+    ConsolidatedOutput сразу, без частей. Возвращает BatchResult.
+    """
+    options = options or FilterOptions()
+    batch = new_batch(options)
+    jobs = plan_sheet_jobs(in_files, options.sheets)
+    # skipped.xlsx и errors.xlsx — write_only-книги: строки уходят во временные
+    # файлы листов по мере обработки, а не копятся в памяти
+    skipped_wb = Workbook(write_only=True)
+    errors_ws = ErrorsSheet(options.output_format, options.out_dir)
+    consolidated = ConsolidatedOutput(options.consolidate, options.out_dir) if options.consolidate else None
+    if consolidated is not None and workers > 1:
+        log_list_item("Сводный выход пишется в основном процессе — --workers не используется")
+
+    started = time.perf_counter()
+    if workers > 1 and len(jobs) > 1 and consolidated is None:
+        for index, (fp, result) in enumerate(iter_file_results(jobs, le_set, options, workers), start=1):
+            merge_file_result(batch, result, skipped_wb, errors_ws)
+            log_progress(index, len(jobs), result.label, result.counts)
+        log_file_separator()
+    else:
+        # В одном процессе пропущенные строки и ошибки пишутся сразу в общие книги, без частей;
+        # следующие входные файлы тем временем читаются наперёд (см. read_ahead)
+        inputs = prefetch(read_ahead(jobs), options.pipeline_depth, batch.metrics, "input")
+        try:
+            for index, (fp, sheet) in enumerate(inputs, start=1):
+                result = FileResult(Path(fp).name, sheet=sheet)
+                log_header(f"Обработка файла: {result.label}", 2)
+                try:
+                    result.filtered, result.skipped, result.errors = run_profiled(
+                        options.profile_dir, result.label, write_filtered_rows, fp, le_set, skipped_wb, errors_ws,
+                        options, result.group_counts, result.metrics, sheet, consolidated)
+                except Exception as e:
+                    # Как в пуле (см. iter_file_results): файл — ошибка, остальные обрабатываются дальше
+                    result = failed_file_result(fp, sheet, e)
+                merge_file_result(batch, result, skipped_wb, errors_ws)
+                log_progress(index, len(jobs), result.label, result.counts)
+                log_file_separator()  # Добавляем разделитель между файлами
+        finally:
+            inputs.close()
+    record_stage(batch.metrics, "files", started, batch.filtered + batch.skipped)
+
+    save_batch_outputs(batch, skipped_wb, errors_ws, options, consolidated)
+    return batch
+
+# ========== Инкрементальный режим ==========
+def file_sha256(path: str) -> str:
+    """
+    SHA-256 содержимого файла (читается блоками по 1 МБ).
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def le_set_hash(le_set: set) -> str:
+    """
+    Хэш нормализованного набора LE (не зависит от порядка строк в LE.txt).
+    """
+    return hashlib.sha256("\n".join(sorted(le_set)).encode("utf-8")).hexdigest()
+
+def load_manifest(out_dir: str = OUT_DIR) -> dict:
+    """
+    Читает манифест прошлого запуска из out_dir. При отсутствии или
+    повреждении манифеста возвращает пустой — тогда обрабатываются все файлы.
+    """
+    path = os.path.join(out_dir, MANIFEST_FILE)
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            manifest = json.load(fh)
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning("Не удалось прочитать манифест %s: %s", path, e)
+    return {"version": MANIFEST_VERSION, "settings": {}, "files": {}}
+
+def save_manifest(manifest: dict, out_dir: str = OUT_DIR):
+    """
+    Атомарно записывает манифест в out_dir.
+    """
+    path = os.path.join(out_dir, MANIFEST_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def is_input_unchanged(file_path: str, entry: dict) -> bool:
+    """
+    Проверяет входной файл по записи манифеста. Совпали размер и mtime —
+    файл не менялся; совпал только размер — сверяется хэш содержимого
+    (при совпадении в записи обновляется mtime).
+    """
+    stat = os.stat(file_path)
+    if stat.st_size != entry.get("size"):
+        return False
+    if stat.st_mtime == entry.get("mtime"):
+        return True
+    if file_sha256(file_path) != entry.get("sha256"):
+        return False
+    entry["mtime"] = stat.st_mtime
+    return True
+
+def plan_incremental_run(in_files: list, settings: dict, groups: list = (), pending: list = (),
+                         out_dir: str = OUT_DIR) -> tuple:
+    """
+    Сравнивает in/ с манифестом прошлого запуска в out_dir (его кэш — <out_dir>/CACHE_DIR).
+    Возвращает (manifest, changed_files). Если изменился набор LE или
+    настройки обработки, изменёнными считаются все файлы, а out/ очищается
+    (прежние выходы могли быть в другом формате). Выходные файлы и кэш для
+    изменённых и исчезнувших входов, а также прежние skipped/errors удаляются —
+    они будут пересобраны. pending — имена файлов, которые есть в in/, но ещё
+    дописываются (режим --watch): исчезнувшими они не считаются, их записи
+    манифеста и выходы остаются до следующего цикла.
+    """
+    cache_dir = os.path.join(out_dir, CACHE_DIR)
+    manifest = load_manifest(out_dir)
+    if manifest["settings"] != settings:
+        manifest["files"] = {}
+        prepare_out_dir(out_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest["settings"] = settings
+    fmt = settings.get("format", OUTPUT_FORMAT)
+
+    names = {Path(fp).name for fp in in_files} | set(pending)
+    changed_files = []
+    for fp in in_files:
+        entry = manifest["files"].get(Path(fp).name)
+        if entry is None or not is_input_unchanged(fp, entry):
+            changed_files.append(fp)
+
+    stale = [name for name in manifest["files"] if name not in names]
+    stale += [Path(fp).name for fp in changed_files]
+    for name in stale:
+        entry = manifest["files"].pop(name, None)
+        if entry is None:
+            continue
+        paths = []
+        for sheet_entry in entry["sheets"]:
+            out_name = sheet_output_name(name, sheet_entry["sheet"], fmt)
+            paths += [os.path.join(out_dir, out_name), os.path.join(out_dir, SKIPPED_DIR, out_name)]
+            paths += [os.path.join(out_dir, group_dir_name(group), out_name) for group in groups]
+            if sheet_entry["skipped_part"]:
+                paths.append(os.path.join(cache_dir, sheet_entry["skipped_part"]))
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+    for name in (SKIPPED_FILE, ERRORS_FILE):
+        path = os.path.join(out_dir, output_file_name(name, fmt))
+        if os.path.exists(path):
+            os.remove(path)
+    return manifest, changed_files
+
+def manifest_entry(file_path: str, results: list) -> dict:
+    """
+    Запись манифеста для только что обработанного файла; results — FileResult
+    его листов в порядке обработки.
+    """
+    stat = os.stat(file_path)
+    return {
+        "sha256": file_sha256(file_path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sheets": [{
+            "sheet": result.sheet,
+            "counts": list(result.counts),
+            "errors": result.error_rows,
+            "skipped_part": os.path.basename(result.skipped_part) if result.skipped_part else None,
+            "group_counts": result.group_counts,
+        } for result in results],
+    }
+
+def cached_file_results(file_name: str, entry: dict, out_dir: str = OUT_DIR) -> list:
+    """
+    FileResult листов неизменившегося файла по записи манифеста в out_dir.
+    """
+    results = []
+    for sheet_entry in entry["sheets"]:
+        part = sheet_entry["skipped_part"]
+        filtered, skipped, errors = sheet_entry["counts"]
+        results.append(FileResult(file_name, filtered, skipped, errors, error_rows=list(sheet_entry["errors"]),
+                                  skipped_part=os.path.join(out_dir, CACHE_DIR, part) if part else None,
+                                  group_counts=sheet_entry["group_counts"], cached=True,
+                                  sheet=sheet_entry["sheet"]))
+    return results
+
+def run_incremental_batch(in_files: list, le_set: set, options: FilterOptions, workers: int = 1,
+                          pool: ProcessPoolExecutor = None, pending: list = ()) -> BatchResult:
+    """
+    Как run_batch, но обрабатывает только новые и изменённые файлы (см.
+    plan_incremental_run): результаты остальных берутся из манифеста и кэша
+    skipped-частей, общие skipped и errors пересобираются в порядке in_files.
+    pool — готовый пул процессов, pending — имена недописанных файлов (режим --watch).
+    """
+    if options.le_groups:
+        le_hash = le_set_hash({f"{group}\t{le}" for group, les in options.le_groups.items() for le in les})
+    else:
+        le_hash = le_set_hash(le_set)
+    settings = {"le_hash": le_hash, "engine": options.engine, "matcher": options.matcher,
+                "format": options.output_format, "layout": options.layout_config["key"],
+                "le_in_text": options.le_in_text, "write_skipped": options.write_skipped,
+                "sheets": list(options.sheets) if options.sheets else None}
+    manifest, changed_files = plan_incremental_run(in_files, settings, list(options.le_groups or ()), pending,
+                                                   options.out_dir)
+    log_list_item(f"Инкрементальный режим: изменено **{len(changed_files)}** из **{len(in_files)}** файлов")
+    jobs = plan_sheet_jobs(changed_files, options.sheets)
+    cache_dir = os.path.join(options.out_dir, CACHE_DIR)
+    part_paths = {(fp, sheet): os.path.join(cache_dir, sheet_output_name(Path(fp).name, sheet, "xlsx") + ".skipped.xlsx")
+                  for fp, sheet in jobs}
+
+    batch = new_batch(options)
+    skipped_wb = Workbook(write_only=True)
+    errors_ws = ErrorsSheet(options.output_format, options.out_dir)
+    started = time.perf_counter()
+    fresh_results = {fp: [] for fp in changed_files}  # файл без выбранных листов — пустой список
+    for fp, result in iter_file_results(jobs, le_set, options, workers, part_paths, pool):
+        fresh_results[fp].append(result)
+    for fp, results in fresh_results.items():
+        # Файлы с упавшим листом в манифест не попадают — в следующий раз обработаются снова
+        if not any(result.failed for result in results):
+            manifest["files"][Path(fp).name] = manifest_entry(fp, results)
+    save_manifest(manifest, options.out_dir)
+    log_file_separator()
+
+    # Сливаем результаты (свежие и из кэша) в порядке in_files и листов
+    results = []
+    for fp in in_files:
+        if fp in fresh_results:
+            results.extend(fresh_results[fp])
+        else:
+            log_list_item(f"Файл {Path(fp).name} не изменился — результаты взяты из кэша")
+            results.extend(cached_file_results(Path(fp).name, manifest["files"][Path(fp).name], options.out_dir))
+    for index, result in enumerate(results, start=1):
+        merge_file_result(batch, result, skipped_wb, errors_ws, remove_part=False)
+        log_progress(index, len(results), result.label, result.counts)
+    record_stage(batch.metrics, "files", started, batch.filtered + batch.skipped)
+
+    save_batch_outputs(batch, skipped_wb, errors_ws, options)
+    return batch
+
+# ========== Режим наблюдения за in/ ==========
+def scan_input_files(pattern: str = IN_PATTERN) -> dict:
+    """
+    Снимок входной папки: {путь: (размер, mtime)}. Файлы, исчезнувшие
+    между glob и stat, пропускаются.
+    """
+    snapshot = {}
+    for fp in glob.glob(pattern):
+        try:
+            stat = os.stat(fp)
+        except OSError:
+            continue
+        snapshot[fp] = (stat.st_size, stat.st_mtime)
+    return snapshot
+
+def ready_input_files(previous: dict, current: dict, now: float) -> dict:
+    """
+    Файлы, дописанные до конца: размер и mtime не изменились с прошлого
+    опроса и файл не менялся последние WATCH_SETTLE_SECONDS секунд.
+    """
+    return {fp: sig for fp, sig in current.items()
+            if previous.get(fp) == sig and now - sig[1] >= WATCH_SETTLE_SECONDS}
+
+def stop_on_sigterm(signum, frame):
+    """
+    SIGTERM (остановка службы) завершает наблюдение так же, как Ctrl+C.
+    """
+    raise KeyboardInterrupt
+
+def watch_input_dir(le_set: set, options: FilterOptions, workers: int, interval: float, report, parse_cache_max_mb: int):
+    """
+    Режим --watch: раз в interval секунд опрашивает in/ и, когда меняется набор
+    дописанных файлов (см. ready_input_files), пересобирает out/ инкрементально
+    (run_incremental_batch): обрабатываются только новые и изменённые файлы,
+    выходы исчезнувших удаляются, skipped и errors собираются заново из кэша.
+    Файлы обрабатываются заранее запущенным пулом (workers > 1) или основным
+    процессом с уже загруженными модулями. report(batch) — итоги цикла.
+    Работает до Ctrl+C или SIGTERM.
+    """
+    warm_up()
+    pool = start_pool(workers, warm=True) if workers > 1 else None
+    if hasattr(signal, "SIGTERM"):
+        # После запуска пула: рабочим процессам обработчик не нужен (см. init_worker)
+        signal.signal(signal.SIGTERM, stop_on_sigterm)
+    log_header("Наблюдение за папкой in/", 2)
+    log_list_item(f"Опрос раз в **{interval}** с; файл берётся в работу, когда не меняется "
+                  f"**{WATCH_SETTLE_SECONDS}** с; остановка — Ctrl+C")
+    previous = scan_input_files()  # первый опрос сравнивается с этим снимком
+    processed = None  # набор файлов последнего цикла: {путь: (размер, mtime)}
+    cycle = 0
+    try:
+        while True:
+            current = scan_input_files()
+            ready = ready_input_files(previous, current, time.time())
+            previous = current
+            if ready != processed:
+                cycle += 1
+                log_header(f"Цикл наблюдения {cycle}: файлов {len(ready)}", 2)
+                pending = [Path(fp).name for fp in current if fp not in ready]
+                batch = run_incremental_batch(sorted(ready), le_set, options, workers, pool, pending)
+                processed = ready
+                if options.parse_cache_dir:
+                    evict_parse_cache(options.parse_cache_dir, parse_cache_max_mb * 1024 * 1024)
+                report(batch)
+                if pool is not None and any(result.failed for result in batch.files):
+                    # Упавший рабочий процесс ломает весь пул — запускаем новый
+                    pool.shutdown(cancel_futures=True)
+                    pool = start_pool(workers, warm=True)
+                flush_logging()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        log_md(f"Наблюдение остановлено, циклов обработки: **{cycle}**", "INFO")
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+# ========== Точка входа ==========
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Фильтрация xlsx-файлов Диасофт по списку LE.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="число процессов для параллельной обработки файлов (по умолчанию 1)")
+    parser.add_argument("--engine", choices=["stream", "template", "zip"], default=ENGINE,
+                        help=f"движок обработки (по умолчанию {ENGINE}; zip — выход копированием архива "
+                             f"исходной книги, только xlsx)")
+    parser.add_argument("--reader", choices=["lean", "openpyxl"], default=READER,
+                        help=f"чтение xlsx движками stream и zip: разбор XML листа напрямую или openpyxl "
+                             f"(по умолчанию {READER}; что не читается напрямую, читает openpyxl)")
+    parser.add_argument("--matcher", choices=["compiled", "vector", "loop"], default=MATCHER,
+                        help=f"поиск LE: по всем маркерам строки с индексом LE.txt (compiled) или по первому "
+                             f"маркеру — векторный по блокам строк или построчный (по умолчанию {MATCHER})")
+    parser.add_argument("--le-in-text", action="store_true", default=LE_IN_TEXT,
+                        help="искать коды LE и внутри текста ячеек (только --matcher compiled)")
+    parser.add_argument("--no-skipped", dest="write_skipped", action="store_false", default=WRITE_SKIPPED,
+                        help="не писать пропущенные строки (skipped), только считать их; строки тогда "
+                             "разбираются целиком лишь для записи в выход")
+    parser.add_argument("--consolidate", choices=["all", "le"], default=CONSOLIDATE,
+                        help=f"сводный выход вместо файла на вход: все отобранные строки в {CONSOLIDATED_FILE} "
+                             f"(all) или книга на код LE в {CONSOLIDATED_LE_DIR}/ (le); только xlsx")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default=OUTPUT_FORMAT,
+                        help=f"формат выходных файлов, skipped и errors; кроме xlsx — без стилей "
+                             f"(по умолчанию {OUTPUT_FORMAT})")
+    parser.add_argument("--incremental", action="store_true",
+                        help="обрабатывать только новые и изменённые файлы (манифест и кэш в out/)")
+    parser.add_argument("--watch", action="store_true",
+                        help="не завершаться: следить за in/ и обрабатывать новые и изменённые файлы "
+                             "по мере появления (включает --incremental)")
+    parser.add_argument("--watch-interval", type=float, default=WATCH_INTERVAL, metavar="SEC",
+                        help=f"период опроса in/ в режиме --watch (по умолчанию {WATCH_INTERVAL} с)")
+    parser.add_argument("--le-files", nargs="+", metavar="FILE",
+                        help="режим групп: несколько списков LE, группа — имя файла без расширения")
+    parser.add_argument("--le-map", metavar="FILE",
+                        help="режим групп: файл соответствия 'LE;группа'")
+    parser.add_argument("--parse-cache", nargs="?", const=PARSE_CACHE_DIR, default=None, metavar="DIR",
+                        help=f"кэшировать разобранные входные файлы (по умолчанию в {PARSE_CACHE_DIR}/)")
+    parser.add_argument("--parse-cache-max-mb", type=int, default=PARSE_CACHE_MAX_MB,
+                        help=f"предельный размер кэша разбора в МБ (по умолчанию {PARSE_CACHE_MAX_MB})")
+    parser.add_argument("--chunk-rows", type=int, metavar="N",
+                        help=f"строк в окне обработки (по умолчанию {MATCH_BATCH_ROWS})")
+    parser.add_argument("--max-memory", type=int, metavar="MB",
+                        help="бюджет памяти на процесс: окно строк подбирается по ширине листа "
+                             "(только движок stream)")
+    parser.add_argument("--pipeline-depth", type=int, default=PIPELINE_DEPTH, metavar="N",
+                        help=f"окон в очередях между потоками чтения, отбора и записи и входных файлов, "
+                             f"читаемых наперёд (по умолчанию {PIPELINE_DEPTH}; 0 — без конвейера)")
+    parser.add_argument("--sheets", nargs="+", metavar="NAME",
+                        help="обрабатывать только листы с этими именами (по умолчанию все рабочие листы)")
+    parser.add_argument("--layout", metavar="FILE",
+                        help="JSON с именами или индексами колонок суммы, даты и маркера LE "
+                             "и числом строк для поиска заголовка (header_rows)")
+    parser.add_argument("--profile", nargs="?", const=PROFILE_DIR, default=None, metavar="DIR",
+                        help=f"дамп cProfile по каждому файлу (по умолчанию в {PROFILE_DIR}/)")
+    console_mode = parser.add_mutually_exclusive_group()
+    console_mode.add_argument("--progress", dest="console_mode", action="store_const", const="progress",
+                              help="в консоль — одна строка прогресса на файл вместо панели на сообщение")
+    console_mode.add_argument("--quiet", dest="console_mode", action="store_const", const="quiet",
+                              help="в консоль — только ошибки и итоговая статистика")
+    parser.set_defaults(console_mode=CONSOLE_MODE)
+    return parser.parse_args(argv)
+
+def report_batch(batch: BatchResult, run_metrics: dict, settings: dict):
+    """
+    Итоги обработки в log.md и консоль: общие счётчики, счётчики групп,
+    счётчики и время по листам многолистовых книг, таблица метрик этапов
+    (run_metrics — этапы запуска) и metrics.json.
+    """
+    file_metrics = {result.label: result.metrics for result in batch.files if not result.cached}
+
+    # Финальный лог и вывод в консоль статистики
+    log_header("Обработка завершена", 2)
+    log_table(["Показатель", "Количество"],
+                [["Отфильтровано", batch.filtered],
+                 ["Пропущено", batch.skipped],
+                 ["Ошибок", batch.errors]])
+    log_md("", "INFO")  # Пустая строка для разделения абзацев
+    if batch.group_totals:
+        log_table(["Группа", "Отфильтровано"], [[group, count] for group, count in sorted(batch.group_totals.items())])
+        log_md("", "INFO")  # Пустая строка для разделения абзацев
+    sheet_results = [result for result in batch.files if result.sheet is not None]
+    if sheet_results:
+        log_header("Листы", 3)
+        log_table(["Файл", "Лист", "Отфильтровано", "Пропущено", "Ошибок", "Время, с"],
+                  [[result.file_name, result.sheet, *result.counts,
+                    f"{sum(entry['seconds'] for entry in result.metrics.values()):.3f}" if not result.cached else "кэш"]
+                   for result in sheet_results])
+        log_md("", "INFO")  # Пустая строка для разделения абзацев
+
+    # Метрики этапов: таблица в log.md и metrics.json
+    log_header("Метрики этапов", 3)
+    metrics_rows = metrics_table_rows("(запуск)", run_metrics)
+    for name, metrics in file_metrics.items():
+        metrics_rows.extend(metrics_table_rows(name, metrics))
+    log_table(["Файл", "Этап", "Время, с", "Строк", "Строк/с", "Peak RSS, МБ", "Очередь ср. / макс."], metrics_rows)
+    log_md("", "INFO")  # Пустая строка для разделения абзацев
+    save_metrics(run_metrics, file_metrics, settings)
+    log_md("---", "INFO")  # Разделитель
+
+    # Итоговая статистика в консоли
+    log_total_stats(batch.filtered, batch.skipped, batch.errors)
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(args.console_mode)
+    workers = max(1, args.workers)
+    args.incremental = args.incremental or args.watch
+    if args.incremental:
+        os.makedirs(os.path.join(OUT_DIR, CACHE_DIR), exist_ok=True)
+    else:
+        prepare_out_dir()
+    log_run_settings(workers, args.engine, args.format)
+
+    run_metrics = {}  # метрики этапов main(); по файлам — в file_metrics
+
+    # Логирование старта
+    log_header("Старт обработки в папке in/", 2)
+    if args.format != "xlsx" and args.engine in ("template", "zip"):
+        log_md(f"**Ошибка:** формат {args.format} работает только с движком stream — завершаю.", "ERROR")
+        return
+    if args.max_memory and args.engine == "template":
+        log_md("**Ошибка:** движок template загружает книгу целиком, --max-memory работает только с stream — завершаю.",
+               "ERROR")
+        return
+    if args.le_in_text and args.matcher != "compiled":
+        log_md("**Ошибка:** поиск LE в тексте ячеек работает только с --matcher compiled — завершаю.", "ERROR")
+        return
+    if args.consolidate and (args.format != "xlsx" or args.incremental or args.le_files or args.le_map):
+        log_md("**Ошибка:** сводный выход (--consolidate) пишется только в xlsx, без --incremental/--watch "
+               "и режима групп — завершаю.", "ERROR")
+        return
+    if args.format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        log_md("**Ошибка:** для формата parquet нужен pyarrow (pip install pyarrow) — завершаю.", "ERROR")
+        return
+    started = time.perf_counter()
+    le_groups = None
+    if args.le_files or args.le_map:
+        if args.engine == "template":
+            log_md("**Ошибка:** режим групп LE работает только с движком stream — завершаю.", "ERROR")
+            return
+        le_groups = load_le_groups(args.le_files, args.le_map)
+        le_set = set().union(*le_groups.values())
+    else:
+        le_set = load_le_set(LE_FILE)
+    if not le_set:
+        log_md("**Ошибка:** LE список пуст — завершаю.", "ERROR")
+        return
+    record_stage(run_metrics, "load_le", started)
+    try:
+        layout_config = load_layout_config(args.layout)
+    except ValueError as e:
+        log_md(f"**Ошибка:** настройки колонок: {e} — завершаю.", "ERROR")
+        return
+    if args.layout:
+        log_list_item(f"Настройки колонок взяты из `{args.layout}`")
+    options = FilterOptions(engine=args.engine, matcher=args.matcher, output_format=args.format,
+                            parse_cache_dir=args.parse_cache, le_groups=le_groups, profile_dir=args.profile,
+                            layout_config=layout_config, chunk_rows=args.chunk_rows, max_memory_mb=args.max_memory,
+                            sheets=args.sheets, le_in_text=args.le_in_text, reader=args.reader,
+                            pipeline_depth=args.pipeline_depth, write_skipped=args.write_skipped,
+                            consolidate=args.consolidate)
+    settings = {"engine": args.engine, "matcher": args.matcher, "workers": workers,
+                "incremental": args.incremental, "format": args.format, "consolidate": args.consolidate}
+
+    if args.watch:
+        watch_input_dir(le_set, options, workers, args.watch_interval,
+                        lambda batch: report_batch(batch, dict(batch.metrics), dict(settings, watch=True)),
+                        args.parse_cache_max_mb)
+        return
+
+    # Сортируем для детерминированного порядка листов и строк в skipped/errors
+    in_files = sorted(glob.glob(IN_PATTERN))
+    if not in_files:
+        log_md("**Ошибка:** Нет файлов в папке `in/`. Завершаю.", "ERROR")
+        return
+
+    log_header("Найденные файлы для обработки", 2)
+    log_list_item(f"Найдено **{len(in_files)}** файлов в папке `in/`")
+    if in_files:
+        log_table(["Файл"], [[Path(fp).name] for fp in in_files])
+        log_md("", "INFO")  # Пустая строка для разделения абзацев
+
+    # Обработка файлов; skipped и errors сохраняются в out/
+    if args.incremental:
+        batch = run_incremental_batch(in_files, le_set, options, workers)
+    else:
+        batch = run_batch(in_files, le_set, options, workers)
+    run_metrics.update(batch.metrics)
+
+    if args.parse_cache:
+        evict_parse_cache(args.parse_cache, args.parse_cache_max_mb * 1024 * 1024)
+
+    report_batch(batch, run_metrics, settings)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+generate_large_files.py
+Генерирует большие синтетические xlsx-файлы в формате выгрузки Диасофт
+для нагрузочной проверки filter_diasoft_acc_by_LE.py: дата в 4-й колонке
+(индекс 3), сумма в 8-й (индекс 7), маркер "LE" и аналитика в колонках
+LE_POSITIONS. Настраиваются число строк и колонок, разнообразие стилей,
+доля совпадений с LE-списком, доля некорректных сумм и строк без LE.
+Вместе с файлами пишется LE-список, по которому считается доля совпадений.
+"""
+
+import os
+import random
+import argparse
+import datetime
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
+
+# Колонки, фиксированные форматом выгрузки (см. AMOUNT_COL_IDX / DATE_COL_IDX в основном скрипте)
+DATE_COL_IDX = 3
+AMOUNT_COL_IDX = 7
+LE_POSITIONS = (1, 5, 10)  # индексы колонок, в которых может стоять маркер "LE"
+
+BAD_AMOUNTS = ("abc", "", "12.3.4", "-150,00", "сумма")
+FONT_COLORS = ("000000", "1F4E79", "C00000", "375623", "7030A0")
+FILL_COLORS = ("FFFFFF", "FFF2CC", "DDEBF7", "E2EFDA", "FCE4D6")
+
+
+def build_styles(count: int) -> list:
+    """
+    Строит count различных сочетаний стилей (шрифт, заливка, рамка, выравнивание).
+    """
+    thin = Side(style="thin")
+    styles = []
+    for i in range(count):
+        styles.append((
+            Font(bold=i % 2 == 1, italic=i % 3 == 2, color=FONT_COLORS[i % len(FONT_COLORS)]),
+            PatternFill("solid", fgColor=FILL_COLORS[(i // 2) % len(FILL_COLORS)]),
+            Border(left=thin, right=thin) if i % 4 < 2 else Border(bottom=thin),
+            Alignment(horizontal=("left", "center", "right")[i % 3]),
+        ))
+    return styles
+
+
+def styled(ws, value, style):
+    """
+    Ячейка write_only-листа со значением и стилем (style=None — без стиля).
+    """
+    if style is None:
+        return value
+    cell = WriteOnlyCell(ws, value=value)
+    cell.font, cell.fill, cell.border, cell.alignment = style
+    return cell
+
+
+def format_amount(rng: random.Random) -> object:
+    """
+    Корректная сумма в одном из встречающихся в выгрузках видов.
+    """
+    value = round(rng.uniform(1, 5_000_000), 2)
+    kind = rng.random()
+    if kind < 0.4:
+        return value
+    if kind < 0.7:
+        return f"{value:.2f}"
+    if kind < 0.9:
+        return f"{value:,.2f}".replace(",", " ").replace(".", ",")
+    return f"{value:,.2f}"
+
+
+def generate_file(path: str, rows: int, cols: int, le_codes: list, other_codes: list,
+                  match_ratio: float, bad_amount_ratio: float, no_le_ratio: float,
+                  le_positions: tuple, styles: list, styled_ratio: float, seed: int):
+    """
+    Пишет один файл: строка заголовка и rows строк данных.
+    """
+    rng = random.Random(seed)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Проводки")
+    header_style = (Font(bold=True), PatternFill("solid", fgColor="D9D9D9"), Border(), Alignment())
+    header = [f"Колонка {i + 1}" for i in range(cols)]
+    header[DATE_COL_IDX] = "Дата"
+    header[AMOUNT_COL_IDX] = "Сумма"
+    for pos in le_positions:
+        header[pos] = "Тип"
+        header[pos + 1] = "Аналитика"
+    ws.append([styled(ws, value, header_style) for value in header])
+
+    base_date = datetime.date(2024, 1, 1)
+    for r in range(rows):
+        values = [f"{rng.randrange(10 ** 19, 10 ** 20)}" if c % 2 == 0 else f"Текст {r}-{c}" for c in range(cols)]
+        day = base_date + datetime.timedelta(days=r % 365)
+        values[DATE_COL_IDX] = day.strftime("%d.%m.%Y") if r % 2 else datetime.datetime(day.year, day.month, day.day)
+        if rng.random() < bad_amount_ratio:
+            values[AMOUNT_COL_IDX] = rng.choice(BAD_AMOUNTS)
+        else:
+            values[AMOUNT_COL_IDX] = format_amount(rng)
+        if rng.random() >= no_le_ratio:
+            pos = rng.choice(le_positions)
+            values[pos] = "LE"
+            values[pos + 1] = rng.choice(le_codes if rng.random() < match_ratio else other_codes)
+
+        if styles and rng.random() < styled_ratio:
+            style_base = rng.randrange(len(styles))
+            row = [styled(ws, value, styles[(style_base + c) % len(styles)]) for c, value in enumerate(values)]
+        else:
+            row = values
+        ws.append(row)
+    wb.save(path)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Генерация больших xlsx-файлов в формате Диасофт.")
+    parser.add_argument("--rows", type=int, default=100_000, help="строк данных в файле")
+    parser.add_argument("--cols", type=int, default=20, help="колонок в файле (не меньше 12)")
+    parser.add_argument("--files", type=int, default=1, help="число файлов")
+    parser.add_argument("--out-dir", default="in", help="папка для файлов (по умолчанию in/)")
+    parser.add_argument("--prefix", default="bench", help="префикс имён файлов")
+    parser.add_argument("--styles", type=int, default=8, help="число различных стилей ячеек (0 — без стилей)")
+    parser.add_argument("--styled-ratio", type=float, default=0.5, help="доля строк со стилями")
+    parser.add_argument("--le-positions", default=",".join(map(str, LE_POSITIONS)),
+                        help="индексы колонок с маркером LE через запятую")
+    parser.add_argument("--le-count", type=int, default=50, help="размер LE-списка")
+    parser.add_argument("--match-ratio", type=float, default=0.1, help="доля строк с LE из списка")
+    parser.add_argument("--bad-amount-ratio", type=float, default=0.01, help="доля некорректных сумм")
+    parser.add_argument("--no-le-ratio", type=float, default=0.05, help="доля строк без маркера LE")
+    parser.add_argument("--le-file", default="LE_bench.txt", help="куда записать LE-список")
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    le_positions = tuple(int(p) for p in args.le_positions.split(",") if p.strip())
+    reserved = {DATE_COL_IDX, AMOUNT_COL_IDX}
+    for pos in le_positions:
+        if pos < 0 or pos + 1 >= args.cols or {pos, pos + 1} & reserved:
+            raise SystemExit(f"Позиция LE {pos} недопустима: нужны колонки {pos} и {pos + 1} "
+                             f"в пределах {args.cols} и не совпадающие с датой/суммой {sorted(reserved)}")
+
+    le_codes = [f"LE{i:05d}" for i in range(args.le_count)]
+    other_codes = [f"XX{i:05d}" for i in range(args.le_count)]
+    with open(args.le_file, "w", encoding="utf-8") as fh:
+        fh.write("\n".join(le_codes) + "\n")
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    styles = build_styles(args.styles)
+    for n in range(args.files):
+        path = os.path.join(args.out_dir, f"{args.prefix}_{n + 1:03d}.xlsx")
+        generate_file(path, args.rows, args.cols, le_codes, other_codes, args.match_ratio,
+                      args.bad_amount_ratio, args.no_le_ratio, le_positions, styles,
+                      args.styled_ratio, args.seed + n)
+        print(f"Создан {path}: {args.rows} строк x {args.cols} колонок")
+    print(f"LE-список ({len(le_codes)} LE) записан в {args.le_file}")
+
+
+if __name__ == "__main__":
+    main()
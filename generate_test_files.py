@@ -160,6 +160,29 @@ def create_invalid_data_file(filename):
     wb.save(os.path.join(IN_DIR, filename))
     print(f"Создан {filename}: с некорректными данными")
 
+def create_multiple_sheets_file(filename):
+    """Создаёт файл с проводками на двух листах и пустым третьим листом."""
+    wb = Workbook()
+    for ws, rows in ((wb.active, [('LE', 'TESTLE1', '2023-01-01', 1000), ('ДРУГОЙ', 'TEST', '2023-01-02', 2000)]),
+                     (wb.create_sheet('Проводки 2'), [('LE', 'TESTLE2', '2023-02-01', 3000), ('LE', 'UNKNOWN', '2023-02-02', 4000)])):
+        ws.append(['ТИП1', 'АНАЛИТИКА1', 'Дата', 'Сумма'])
+        for row in rows:
+            ws.append(list(row))
+    wb.active.title = 'Проводки 1'
+    wb.create_sheet('Пустой')
+    wb.save(os.path.join(IN_DIR, filename))
+    print(f"Создан {filename}: проводки на нескольких листах")
+
+def create_le_in_text_file(filename):
+    """Создаёт файл, где код LE есть только в тексте назначения платежа."""
+    wb = Workbook()
+    ws = wb.active
+    ws.append(['Дата', 'Назначение', 'Сумма'])
+    ws.append(['2023-01-01', 'Оплата по договору с TESTLE-1, НДС не облагается', 1000])
+    ws.append(['2023-01-02', 'Оплата по договору с TESTLE10', 2000])
+    wb.save(os.path.join(IN_DIR, filename))
+    print(f"Создан {filename}: код LE в тексте ячейки")
+
 if __name__ == "__main__":
     create_empty_file("test_empty.xlsx")
     create_no_columns_file("test_no_columns.xlsx")
@@ -169,4 +192,6 @@ if __name__ == "__main__":
     create_le_in_different_columns_file("test_le_different_columns.xlsx")
     create_empty_rows_file("test_empty_rows.xlsx")
     create_invalid_data_file("test_invalid_data.xlsx")
+    create_multiple_sheets_file("test_multiple_sheets.xlsx")
+    create_le_in_text_file("test_le_in_text.xlsx")
     print("Все тестовые файлы созданы в папке in/")
\ No newline at end of file
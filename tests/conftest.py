@@ -0,0 +1,66 @@
+import os
+import runpy
+import sys
+from pathlib import Path
+
+import pytest
+from openpyxl import load_workbook
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import filter_diasoft_acc_by_LE as flt  # noqa: E402
+
+TEST_LE = ("TESTLE1", "TESTLE2")
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """
+    Рабочая папка с in/ из generate_test_files.py и LE.txt с кодами TEST_LE.
+    """
+    monkeypatch.chdir(tmp_path)
+    runpy.run_path(str(ROOT / "generate_test_files.py"), run_name="__main__")
+    (tmp_path / "LE.txt").write_text("\n".join(TEST_LE) + "\n", encoding="utf-8")
+    yield tmp_path
+    flt.stop_logging()
+
+
+@pytest.fixture
+def run_main(workdir):
+    """
+    Запускает main с аргументами и переносит out/ в out_<name>; возвращает путь.
+    """
+    def run(name: str, *argv):
+        flt.main(["--quiet", *argv])
+        flt.flush_logging()
+        target = workdir / f"out_{name}"
+        os.replace(workdir / flt.OUT_DIR, target)
+        return target
+
+    return run
+
+
+def read_book(path) -> list:
+    """
+    Листы книги: [(имя, [[(значение, формат числа), ...], ...])].
+    """
+    wb = load_workbook(path)
+    try:
+        return [(ws.title, [[(cell.value, cell.number_format) for cell in row] for row in ws.iter_rows()])
+                for ws in wb.worksheets]
+    finally:
+        wb.close()
+
+
+def read_outputs(out_dir, skip=()) -> dict:
+    """
+    Все xlsx папки выходов (без служебных папок вида .cache): {относительный путь: read_book}.
+    """
+    books = {}
+    for path in sorted(Path(out_dir).rglob("*.xlsx")):
+        relative = path.relative_to(out_dir)
+        if any(part.startswith(".") for part in relative.parts) or relative.as_posix() in skip:
+            continue
+        books[relative.as_posix()] = read_book(path)
+    return books
@@ -0,0 +1,31 @@
+"""
+Преобразование колонки суммы: запятая — десятичный разделитель, кроме
+записи с разделителями разрядов и точкой в дробной части.
+"""
+import pytest
+
+from conftest import flt
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("1,234", 1.234),
+    ("1,5", 1.5),
+    ("1 234,56", 1234.56),
+    ("1\u00a0234,56", 1234.56),
+    ("1.234,5", 1234.5),
+    ("1,234,567.89", 1234567.89),
+    ("427680000.00", 427680000.0),
+    (1000, 1000.0),
+])
+def test_convert_amounts(raw, expected):
+    assert flt.convert_amounts([raw]) == ([expected], [""])
+
+
+@pytest.mark.parametrize("raw", ["1,234,567", "12,34,56", "abc", "-5"])
+def test_convert_amounts_rejects(raw):
+    amounts, errors = flt.convert_amounts([raw])
+    assert amounts == [None] and errors[0].startswith("Некорректный формат суммы")
+
+
+def test_convert_amounts_empty():
+    assert flt.convert_amounts([None, " "]) == ([None, None], ["Пустое значение суммы"] * 2)
@@ -0,0 +1,55 @@
+"""
+Сводный выход (--consolidate): все отобранные строки в одной книге или в
+книгах по кодам LE, колонка исходного файла, перенос шардов во временные
+файлы и продолжение в следующем файле при пределе строк.
+"""
+from openpyxl import Workbook
+
+from conftest import TEST_LE, flt, read_book, read_outputs
+
+
+def test_consolidated_outputs(run_main):
+    per_file = read_outputs(run_main("default"), skip={"skipped.xlsx", "errors.xlsx"})
+    filtered = sum(len(sheet_rows) - 1 for books in per_file.values() for _, sheet_rows in books)
+
+    out_all = run_main("all", "--consolidate", "all")
+    book = read_book(out_all / "filtered.xlsx")
+    assert sum(len(sheet_rows) - 1 for _, sheet_rows in book) == filtered
+    header, first = book[0][1][0], book[0][1][1]
+    assert header[-1][0] == flt.CONSOLIDATED_SOURCE_HEADER
+    assert first[-1][0].endswith(".xlsx")
+
+    out_le = run_main("le", "--consolidate", "le")
+    assert sorted(path.name for path in (out_le / flt.CONSOLIDATED_LE_DIR).iterdir()) == \
+        ["TESTLE1.xlsx", "TESTLE2.xlsx"]
+    # Строка test_multiple_le с двумя кодами — в книгах обоих
+    for code in TEST_LE:
+        sources = [row[-1][0] for _, rows in read_book(out_le / "by_le" / f"{code}.xlsx") for row in rows[1:]]
+        assert "test_multiple_le.xlsx" in sources
+
+
+def consolidate(workdir, name: str, **limits):
+    """
+    Пишет отобранные строки всех входных файлов в ConsolidatedOutput("le")
+    с пределами limits; возвращает папку выхода.
+    """
+    out_dir = workdir / name
+    out_dir.mkdir()
+    options = flt.FilterOptions(out_dir=str(out_dir), consolidate="le", write_skipped=False)
+    consolidated = flt.ConsolidatedOutput("le", str(out_dir), **limits)
+    errors_ws = flt.ErrorsSheet()
+    in_files = sorted(str(path) for path in (workdir / "in").glob("*.xlsx"))
+    for fp, sheet in flt.plan_sheet_jobs(in_files):
+        flt.write_filtered_rows(fp, set(TEST_LE), Workbook(write_only=True), errors_ws,
+                                options, sheet=sheet, consolidated=consolidated)
+    consolidated.save()
+    errors_ws.save(str(workdir / f"{name}_errors.xlsx"))
+    return out_dir
+
+
+def test_consolidated_spill_matches_open_shards(workdir):
+    expected = read_outputs(consolidate(workdir, "open", max_rows=2))
+    out = consolidate(workdir, "spill", max_rows=2, max_open=1)
+    assert read_outputs(out) == expected
+    assert "by_le/TESTLE2_2.xlsx" in expected
+    assert not [path for path in out.iterdir() if path.name.startswith(".consolidated-")]
@@ -0,0 +1,137 @@
+"""
+Равенство выходов при разных движках, чтении, сопоставлении, числе
+процессов и прочих настройках на файлах generate_test_files.py.
+"""
+import io
+import zipfile
+
+import pytest
+from openpyxl import Workbook
+
+from conftest import TEST_LE, flt, read_book, read_outputs
+
+
+@pytest.mark.parametrize("argv", [
+    ["--engine", "template"],
+    ["--workers", "2"],
+    ["--matcher", "vector"],
+    ["--matcher", "loop"],
+    ["--parse-cache", ".parse_cache"],
+    ["--chunk-rows", "1"],
+    ["--reader", "openpyxl"],
+    ["--engine", "zip"],
+    ["--pipeline-depth", "0"],
+], ids=lambda argv: " ".join(argv))
+def test_settings_give_same_outputs(run_main, argv):
+    expected = read_outputs(run_main("default"))
+    assert "test_multiple_le.xlsx" in expected and "skipped.xlsx" in expected
+    assert read_outputs(run_main("variant", *argv)) == expected
+
+
+def test_parse_cache_hit_gives_same_outputs(run_main, workdir):
+    expected = read_outputs(run_main("default"))
+    run_main("fill", "--parse-cache", ".parse_cache")
+    assert any((workdir / ".parse_cache").iterdir())
+    assert read_outputs(run_main("hit", "--parse-cache", ".parse_cache")) == expected
+
+
+def test_groups_get_rows_of_their_codes(run_main, workdir):
+    (workdir / "map.txt").write_text("TESTLE1;g1\nTESTLE2;g3\n", encoding="utf-8")
+    out = run_main("groups", "--le-map", "map.txt")
+    assert [row[2][0] for row in read_book(out / "g1" / "test_le_different_columns.xlsx")[0][1][1:]] == ["TESTLE1"]
+    assert [row[4][0] for row in read_book(out / "g3" / "test_le_different_columns.xlsx")[0][1][1:]] == ["TESTLE2"]
+
+
+def test_groups_get_rows_of_every_matched_code(run_main, workdir):
+    (workdir / "map.txt").write_text("TESTLE1;g1\nTESTLE2;g3\n", encoding="utf-8")
+    out = run_main("groups", "--le-map", "map.txt")
+    g1 = read_book(out / "g1" / "test_multiple_le.xlsx")[0][1]
+    g3 = read_book(out / "g3" / "test_multiple_le.xlsx")[0][1]
+    assert [cell[0] for cell in g1[1]] == [cell[0] for cell in g3[1]]
+    assert len(g1) == len(g3) == 2
+
+
+def test_groups_with_template_engine_are_rejected():
+    with pytest.raises(ValueError):
+        flt.FilterOptions(engine="template", le_groups={"g1": {"TESTLE1"}})
+
+
+def test_no_skipped_keeps_filtered_outputs(run_main):
+    expected = read_outputs(run_main("default"), skip={"skipped.xlsx"})
+    out = run_main("no_skipped", "--no-skipped")
+    assert not (out / "skipped.xlsx").exists()
+    assert read_outputs(out) == expected
+
+
+def write_wide_sheet(path, rows: int = 200):
+    """
+    Широкий лист с маркером LE в колонке «Тип»; отбирается каждая четвёртая строка.
+    """
+    wb = Workbook()
+    ws = wb.active
+    ws.append(["Дата", "Тип", "Аналитика", "Сумма", *(f"Поле {i}" for i in range(20))])
+    for row in range(rows):
+        ws.append(["2024-01-01", "LE", "TESTLE1" if row % 4 == 0 else "OTHER", row, *(f"v{row}_{i}" for i in range(20))])
+    wb.save(path)
+
+
+def test_no_skipped_with_le_marker_reads_in_two_phases(run_main, workdir, monkeypatch):
+    for path in (workdir / "in").iterdir():
+        path.unlink()
+    write_wide_sheet(workdir / "in" / "wide.xlsx")
+    (workdir / "layout.json").write_text('{"le_marker": ["Тип"]}', encoding="utf-8")
+    expected = read_outputs(run_main("default"), skip={"skipped.xlsx"})
+
+    materialized = []
+    materialize = flt.XmlRowSource.materialize
+    monkeypatch.setattr(flt.XmlRowSource, "materialize",
+                        lambda self, cells, values: materialized.append(cells) or materialize(self, cells, values))
+    log_start = (workdir / flt.LOG_FILE).stat().st_size
+    out = run_main("two_phase", "--no-skipped", "--layout", "layout.json")
+    log = (workdir / flt.LOG_FILE).read_bytes()[log_start:].decode("utf-8")
+    assert "Чтение в две фазы: " in log
+    # Целиком разобраны только отобранные строки
+    assert len(materialized) == 50
+    assert read_outputs(out) == expected
+
+    materialized.clear()
+    log_start = (workdir / flt.LOG_FILE).stat().st_size
+    run_main("whole_row", "--no-skipped")
+    log = (workdir / flt.LOG_FILE).read_bytes()[log_start:].decode("utf-8")
+    assert "Чтение в две фазы не используется: колонки маркера LE не заданы" in log
+    assert not materialized
+
+
+def write_broken_sheet(path):
+    """
+    Книга, лист которой обрывается посреди XML: открывается, но чтение
+    строк падает с ParseError после первых блоков.
+    """
+    wb = Workbook()
+    ws = wb.active
+    ws.append(["Дата", "Тип", "Аналитика", "Сумма"])
+    for row in range(3000):
+        ws.append(["2024-01-01", "LE", "TESTLE1" if row % 2 else "OTHER", row])
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    with zipfile.ZipFile(buffer) as src, zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as dst:
+        for info in src.infolist():
+            data = src.read(info.filename)
+            if info.filename == "xl/worksheets/sheet1.xml":
+                data = data[:len(data) * 9 // 10]
+            dst.writestr(info, data)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_failed_file_does_not_stop_batch(run_main, workdir, workers):
+    expected = read_outputs(run_main("default"), skip={"skipped.xlsx", "errors.xlsx"})
+    write_broken_sheet(workdir / "in" / "test_broken_sheet.xlsx")
+    in_files = sorted(str(path) for path in (workdir / "in").glob("*.xlsx"))
+    options = flt.FilterOptions(out_dir="broken")
+    batch = flt.run_batch(in_files, set(TEST_LE), options, workers)
+    assert [result.file_name for result in batch.files if result.failed] == ["test_broken_sheet.xlsx"]
+    assert len(batch.files) == len(flt.plan_sheet_jobs(in_files))
+    assert read_outputs(workdir / "broken", skip={"skipped.xlsx", "errors.xlsx"}) == expected
+    errors = [row[2][0] for row in read_book(workdir / "broken" / "errors.xlsx")[0][1]
+              if row[0][0] == "test_broken_sheet.xlsx"]
+    assert errors[-1].startswith("Ошибка обработки файла")
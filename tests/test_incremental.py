@@ -0,0 +1,117 @@
+"""
+Режимы --incremental и --watch: результат совпадает с полным запуском,
+повторно обрабатываются только изменённые файлы, выходы недописанных
+файлов не удаляются.
+"""
+import glob
+import os
+import signal
+
+import pytest
+from openpyxl import load_workbook
+
+from conftest import TEST_LE, flt, read_book, read_outputs
+
+
+def input_files() -> list:
+    return sorted(glob.glob(flt.IN_PATTERN))
+
+
+def test_incremental_matches_full_run(run_main):
+    expected = read_outputs(run_main("full"))
+    assert read_outputs(run_main("first", "--incremental")) == expected
+    os.replace("out_first", flt.OUT_DIR)
+    assert read_outputs(run_main("second", "--incremental")) == expected
+
+
+def test_incremental_reprocesses_only_changed_files(workdir):
+    options = flt.FilterOptions()
+    batch = flt.run_incremental_batch(input_files(), set(TEST_LE), options)
+    assert not any(result.cached for result in batch.files)
+
+    # Файл с тем же содержимым и новым mtime не обрабатывается заново
+    os.utime("in/test_empty_rows.xlsx")
+    batch = flt.run_incremental_batch(input_files(), set(TEST_LE), options)
+    assert all(result.cached for result in batch.files)
+
+    book = read_book("in/test_multiple_le.xlsx")
+    wb = load_workbook("in/test_multiple_le.xlsx")
+    wb.active["D3"] = "TESTLE2"
+    wb.save("in/test_multiple_le.xlsx")
+    batch = flt.run_incremental_batch(input_files(), set(TEST_LE), options)
+    fresh = [result.file_name for result in batch.files if not result.cached]
+    assert fresh == ["test_multiple_le.xlsx"]
+    assert len(read_book("out/test_multiple_le.xlsx")[0][1]) == len(book[0][1])
+
+    os.remove("in/test_empty_rows.xlsx")
+    flt.run_incremental_batch(input_files(), set(TEST_LE), options)
+    assert not os.path.exists("out/test_empty_rows.xlsx")
+
+
+def test_incremental_uses_out_dir(workdir):
+    options = flt.FilterOptions(out_dir="alt")
+    flt.run_incremental_batch(input_files(), set(TEST_LE), options)
+    assert os.path.exists(os.path.join("alt", flt.MANIFEST_FILE))
+    assert os.path.isdir(os.path.join("alt", flt.CACHE_DIR))
+    assert not os.path.exists(flt.OUT_DIR)
+    batch = flt.run_incremental_batch(input_files(), set(TEST_LE), options)
+    assert all(result.cached for result in batch.files)
+
+
+def test_pending_files_keep_their_outputs(workdir):
+    options = flt.FilterOptions()
+    flt.run_incremental_batch(input_files(), set(TEST_LE), options)
+    others = [fp for fp in input_files() if not fp.endswith("test_empty_rows.xlsx")]
+    flt.run_incremental_batch(others, set(TEST_LE), options, pending=["test_empty_rows.xlsx"])
+    assert os.path.exists("out/test_empty_rows.xlsx")
+    assert "test_empty_rows.xlsx" in flt.load_manifest()["files"]
+
+
+@pytest.fixture
+def watch(workdir, monkeypatch):
+    """
+    Запускает watch_input_dir на polls опросов (between(номер опроса) — между ними); возвращает итоги циклов.
+    """
+    monkeypatch.setattr(flt, "WATCH_SETTLE_SECONDS", 0)
+
+    def run(polls: int, workers: int = 1, between=None):
+        batches = []
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if between is not None:
+                between(len(sleeps))
+            if len(sleeps) >= polls:
+                raise KeyboardInterrupt
+
+        monkeypatch.setattr(flt.time, "sleep", sleep)
+        handler = signal.getsignal(signal.SIGTERM)
+        try:
+            flt.watch_input_dir(set(TEST_LE), flt.FilterOptions(), workers, 0, batches.append, 1)
+        finally:
+            signal.signal(signal.SIGTERM, handler)
+        return batches
+
+    return run
+
+
+def test_watch_first_poll_keeps_previous_outputs(run_main, watch):
+    expected = read_outputs(run_main("full", "--incremental"))
+    os.replace("out_full", flt.OUT_DIR)
+    batches = watch(polls=2)
+    assert len(batches) == 1
+    assert all(result.cached for result in batches[0].files)
+    assert read_outputs(flt.OUT_DIR) == expected
+
+
+def test_watch_drops_outputs_of_removed_files(watch, workdir):
+    def between(poll):
+        if poll == 1:
+            os.replace("in/test_empty_rows.xlsx", "test_empty_rows.xlsx")
+
+    batches = watch(polls=3, workers=2, between=between)
+    assert len(batches) == 2
+    assert "test_empty_rows.xlsx" in [result.file_name for result in batches[0].files]
+    assert "test_empty_rows.xlsx" not in [result.file_name for result in batches[1].files]
+    assert not os.path.exists("out/test_empty_rows.xlsx")
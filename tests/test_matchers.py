@@ -0,0 +1,56 @@
+"""
+Сопоставление LE: построчный, векторный и компилированный поиск дают
+одинаковые решения.
+"""
+from openpyxl import load_workbook
+
+from conftest import TEST_LE, flt
+
+
+def fixture_rows(workdir) -> list:
+    rows = []
+    for path in sorted((workdir / "in").glob("*.xlsx")):
+        if path.name == "test_corrupted.xlsx":
+            continue
+        for ws in load_workbook(path, read_only=True).worksheets:
+            rows += [list(row) for row in ws.iter_rows(min_row=2, values_only=True)]
+    return rows
+
+
+# Аналитика с табуляцией, переводом строки, неразрывными и узкими пробелами и тире
+WHITESPACE_ROWS = [
+    ["LE", "TEST\tLE1"],
+    ["LE", "\u00a0TESTLE2\u00a0"],
+    ["x", " le ", "TEST\u202fLE1"],
+    ["LE", "test-le\r\n1"],
+    ["LE", "TEST\x0bLE2\x0c"],
+    ["LE", "\u00a0"],
+    ["LE", "TEST\tLE3"],
+]
+
+
+def test_matchers_classify_fixture_rows_alike(workdir):
+    le_set = set(TEST_LE)
+    rows = fixture_rows(workdir) + WHITESPACE_ROWS
+    expected = [flt.find_le_match(values, le_set) for values in rows]
+    assert flt.classify_rows_vectorized(rows, le_set) == expected
+    compiled = flt.LEMatcher(le_set).classify_rows(rows)
+    assert [decision[0] for decision in compiled] == [decision[0] for decision in expected]
+
+
+def test_matchers_normalize_whitespace_alike():
+    le_set = set(TEST_LE)
+    expected = [flt.find_le_match(values, le_set) for values in WHITESPACE_ROWS]
+    assert [decision[0] for decision in expected] == ["match"] * 5 + ["error", "skip"]
+    assert flt.classify_rows_vectorized(WHITESPACE_ROWS, le_set) == expected
+    assert flt.LEMatcher(le_set).classify_rows(WHITESPACE_ROWS) == expected
+
+
+def test_compiled_matcher_returns_every_code():
+    matcher = flt.LEMatcher({"TESTLE1", "TESTLE2"})
+    assert matcher.classify(["LE", "TESTLE1", "x", "LE", "TESTLE2"]) == ("match", "", ("TESTLE1", "TESTLE2"))
+    assert matcher.classify(["LE", "OTHER", "LE", "TESTLE2"]) == ("match", "", ("TESTLE2",))
+    assert matcher.classify(["LE", "OTHER"]) == ("skip", "", "OTHER")
+    assert matcher.classify(["LE", ""])[0] == "error"
+    in_text = flt.LEMatcher({"LE001", "LE002"}, search_text=True)
+    assert in_text.classify(["Оплата LE-001, LE-002"]) == ("match", "", ("LE001", "LE002"))
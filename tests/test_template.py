@@ -0,0 +1,25 @@
+"""
+Движок template: обрезка исходного листа ниже последней записанной строки.
+"""
+from openpyxl import Workbook
+from openpyxl.styles import PatternFill
+
+from conftest import flt
+
+
+def test_truncate_rows_keeps_every_column_of_kept_rows():
+    ws = Workbook().active
+    for row in range(1, 6):
+        ws.append([f"r{row}c{col}" for col in range(1, 4)])
+    ws.cell(row=2, column=10, value="note").fill = PatternFill("solid", fgColor="FFFF00")
+    ws.cell(row=5, column=10, value="tail")
+
+    flt.truncate_rows(ws, 3)
+    assert ws.max_row == 3
+    assert [cell.value for cell in ws[3][:3]] == ["r3c1", "r3c2", "r3c3"]
+    assert ws.cell(row=2, column=10).value == "note"
+    assert ws.cell(row=2, column=10).fill.fgColor.rgb == "00FFFF00"
+    assert not [cell for row in ws.iter_rows(min_row=4) for cell in row if cell.value is not None]
+
+    flt.truncate_rows(ws, 3)
+    assert ws.max_row == 3
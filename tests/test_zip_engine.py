@@ -0,0 +1,124 @@
+"""
+Движок zip: перенос слияний, проверок данных, закреплённых областей и
+гиперссылок на новые номера строк, запись целых чисел.
+"""
+import io
+import re
+import zipfile
+from xml.etree import ElementTree
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.worksheet.datavalidation import DataValidation
+
+from conftest import flt
+
+
+def test_remap_sqref():
+    rows = [3, 6, 9, 15]  # исходные номера записанных строк: заголовок и три строки данных
+    assert flt.remap_sqref("E6:E10", rows) == "E2:E3"
+    assert flt.remap_sqref("A1:E1", rows) == ""
+    assert flt.remap_sqref("C7:D8", rows) == ""
+    assert flt.remap_sqref("B4:B29 $D$9", rows) == "B2:B4 $D$3"
+    assert flt.remap_sqref("A:C", rows) == "A:C"
+    assert flt.remap_sqref("E9:E10", rows, merge=True) == ""
+
+
+def test_excel_number():
+    assert flt.excel_number(1000.0) == "1000"
+    assert flt.excel_number(1000) == "1000"
+    assert flt.excel_number(0.1) == "0.1"
+
+
+def rich_workbook() -> Workbook:
+    """
+    Лист с заголовком в строке 3, слияниями, проверкой данных, закреплением
+    и гиперссылками; отбираются строки 6, 9, ..., 27.
+    """
+    wb = Workbook()
+    ws = wb.active
+    ws.append(["Отчёт"])
+    ws.append([])
+    ws.append(["Дата", "Сумма", "Тип", "Аналитика", "Комментарий"])
+    for row in range(4, 30):
+        ws.append(["2024-01-01", row * 10, "LE", "TESTLE1" if row % 3 == 0 else "OTHER", f"r{row}"])
+    ws.merge_cells("A1:E1")
+    ws.merge_cells("E6:E10")
+    ws.freeze_panes = "A4"
+    validation = DataValidation(type="list", formula1='"a,b"')
+    validation.add("E4:E29")
+    ws.add_data_validation(validation)
+    ws["E15"].hyperlink = "http://example.com"
+    ws["E13"].hyperlink = "http://example.org"
+    return wb
+
+
+def clear_inputs(workdir):
+    for path in (workdir / "in").iterdir():
+        path.unlink()
+
+
+def test_zip_engine_remaps_row_bound_elements(workdir):
+    clear_inputs(workdir)
+    rich_workbook().save(workdir / "in" / "rich.xlsx")
+
+    flt.main(["--quiet", "--engine", "zip"])
+    with zipfile.ZipFile(workdir / "out" / "rich.xlsx") as zf:
+        xml = zf.read("xl/worksheets/sheet1.xml").decode()
+    assert '<v>60</v>' in xml and '60.0' not in xml
+    result = load_workbook(workdir / "out" / "rich.xlsx").active
+    assert [row[4] for row in result.iter_rows(values_only=True)][:3] == ["Комментарий", "r6", None]
+    assert [str(rng) for rng in result.merged_cells.ranges] == ["E2:E3"]
+    assert result.freeze_panes == "A2"
+    assert [str(dv.sqref) for dv in result.data_validations.dataValidation] == ["E2:E9"]
+    assert [(cell.coordinate, cell.hyperlink.target) for row in result.iter_rows() for cell in row
+            if cell.hyperlink] == [("E5", "http://example.com")]
+
+
+def prefixed_xml(data: bytes) -> bytes:
+    """
+    Та же часть, как её пишут другие программы: теги с префиксом x:,
+    атрибуты в одинарных кавычках, mc:Ignorable с неиспользуемым префиксом.
+    """
+    ElementTree.register_namespace("x", "http://schemas.openxmlformats.org/spreadsheetml/2006/main")
+    ElementTree.register_namespace("r", "http://schemas.openxmlformats.org/officeDocument/2006/relationships")
+    xml = re.sub(rb'="([^"]*)"', rb"='\1'", ElementTree.tostring(ElementTree.fromstring(data)))
+    return b"<?xml version='1.0' encoding='UTF-8'?>\n" + xml.replace(
+        b" xmlns:x=", b" xmlns:mc='http://schemas.openxmlformats.org/markup-compatibility/2006'"
+        b" xmlns:x14ac='http://schemas.microsoft.com/office/spreadsheetml/2009/9/ac' mc:Ignorable='x14ac'"
+        b" xmlns:x=", 1)
+
+
+def test_zip_engine_edits_prefixed_parts_in_place(workdir):
+    clear_inputs(workdir)
+    wb = rich_workbook()
+    wb.active.title = "Данные"
+    wb.active.auto_filter.ref = "A3:E29"
+    wb.create_sheet("Второй").append(["x"])
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    edited = ("xl/worksheets/sheet1.xml", "xl/styles.xml", "xl/workbook.xml")
+    with zipfile.ZipFile(buffer) as src, zipfile.ZipFile(workdir / "in" / "rich.xlsx", "w") as dst:
+        for info in src.infolist():
+            data = src.read(info.filename)
+            dst.writestr(info, prefixed_xml(data) if info.filename in edited else data)
+
+    flt.main(["--quiet", "--engine", "zip", "--sheets", "Данные"])
+    out_path = workdir / "out" / "rich_Данные.xlsx"
+    with zipfile.ZipFile(workdir / "in" / "rich.xlsx") as src, zipfile.ZipFile(out_path) as out:
+        assert "xl/worksheets/sheet2.xml" not in out.namelist()
+        assert out.read("xl/theme/theme1.xml") == src.read("xl/theme/theme1.xml")
+        for name in edited:
+            # Корневой тег с объявлениями пространств имён переносится как есть
+            root = re.search(rb"<x:\w+ [^>]*>", src.read(name)).group(0)
+            assert root in out.read(name)
+        sheet = out.read("xl/worksheets/sheet1.xml").decode()
+        workbook = out.read("xl/workbook.xml").decode()
+    assert "'Данные'!$A$1:$E$9" in workbook and "Второй" not in workbook
+    assert '<x:mergeCell ref="E2:E3"/>' in sheet and '<x:autoFilter ref="A1:E9"/>' in sheet
+    result = load_workbook(out_path)
+    assert result.sheetnames == ["Данные"]
+    ws = result.active
+    assert [str(rng) for rng in ws.merged_cells.ranges] == ["E2:E3"]
+    assert ws.freeze_panes == "A2"
+    assert [str(dv.sqref) for dv in ws.data_validations.dataValidation] == ["E2:E9"]
+    assert [cell.number_format for cell in ws[2][:2]] == [flt.DATE_NUMBER_FORMAT, flt.AMOUNT_NUMBER_FORMAT]